@@ -0,0 +1,162 @@
+"""Len Taing 2019 (TGBTG)
+CHIPS automator - picks the machine type and data disk size of a run from
+the size of its inputs (see apply)
+"""
+
+import math
+import zlib
+
+import gcp
+import bucket
+import workers
+
+#THE SIZE MODEL--rough figures from past chips runs, tune as more runs come
+#in.  Reads are estimated from the compressed fastq sizes unless they're
+#counted from the head of each file (see estimateReads)
+_bytes_per_read = 60.0      #gzip fastq bytes per read
+_disk_per_input = 5.0       #GB of bams/peaks/etc per GB of input
+_disk_base_gb = 100         #conda envs, logs, reports...
+_disk_step_gb = 100         #disk sizes are rounded up to this
+_mem_base_gb = 16           #bwa index, macs2 etc
+_mem_per_core_gb = 2        #per concurrent job
+#(max total reads in millions, cores)--the more reads, the more cores
+_core_tiers = [(50, 8), (200, 16), (500, 32), (1000, 64)]
+_max_cores = 96
+#machine families, cheapest first, with their GB of memory per core
+_families = [('n2-standard', 4), ('n2-highmem', 8)]
+#compressed bytes read from the head of each fastq when counting reads
+_head_bytes = 4 * 1024 * 1024
+
+def countReads(head):
+    """Given the first bytes of a gzip fastq, RETURNS (reads, compressed
+    bytes consumed) for the whole records found in it
+    NOTE: handles multi-member (e.g. bgzip) files; a truncated last member
+    is fine, whatever was decompressed is counted"""
+    lines = 0
+    consumed = 0
+    data = head
+    while data:
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            lines += d.decompress(data).count(b"\n")
+        except zlib.error:
+            break
+        consumed += len(data) - len(d.unused_data)
+        data = d.unused_data
+    return (lines // 4, consumed)
+
+def estimateReads(storage, objects, num_workers=8):
+    """Estimates the reads in each gzip fastq (by counting the reads in its
+    first _head_bytes and scaling by its size); other files are estimated
+    from their size
+    INPUT: {path: object resource} e.g. from checkConfig
+    RETURNS: {path: estimated reads}"""
+    def _estimate(path):
+        size = int(objects[path]['size'])
+        if path.endswith(".gz") and size:
+            head = bucket.download_head(gcp.for_thread(storage), path, _head_bytes)
+            (reads, consumed) = countReads(head)
+            if reads and consumed:
+                return int(reads * float(size) / consumed)
+        return int(size / _bytes_per_read)
+
+    estimates = {}
+    for (path, reads, err) in workers.imap_unordered(_estimate, list(objects), num_workers):
+        if err is not None:
+            print("Could not count the reads in %s (%s), estimating from its size" % (path, err))
+            reads = int(int(objects[path]['size']) / _bytes_per_read)
+        estimates[path] = reads
+    return estimates
+
+def pickFamily(cores):
+    """RETURNS: (the cheapest machine family with enough memory for the
+    given cores, its GB per core, the GB needed)"""
+    mem_gb = _mem_base_gb + _mem_per_core_gb * cores
+    for (family, per_core) in _families:
+        if per_core * cores >= mem_gb:
+            return (family, per_core, mem_gb)
+    return _families[-1] + (mem_gb,)
+
+def model(sample_bytes, sample_reads):
+    """The size model: given {sample: input bytes} and {sample: reads}
+    RETURNS: ({'cores', 'machine_type', 'disk_size'}, list of reasons)"""
+    reasons = []
+    total_gb = sum(sample_bytes.values()) / 1e9
+    total_reads = sum(sample_reads.values()) / 1e6
+    largest = max(sample_bytes, key=lambda s: sample_bytes[s]) if sample_bytes else None
+    reasons.append("%s samples, %.1f GB of input (largest: %s, %.1f GB), ~%.0fM reads" %
+                   (len(sample_bytes), total_gb, largest,
+                    sample_bytes.get(largest, 0) / 1e9, total_reads))
+
+    cores = _max_cores
+    for (max_reads, tier_cores) in _core_tiers:
+        if total_reads <= max_reads:
+            cores = tier_cores
+            break
+    reasons.append("~%.0fM reads -> %s cores" % (total_reads, cores))
+
+    (family, per_core, mem_gb) = pickFamily(cores)
+    reasons.append("%s cores need ~%s GB of memory -> %s (%s GB)" %
+                   (cores, mem_gb, family, per_core * cores))
+
+    disk_gb = _disk_base_gb + _disk_per_input * total_gb
+    disk_size = int(math.ceil(disk_gb / _disk_step_gb) * _disk_step_gb)
+    reasons.append("%s GB + %.0fx %.1f GB of input -> %s GB disk" %
+                   (_disk_base_gb, _disk_per_input, total_gb, disk_size))
+    return ({'cores': cores,
+             'machine_type': "%s-%s" % (family, cores),
+             'disk_size': disk_size}, reasons)
+
+def apply(config, storage, source_objects=None, num_workers=8):
+    """Autosizes the automator config in place (if it says autosize: true):
+    the cores, machine_type and disk_size that AREN'T given in the config
+    are filled in from the size model.  With autosize_reads: true the reads
+    are counted from the head of each fastq rather than guessed from the
+    file sizes.  The reasoning is printed.
+    source_objects ({path: object resource}, e.g. from checkConfig) saves
+    looking the inputs up again
+    NOTE: a config that's been autosized already (e.g. by the fleet's quota
+    check) has every size filled in, so it's left as is
+    RETURNS: the sizes that were picked (or {} if autosize is off or there
+    was nothing left to pick)"""
+    if not config.get('autosize'):
+        return {}
+    if all(config.get(k) for k in ['cores', 'machine_type', 'disk_size']):
+        return {}
+    if source_objects is None:
+        paths = [p for s in config['samples'] for p in bucket.sample_paths(config['samples'][s])]
+        (source_objects, invalid) = bucket.check_paths(storage, paths, num_workers)
+
+    if config.get('autosize_reads'):
+        reads = estimateReads(storage, source_objects, num_workers)
+    else:
+        reads = dict((p, int(int(o['size']) / _bytes_per_read))
+                     for (p, o) in source_objects.items())
+
+    sample_bytes = {}
+    sample_reads = {}
+    for sample in config['samples']:
+        paths = bucket.sample_paths(config['samples'][sample])
+        found = [p for p in paths if p in source_objects]
+        sample_bytes[sample] = sum(int(source_objects[p]['size']) for p in found)
+        sample_reads[sample] = sum(reads[p] for p in found)
+
+    (sizes, reasons) = model(sample_bytes, sample_reads)
+    print("Autosizing:")
+    for r in reasons:
+        print("  %s" % r)
+    #NOTE: whatever is given in the config wins; if only the cores are
+    #given, the machine family is still picked to fit them
+    if config.get('machine_type'):
+        sizes['machine_type'] = config['machine_type']
+        sizes['cores'] = int(config['machine_type'].split("-")[-1])
+    elif config.get('cores'):
+        sizes['cores'] = int(config['cores'])
+        sizes['machine_type'] = "%s-%s" % (pickFamily(sizes['cores'])[0], sizes['cores'])
+    for k in ['cores', 'machine_type', 'disk_size']:
+        if config.get(k):
+            print("  %s: %s (from the config)" % (k, config[k]))
+        else:
+            config[k] = sizes[k]
+            print("  %s: %s" % (k, sizes[k]))
+    return sizes
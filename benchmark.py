@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+"""Len Taing 2019 (TGBTG)
+CHIPS automator benchmark - runs the automator's config check, provisioning,
+data transfer, bucket-to-bucket copy and empty-file scan end to end against the in-process fakes
+(see fakes.py) for cohorts of increasing size and reports per-phase
+timings.  Nothing touches GCP, so it's free to run as often as needed, e.g.
+to compare the timings before/after a change (see -j).  A spot run is also
+preempted part way and checked to resume where it left off (see -P)
+NOTE: transfers really run--with bash, xargs and the fake gsutil--on this
+machine, through a local ssh server
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import threading
+import tempfile
+import contextlib
+from optparse import OptionParser
+
+import gcp
+import cache
+import fakes
+import bucket
+import tracing
+import chips_automator
+import chips_automator_tx
+
+_phases = ['check', 'provision', 'transfer', 'copy', 'empty']
+
+#every bucket-to-bucket copy takes this many rewrite calls (see -f)
+_rewrite_calls = 4
+
+@contextlib.contextmanager
+def _quiet(verbose):
+    """Hides what the automator prints (unless verbose)"""
+    if verbose:
+        yield
+        return
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+def makeCohort(storage, num_samples, file_size):
+    """Puts num_samples single-fastq samples in the fake store, along with a
+    finished run's results (a few of which are empty)
+    RETURNS: (automator config, results bucket path)"""
+    tag = "cohort_%s" % num_samples
+    record = b"@read\nACGTACGTACGTACGTACGTACGTACGTACGT\n+\nIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIII\n"
+    samples = {}
+    for i in range(num_samples):
+        sample = "S%04d" % i
+        path = "gs://bench-src/%s/%s.fastq.gz" % (tag, sample)
+        #NOTE: the sample name leads so every file has its own checksum
+        data = sample.encode("ascii") + record * (file_size // len(record) + 1)
+        storage.put(path, data[:file_size])
+        samples[sample] = [path]
+
+    results = "gs://bench-out/%s" % tag
+    for sample in samples:
+        for (f, size) in [("align/%s.bam" % sample, 1024),
+                          ("peaks/%s_peaks.bed" % sample, 256),
+                          ("logs/align/%s.log" % sample, 0),
+                          ("peaks/%s/%s_sorted_5k_summits.bed" % (sample, sample), 0)]:
+            storage.put("%s/analysis/%s" % (results, f), b"x" * size)
+    #every 10th sample is missing its peaks
+    for sample in sorted(samples)[::10]:
+        storage.put("%s/analysis/peaks/%s_peaks.bed" % (results, sample), b"")
+
+    samples_list = sorted(samples)
+    metasheet = {}
+    for i in range(0, len(samples_list), 2):
+        metasheet["run_%s" % samples_list[i]] = {'treat1': samples_list[i],
+                                                 'cont1': (samples_list[i + 1:i + 2] or [None])[0],
+                                                 'treat2': None, 'cont2': None}
+    config = {'instance_name': "bench-%s" % num_samples,
+              'cores': 8,
+              'disk_size': 500,
+              'google_bucket_path': results,
+              'samples': samples,
+              'metasheet': metasheet}
+    return (config, results)
+
+def runScale(num_samples, compute, storage, server, key_file, work_dir, file_size, num_workers, verbose):
+    """Runs every phase for one cohort size
+    RETURNS: {phase: {'secs', 'requests'}}"""
+    (config, results) = makeCohort(storage, num_samples, file_size)
+    #every launch starts cold
+    cache.invalidate()
+
+    timings = {}
+    def _phase(name, fn):
+        requests = gcp.request_count()
+        start = time.time()
+        with _quiet(verbose):
+            with tracing.span("%s x%s" % (name, num_samples), "benchmark"):
+                res = fn()
+        timings[name] = {'secs': time.time() - start,
+                         'requests': gcp.request_count() - requests}
+        return res
+
+    source_objects = _phase('check', lambda: chips_automator.checkConfig(config, storage, template=None))
+
+    instance_name = "chips-auto-%s" % config['instance_name']
+    instance_config = {'name': instance_name,
+                       'image_name': '',
+                       'image_family': 'chips',
+                       'machine_type': chips_automator.getMachineType(config),
+                       'serviceAcct': 'bench@example.com'}
+    disk_config = {'name': "%s-disk" % instance_name, 'size': config['disk_size']}
+    ssh_config = {'user': 'chips', 'key': key_file, 'port': server.port}
+    (instance_id, ip, ssh_conn) = _phase('provision', lambda: chips_automator.createInstanceDisk(
+        compute, instance_config, 'chips-ref-bench', disk_config, ssh_config,
+        'bench-project', 'us-east1-b'))
+
+    try:
+        chips_dir = os.path.join(work_dir, "instances", instance_name)
+        _phase('transfer', lambda: chips_automator.transferRawFiles_local(
+            config['samples'], ssh_conn, 'data', chips_dir=chips_dir,
+            num_workers=num_workers, source_objects=source_objects))
+        #NOTE: not counting the .done/.ready markers
+        copied = sum(len([f for f in files if not f.startswith(".")])
+                     for (d, dirs, files) in os.walk(os.path.join(chips_dir, 'data')))
+        if copied != num_samples:
+            raise Exception("transferred %s of %s files" % (copied, num_samples))
+    finally:
+        ssh_conn.client.close()
+
+    #NOTE: a sample whose file is missing must be left out of the copies
+    copy_samples = dict(config['samples'], MISSING=["gs://bench-src/missing.fastq.gz"])
+    copies = _phase('copy', lambda: chips_automator.transferRawFiles_remote(
+        copy_samples, results, storage, num_workers=num_workers))
+    if sorted(copies) != sorted(config['samples']):
+        raise Exception("copied samples %s, not %s" % (sorted(copies), sorted(config['samples'])))
+    for sample in config['samples']:
+        (src, dst) = (config['samples'][sample][0], "%s/%s" % (results, copies[sample][0]))
+        if storage.resource(*bucket.parse_path(dst))['crc32c'] != source_objects[src]['crc32c']:
+            raise Exception("%s was not copied whole" % src)
+    if timings['copy']['requests'] < _rewrite_calls * num_samples:
+        raise Exception("%s requests for %s copies of %s rewrite calls each" %
+                        (timings['copy']['requests'], num_samples, _rewrite_calls))
+
+    empty = _phase('empty', lambda: list(chips_automator_tx.checkForEmptyFiles(results, storage)))
+    expected = len(range(0, num_samples, 10))
+    if len(empty) != expected:
+        raise Exception("found %s of %s empty files" % (len(empty), expected))
+    return timings
+
+#A stand-in for chips' snakemake (see chips_automator.snakemakeCommand): it
+#builds the steps one at a time--skipping those already done--and marks each
+#step incomplete while it builds it, like snakemake.  Its own and its
+#parent's pids go in .pids, so the "preemption" can kill the run
+_fake_snakemake = """#!/bin/sh
+echo $PPID $$ > .pids
+mkdir -p analysis .snakemake/locks .snakemake/incomplete
+for i in $(seq %d); do
+  f=analysis/step$i
+  [ -f $f ] && continue
+  m=.snakemake/incomplete/$(printf '%%s' $f | base64 | tr '/+' '_-')
+  touch $m
+  echo partial > $f.tmp && sleep %s && mv $f.tmp $f
+  rm -f $m
+  echo $i >> analysis/built
+done
+"""
+
+def runPreemption(compute, storage, server, key_file, work_dir, steps=6, step_secs=0.5, verbose=False):
+    """Starts a (fake) spot run, preempts its instance part way through and
+    checks that the run is recovered and resumed, i.e. that it finishes
+    with every step built--without rebuilding the steps it had done
+    RETURNS: {'secs', 'requests', 'recovery_secs'}"""
+    config = {'instance_name': "bench-spot",
+              'cores': 8,
+              'google_bucket_path': "gs://bench-out/spot",
+              'spot': True,
+              'snakemake': os.path.join(work_dir, "fake_snakemake.sh")}
+    f = open(config['snakemake'], "w")
+    f.write(_fake_snakemake % (steps, step_secs))
+    f.close()
+    os.chmod(config['snakemake'], 0o755)
+    #NOTE: there are no disks to set up on the fake instances
+    chips_automator._setup_script = os.path.join(work_dir, "fake_setup.sh")
+    f = open(chips_automator._setup_script, "w")
+    f.write("#!/bin/bash\n#takes CHIPS_DATA_DEV and CHIPS_REF_DEV\ntrue\n")
+    f.close()
+    os.chmod(chips_automator._setup_script, 0o755)
+
+    instance_config = chips_automator.instanceConfig(config)
+    instance_config['image_name'] = ''
+    name = instance_config['name']
+    ssh_config = {'user': 'chips', 'key': key_file, 'port': server.port}
+    chips_dir = os.path.join(work_dir, "instances", name, "chips")
+    os.makedirs(chips_dir)
+    built = os.path.join(chips_dir, "analysis", "built")
+
+    def _preempt():
+        #once a few steps are done, stop the instance--and its run
+        while not os.path.exists(built) or len(open(built).read().split()) < steps // 2:
+            time.sleep(0.1)
+        compute.preempt('bench-project', 'us-east1-b', name)
+        for pid in open(os.path.join(chips_dir, ".pids")).read().split():
+            try:
+                os.kill(int(pid), signal.SIGKILL)
+            except OSError:
+                pass
+
+    requests = gcp.request_count()
+    start = time.time()
+    with _quiet(verbose):
+        (instance_id, ip, ssh_conn) = chips_automator.createInstanceDisk(
+            compute, instance_config, 'chips-ref-bench',
+            {'name': "%s-disk" % name, 'size': 100}, ssh_config,
+            'bench-project', 'us-east1-b', spot=True)
+        t = threading.Thread(target=_preempt)
+        t.daemon = True
+        t.start()
+        (status, ip) = chips_automator.watchRun(compute, storage, config, instance_config,
+                                                ssh_conn, ssh_config, 'bench-project',
+                                                'us-east1-b', chips_dir=chips_dir,
+                                                max_recoveries=1, poll_secs=0.2)
+    secs = time.time() - start
+
+    events = json.loads(bucket.download_string(storage, chips_automator.spotEventsPath(config['google_bucket_path'])).decode("utf-8"))
+    if status != 0 or [e['event'] for e in events] != ['preempted', 'recovered', 'finished']:
+        raise Exception("the preempted run was not resumed: status %s, events %s" % (status, events))
+    built = [int(i) for i in open(built).read().split()]
+    #NOTE: the step that was cut short is built again, nothing else
+    if sorted(set(built)) != list(range(1, steps + 1)) or len(built) > steps + 1:
+        raise Exception("the resumed run built steps %s" % built)
+    if [f for f in os.listdir(os.path.join(chips_dir, "analysis")) if f.endswith(".tmp")]:
+        raise Exception("the resumed run left incomplete outputs behind")
+    return {'secs': secs,
+            'requests': gcp.request_count() - requests,
+            'recovery_secs': [e for e in events if e['event'] == 'recovered'][0]['secs']}
+
+def printResults(results):
+    """Prints a table of every phase's timing for each scale"""
+    print("%8s %-10s %10s %10s %12s" % ("samples", "phase", "secs", "requests", "samples/sec"))
+    for (n, timings) in results:
+        for phase in _phases:
+            t = timings[phase]
+            print("%8s %-10s %10.2f %10s %12.1f" % (n, phase, t['secs'], t['requests'],
+                                                    n / t['secs'] if t['secs'] else 0))
+        print("%8s %-10s %10.2f %10s" % (n, "total", sum(timings[p]['secs'] for p in _phases),
+                                         sum(timings[p]['requests'] for p in _phases)))
+
+def main():
+    usage = "USAGE: %prog [-s scales, e.g. 1,10,100,1000] [-l api latency secs] [-o instance insert secs] [-j results json]"
+    optparser = OptionParser(usage=usage)
+    optparser.add_option("-s", "--scales", default="1,10,100,1000", help="comma separated cohort sizes (default: 1,10,100,1000)")
+    optparser.add_option("-f", "--file_size", type="int", default=64 * 1024, help="bytes per fastq (default: 64KB)")
+    optparser.add_option("-l", "--api_latency", type="float", default=0.05, help="secs per api round trip (default: 0.05)")
+    optparser.add_option("-o", "--op_latency", type="float", default=15.0, help="secs for the instance insert operation (default: 15)")
+    optparser.add_option("-m", "--mbps", type="float", default=0, help="throttle each fake gsutil copy to this many MB/s (default: no throttle)")
+    optparser.add_option("-w", "--workers", type="int", default=8, help="parallel transfers (default: 8)")
+    optparser.add_option("-j", "--json", help="also write the results to this json file")
+    optparser.add_option("-k", "--keep", action="store_true", default=False, help="keep the work dir")
+    optparser.add_option("-t", "--trace", help="write a Chrome trace json of the whole benchmark to this file")
+    optparser.add_option("-P", "--no_preempt", action="store_true", default=False, help="skip the spot preemption/resume check")
+    optparser.add_option("-v", "--verbose", action="store_true", default=False, help="show the automator's output")
+    (options, args) = optparser.parse_args(sys.argv)
+
+    scales = [int(s) for s in options.scales.split(",")]
+    if options.trace:
+        tracing.enable()
+    work_dir = tempfile.mkdtemp(prefix="chips_bench_")
+    #NOTE: keep the fake images/snapshots/instances out of the real cache
+    cache._cache_dir = os.path.join(work_dir, "cache")
+    #NOTE: so that the copies take several rewrite calls, like big fastqs
+    bucket._rewrite_chunk = -(-options.file_size // _rewrite_calls)
+
+    storage = fakes.FakeStorage(os.path.join(work_dir, "gcs"), latency=options.api_latency)
+    env = storage.install_gsutil(os.path.join(work_dir, "bin"))
+    if options.mbps:
+        env['FAKE_GSUTIL_MBPS'] = str(options.mbps)
+    server = fakes.FakeSSHServer(env)
+    key_file = fakes.FakeSSHServer.client_key(os.path.join(work_dir, "id_rsa"))
+    compute = fakes.FakeCompute({'api': options.api_latency,
+                                 'instance': options.op_latency})
+    print("Work dir: %s, ssh server on port %s" % (work_dir, server.port))
+
+    results = []
+    preemption = None
+    try:
+        for n in scales:
+            print("Running %s samples..." % n)
+            results.append((n, runScale(n, compute, storage, server, key_file,
+                                        work_dir, options.file_size,
+                                        options.workers, options.verbose)))
+        if not options.no_preempt:
+            print("Preempting a spot run...")
+            preemption = runPreemption(compute, storage, server, key_file, work_dir,
+                                       verbose=options.verbose)
+    finally:
+        server.close()
+        if not options.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    printResults(results)
+    if preemption:
+        print("spot run preempted and resumed: %.2f secs, %s requests (recovery %.2f secs)" %
+              (preemption['secs'], preemption['requests'], preemption['recovery_secs']))
+    if options.trace:
+        tracing.save(options.trace)
+        print("Trace written to %s" % options.trace)
+    if options.json:
+        f = open(options.json, "w")
+        json.dump({'options': options.__dict__,
+                   'results': [{'samples': n, 'phases': t} for (n, t) in results],
+                   'preemption': preemption},
+                  f, indent=1, sort_keys=True)
+        f.close()
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,300 @@
+"""Len Taing 2019 (TGBTG)
+CHIPS automator - Google Cloud Storage API wrapper for bucket operations
+NOTE: googleapiclient is imported lazily, see gcp.py
+"""
+
+import io
+import time
+import posixpath
+
+import gcp
+import workers
+import tracing
+
+#only ask for the object fields that the automator uses
+_object_fields = "bucket,name,size,crc32c,md5Hash,updated"
+
+#the most bytes a single rewrite call copies (a multiple of 1MB); larger
+#objects are copied over several calls, see rewrite_object
+_rewrite_chunk = 256 * 1024 * 1024
+
+def parse_path(path):
+    """Given a google bucket path, e.g. gs://mybucket/data/sample1.fastq.gz
+    returns a tuple of (bucket name, object name), e.g.
+    ('mybucket', 'data/sample1.fastq.gz')"""
+    if not path.startswith("gs://"):
+        raise ValueError("Not a google bucket path: %s" % path)
+    (bucket_name, _, name) = path[len("gs://"):].partition("/")
+    return (bucket_name, name)
+
+def sample_paths(paths):
+    """RETURNS: the google bucket paths of a sample (from the automator
+    config), which are either a list or a dictionary {key: path}"""
+    return list(paths.values()) if isinstance(paths, dict) else list(paths)
+
+def list_objects(storage, bucket_name, prefix="", delimiter=None):
+    """Generator over the objects found under gs://{bucket_name}/{prefix}
+    NOTE: the listing is fetched one page (of up to 1000 objects) at a time,
+    so only a single page is ever held in memory"""
+    page_token = None
+    while True:
+        response = storage.objects().list(
+            bucket=bucket_name,
+            prefix=prefix,
+            delimiter=delimiter,
+            pageToken=page_token,
+            fields="items(%s),nextPageToken" % _object_fields).execute()
+        for item in response.get('items', []):
+            yield item
+
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            break
+
+def list_prefixes(storage, bucket_name, prefix=""):
+    """Returns the list of "sub-directory" prefixes directly under
+    gs://{bucket_name}/{prefix}, e.g. ['analysis/align/', 'analysis/peaks/']"""
+    prefixes = []
+    page_token = None
+    while True:
+        response = storage.objects().list(
+            bucket=bucket_name,
+            prefix=prefix,
+            delimiter="/",
+            pageToken=page_token,
+            fields="prefixes,nextPageToken").execute()
+        prefixes.extend(response.get('prefixes', []))
+
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            break
+    return prefixes
+
+def get_object(storage, path):
+    """Returns the object resource for the given google bucket path, or None
+    if the object does not exist"""
+    from googleapiclient.errors import HttpError
+    (bucket_name, name) = parse_path(path)
+    try:
+        return storage.objects().get(bucket=bucket_name, object=name,
+                                     fields=_object_fields).execute()
+    except HttpError as e:
+        if e.resp.status == 404:
+            return None
+        raise
+
+def download_string(storage, path):
+    """Returns the contents of the given google bucket path (as bytes), or
+    None if the object does not exist"""
+    from googleapiclient.errors import HttpError
+    (bucket_name, name) = parse_path(path)
+    try:
+        return storage.objects().get_media(bucket=bucket_name, object=name).execute()
+    except HttpError as e:
+        if e.resp.status == 404:
+            return None
+        raise
+
+def download_head(storage, path, nbytes):
+    """Returns (at most) the first nbytes of the given google bucket path,
+    i.e. a ranged download"""
+    (bucket_name, name) = parse_path(path)
+    request = storage.objects().get_media(bucket=bucket_name, object=name)
+    request.headers['Range'] = "bytes=0-%s" % (nbytes - 1)
+    return request.execute()
+
+def upload_string(storage, path, data, mimetype="text/plain"):
+    """Writes data (a string) to the given google bucket path
+    RETURNS: the new object resource"""
+    from googleapiclient.http import MediaIoBaseUpload
+    (bucket_name, name) = parse_path(path)
+    if not isinstance(data, bytes):
+        data = data.encode("utf-8")
+    media = MediaIoBaseUpload(io.BytesIO(data), mimetype=mimetype)
+    return storage.objects().insert(bucket=bucket_name, name=name,
+                                    media_body=media,
+                                    fields=_object_fields).execute()
+
+def rewrite_object(storage, src, dst, size=None):
+    """Copies the object at the src google bucket path to dst server-side,
+    i.e. the bytes never leave google.  Objects bigger than _rewrite_chunk
+    (or that change location/storage class) take several rewrite calls,
+    each picking up from the last one's rewriteToken
+    RETURNS: the new object resource"""
+    (src_bucket, src_name) = parse_path(src)
+    (dst_bucket, dst_name) = parse_path(dst)
+    token = None
+    calls = 0
+    with tracing.span("rewrite", "transfer", src=src) as s:
+        while True:
+            response = storage.objects().rewrite(
+                sourceBucket=src_bucket,
+                sourceObject=src_name,
+                destinationBucket=dst_bucket,
+                destinationObject=dst_name,
+                body={},
+                rewriteToken=token,
+                maxBytesRewrittenPerCall=_rewrite_chunk if size is None or int(size) > _rewrite_chunk else None,
+                fields="done,rewriteToken,totalBytesRewritten,resource(%s)" % _object_fields).execute()
+            calls += 1
+            if response.get('done'):
+                s.set(bytes=int(response['resource']['size']), calls=calls)
+                return response['resource']
+            token = response['rewriteToken']
+
+def copy_objects(storage, pairs, num_workers=8, objects=None):
+    """Copies each (src, dst) pair of google bucket paths server-side (see
+    rewrite_object) on a pool of at most num_workers threads, printing the
+    aggregate throughput at the end
+    objects ({path: object resource}, e.g. from check_paths) gives the
+    sizes, so that only the big objects are copied a chunk at a time
+    RETURNS: a tuple (copied, errors) where copied is a dictionary of
+    {src: new object resource} and errors is {src: exception}"""
+    objects = objects or {}
+    copied = {}
+    errors = {}
+    if not pairs:
+        return (copied, errors)
+
+    def _copy(pair):
+        (src, dst) = pair
+        return rewrite_object(gcp.for_thread(storage), src, dst,
+                              objects.get(src, {}).get('size'))
+
+    start = time.time()
+    for ((src, dst), res, err) in workers.imap_unordered(_copy, pairs, num_workers):
+        if err is not None:
+            print("Error copying %s to %s: %s" % (src, dst, err))
+            errors[src] = err
+        else:
+            copied[src] = res
+    secs = time.time() - start
+    total = sum(int(r['size']) for r in copied.values())
+    print("Copied %s/%s files, %.2f GB in %.1f secs (%.1f MB/s)" %
+          (len(copied), len(pairs), total / 1e9, secs,
+           total / 1e6 / secs if secs else 0))
+    return (copied, errors)
+
+def check_paths(storage, paths, num_workers=8, min_listing=2):
+    """Checks that each of the given google bucket paths exists.
+
+    The paths are grouped by their parent "directory"; any directory which
+    holds at least min_listing of the paths is resolved with a single
+    (paginated) listing of just the range of names requested, the leftover
+    paths are looked up one by one.  The
+    listings and lookups run on a pool of at most num_workers threads.
+
+    RETURNS: a tuple (objects, invalid) where objects is a dictionary of
+    {path: object resource} (with the object's size, crc32c and md5Hash)
+    for every valid path and invalid is a list of the paths that are
+    malformed, do not exist or could not be read
+    """
+    objects = {}
+    invalid = []
+
+    #GROUP the paths by bucket and parent directory
+    groups = {}
+    for p in paths:
+        try:
+            (bucket_name, name) = parse_path(p)
+        except ValueError:
+            invalid.append(p)
+            continue
+        groups.setdefault((bucket_name, posixpath.dirname(name)), []).append(p)
+
+    listings = [k for k in groups if len(groups[k]) >= min_listing]
+    leftovers = [p for k in groups if len(groups[k]) < min_listing
+                 for p in groups[k]]
+
+    def _list(key):
+        (bucket_name, dirname) = key
+        names = sorted(parse_path(p)[1] for p in groups[key])
+        #NOTE: only list the names that can match, i.e. the ones starting
+        #with the requested names' common prefix (e.g. dir/SAMPLE1_), and
+        #stop once past the last one--listings come back in name order--so a
+        #big shared directory doesn't cost a page per 1000 other files
+        prefix = posixpath.commonprefix(names)
+        found = {}
+        for obj in list_objects(gcp.for_thread(storage), bucket_name, prefix,
+                                delimiter="/"):
+            if obj['name'] > names[-1]:
+                break
+            found[obj['name']] = obj
+        return found
+
+    def _get(path):
+        return get_object(gcp.for_thread(storage), path)
+
+    tasks = [(_list, k) for k in listings] + [(_get, p) for p in leftovers]
+    for ((fn, item), res, err) in workers.imap_unordered(lambda t: t[0](t[1]), tasks, num_workers):
+        if err is not None:
+            #e.g. no access to the bucket--treat the paths as invalid
+            print(err)
+            invalid.extend(groups[item] if fn is _list else [item])
+        elif fn is _list:
+            for p in groups[item]:
+                name = parse_path(p)[1]
+                if name in res:
+                    objects[p] = res[name]
+                else:
+                    invalid.append(p)
+        elif res is not None:
+            objects[item] = res
+        else:
+            invalid.append(item)
+
+    return (objects, invalid)
+
+#how many "sub-directory" levels find_empty_objects goes down to split its
+#scan across the workers
+_max_scan_depth = 4
+
+def scan_shards(storage, bucket_name, prefix, num_workers=8):
+    """Splits a recursive listing of gs://{bucket_name}/{prefix} into shards
+    that can be listed independently: the prefixes are descended a level at
+    a time (e.g. analysis/ -> analysis/align/, analysis/peaks/ ..) until
+    there are at least num_workers shards, no deeper levels or
+    _max_scan_depth levels
+    RETURNS: a list of (prefix, recursive) tuples--recursive=False only
+    lists the objects directly under the prefix (the levels that were
+    descended), recursive=True lists everything under it"""
+    direct = [prefix]
+    tree = list_prefixes(storage, bucket_name, prefix)
+    depth = 1
+    while tree and len(direct) + len(tree) < num_workers and depth < _max_scan_depth:
+        fn = lambda p: list_prefixes(gcp.for_thread(storage), bucket_name, p)
+        subs = []
+        for (p, res, err) in workers.imap_unordered(fn, tree, num_workers):
+            if err is not None:
+                raise err
+            subs.extend(res)
+        direct.extend(tree)
+        tree = subs
+        depth += 1
+    return [(p, False) for p in direct] + [(p, True) for p in tree]
+
+def find_empty_objects(storage, path, num_workers=8):
+    """Generator over the gs:// paths of the zero-byte objects found (at any
+    depth) under the given google bucket path.
+    The listing is split into shards (see scan_shards)--so a results tree
+    that sits under one analysis/ prefix still fans out--across a pool of
+    at most num_workers threads, each of which streams its listing page by
+    page, so memory use does not grow with the size of the bucket.  Paths
+    are yielded as they are found (i.e. in no particular order)"""
+    (bucket_name, prefix) = parse_path(path)
+    if prefix and not prefix.endswith("/"):
+        prefix += "/"
+
+    shards = scan_shards(storage, bucket_name, prefix, num_workers)
+
+    def _scan(shard):
+        (shard_prefix, recursive) = shard
+        objects = list_objects(gcp.for_thread(storage), bucket_name, shard_prefix,
+                               delimiter=None if recursive else "/")
+        for obj in objects:
+            #NOTE: skip the 0-byte "dir/" placeholder objects
+            if int(obj['size']) == 0 and not obj['name'].endswith("/"):
+                yield "gs://%s/%s" % (bucket_name, obj['name'])
+
+    for p in workers.imap_generators(_scan, shards, num_workers):
+        yield p
@@ -0,0 +1,74 @@
+"""Len Taing 2019 (TGBTG)
+CHIPS automator - small on-disk cache for rarely-changing api look-ups
+(kept as json files under ~/.chips_automator/cache, or the dir given by the
+CHIPS_AUTOMATOR_CACHE env variable)
+"""
+
+import os
+import json
+import time
+import threading
+
+_cache_dir = os.environ.get("CHIPS_AUTOMATOR_CACHE",
+                            os.path.join(os.path.expanduser("~"), ".chips_automator", "cache"))
+#serialises the read-modify-write of the cache files between threads
+_lock = threading.Lock()
+
+def _path(name):
+    return os.path.join(_cache_dir, "%s.json" % name)
+
+def _read(name):
+    try:
+        f = open(_path(name))
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+    except (IOError, OSError, ValueError):
+        #missing or corrupt--start over
+        return {}
+
+def _write(name, entries):
+    if not os.path.isdir(_cache_dir):
+        os.makedirs(_cache_dir)
+    #write then rename so that readers never see a half-written file
+    tmp = "%s.%s.tmp" % (_path(name), os.getpid())
+    f = open(tmp, "w")
+    json.dump(entries, f, indent=1, sort_keys=True)
+    f.close()
+    os.rename(tmp, _path(name))
+
+def lookup(name, key, ttl):
+    """Returns the value stored under key in the named cache, or None if
+    there is none or it is older than ttl secs"""
+    with _lock:
+        entry = _read(name).get(key)
+    if entry and time.time() - entry['time'] < ttl:
+        return entry['value']
+    return None
+
+def store(name, key, value):
+    """Stores value (anything json serialisable) under key in the named
+    cache"""
+    with _lock:
+        entries = _read(name)
+        entries[key] = {'time': time.time(), 'value': value}
+        _write(name, entries)
+
+def invalidate(name=None, key=None):
+    """Drops key from the named cache, or the whole named cache if no key is
+    given, or EVERY cache if no name is given"""
+    with _lock:
+        if name is None:
+            names = [f[:-len(".json")] for f in os.listdir(_cache_dir)
+                     if f.endswith(".json")] if os.path.isdir(_cache_dir) else []
+        else:
+            names = [name]
+        for n in names:
+            if key is None:
+                if os.path.exists(_path(n)):
+                    os.remove(_path(n))
+            else:
+                entries = _read(n)
+                if entries.pop(key, None) is not None:
+                    _write(n, entries)
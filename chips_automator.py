@@ -4,112 +4,216 @@ CHIPS automator script to automatically run chips on GCP
 """
 
 import os
+import re
 import sys
+import json
+import socket
 import time
-import string
-import random
-import subprocess
+import difflib
+import threading
+import collections
 from optparse import OptionParser
-
-import googleapiclient.discovery
-
-import paramiko
-from paramiko import client
+try:
+    from shlex import quote
+except ImportError: #python2
+    from pipes import quote
+try:
+    import queue
+except ImportError: #python2
+    import Queue as queue
 
 import ruamel.yaml
 
 import instance
 import disk
+import bucket
+import gcp
+import cache
+import manifest
+import workers
+import tracing
+import autosize
 from instance import wait_for_operation
+from ssh import wait_for_ssh
 
-class ssh:
-    client = None
-
-    def __init__(self, address, username, key_filename):
-        # Let the user know we're connecting to the server
-        print("Connecting to server.")
-        # Create a new SSH client
-        self.client = client.SSHClient()
-        # The following line is required if you want the script to be able to access a server that's not yet in the known_hosts file
-        self.client.set_missing_host_key_policy(client.AutoAddPolicy())
-        # Make the connection
-        self.client.connect(address, username=username, key_filename=key_filename, look_for_keys=False)
-
-    def sendCommand(self, command, timeout=None):
-        # Check if connection is made previously
-        #ref: https://www.programcreek.com/python/example/7495/paramiko.SSHException
-        #example 3
-        if(self.client):
-            status = 0
-            try:
-                t = self.client.exec_command(command, timeout)
-            except paramiko.SSHException:
-                status=1
-
-            #NOTE: reverting to python2 method of utf-8 conversion
-            std_out = unicode(t[1].read(), "utf-8") #str(t[1].read(), "utf-8")
-            std_err = unicode(t[2].read(), "utf-8") #str(t[2].read(), "utf-8")
-            t[0].close()
-            t[1].close()
-            t[2].close()
-            return (status, std_out, std_err)
-
-def checkConfig_bucketPath(a_dict, invalid_bucket_paths):
+def checkConfig_bucketPath(a_dict, invalid_bucket_paths, storage=None):
     """Given a dictionary of {key: [list of google bucket paths], ...}
     OR a dictionary of dictionaries (of google paths {key: {foo: path, ..}..}
     Will check each of the bucket paths associated with the key and
     if any are invalid, will add them to the invalid_bucket_path list
-    NOTE: this was an inner loop in checkConfig which we're trying to reuse"""
-
+    RETURNS: a dictionary of {bucket path: object resource} for the valid
+    paths (with the object's size, crc32c and md5Hash)
+    NOTE: the paths are checked in batches (one bucket listing per
+    directory) rather than one gsutil call per file, see bucket.check_paths"""
+    paths = []
     for sample in a_dict:
-        for f in a_dict[sample]:
-            if isinstance(a_dict[sample], list):
-                ffile = f
-            else: #dictionary
-                ffile = a_dict[sample][f]
-
-            cmd = [ "gsutil", "ls", ffile]
-            print(" ".join(cmd))
-            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE)
-            (out, error) = proc.communicate()
-            if proc.returncode != 0:
-                #print("Error %s:" % proc.returncode)
-                #print(out)
-                print(error)
-                invalid_bucket_paths.append(f)
-
-def checkConfig(chips_auto_config):
+        if isinstance(a_dict[sample], list):
+            paths.extend(a_dict[sample])
+        else: #dictionary
+            paths.extend(a_dict[sample].values())
+
+    if not storage:
+        storage = gcp.build('storage', 'v1')
+    (objects, invalid) = bucket.check_paths(storage, paths)
+    print("Checked %s bucket paths, %s invalid" % (len(paths), len(invalid)))
+    invalid_bucket_paths.extend(invalid)
+    return objects
+
+#the chips config template that the run's config.yaml is rendered from
+_chips_template = 'chips.config.yaml'
+#the sample columns of a metasheet run
+_run_keys = ['treat1', 'cont1', 'treat2', 'cont2']
+#instance names are prepended with this, see launch
+_instance_prefix = 'chips-auto-'
+#gce resource names: lowercase letters, digits and dashes, at most 63 chars
+_gce_name = re.compile(r'^[a-z]([-a-z0-9]*[a-z0-9])?$')
+
+def _isInt(value, minimum=0):
+    try:
+        return int(value) >= minimum and float(value) == int(value)
+    except (TypeError, ValueError):
+        return False
+
+def validateConfig(config, template=_chips_template):
+    """Checks the automator config (parsed) and the chips config template
+    WITHOUT touching GCP, in fail-fast order: the required fields, then the
+    values of each field, then that the metasheet runs only name samples
+    that are defined, then the template--at the first step that fails, its
+    errors are returned
+    RETURNS: a list of error messages (empty if the config is ok)"""
+    #1. REQUIRED fields
+    required_fields = ["instance_name", "cores", "disk_size",
+                       "google_bucket_path", "samples", "metasheet"]
+    if config.get('autosize'):
+        #NOTE: picked from the inputs unless given, see autosize.apply
+        required_fields = [f for f in required_fields if f not in ["cores", "disk_size"]]
+    #optional_fields = ['chips_commit'] #not used below!!
+    missing = [f for f in required_fields if not config.get(f)]
+    if missing:
+        return ["Please define these required params in the automator config file: %s" % ", ".join(missing)]
+
+    #2. FIELD values
+    errors = []
+    name = str(config['instance_name'])
+    #NOTE: sharded runs' instances get a -s{shard} suffix, see runInstanceNames
+    longest = "%s%s%s-ref-disk" % (_instance_prefix, name, "-s%s" % config['shards'] if _isInt(config.get('shards'), 2) else "")
+    if not _gce_name.match(name) or len(longest) > 63:
+        errors.append("instance_name '%s' must be lowercase letters, digits and dashes (at most %s chars)" % (name, 63 - len(longest) + len(name)))
+    if config.get('machine_type'):
+        if not re.match(r'^[a-z0-9]+-[a-z0-9]+-\d+$', str(config['machine_type'])):
+            errors.append("machine_type '%s' is not a machine type, e.g. n2-standard-32" % config['machine_type'])
+    elif config.get('cores') and str(config['cores']) not in _machine_types:
+        errors.append("cores must be one of %s, not %s" % (", ".join(sorted(_machine_types, key=int)), config['cores']))
+    for f in ['disk_size', 'disk_iops', 'disk_throughput']:
+        if config.get(f) is not None and not _isInt(config[f], 1):
+            errors.append("%s must be a positive number, not %s" % (f, config[f]))
+    for f in ['local_ssds', 'ref_pool_size', 'instance_pool_size']:
+        if config.get(f) is not None and not _isInt(config[f]):
+            errors.append("%s must be a number, not %s" % (f, config[f]))
+    if config.get('disk_type') and config['disk_type'] not in disk.disk_types + ['local-ssd']:
+        errors.append("disk_type must be one of %s, not %s" % (", ".join(disk.disk_types + ['local-ssd']), config['disk_type']))
+    for f in ['iops', 'throughput']:
+        #NOTE: the other disk types would silently ignore them
+        disk_type = config.get('disk_type') or 'pd-standard'
+        if config.get('disk_%s' % f) is not None and f not in disk.provisioned.get(disk_type, []):
+            errors.append("disk_%s only applies to the %s disk types, not %s" % (f, ", ".join(t for t in disk.disk_types if f in disk.provisioned.get(t, [])), disk_type))
+    if config.get('spot') and config.get('disk_type') == 'local-ssd':
+        errors.append("spot runs need a persistent data disk to resume from, not local ssds")
+    if config.get('spot') and config.get('pipelined'):
+        errors.append("spot and pipelined can't be used together")
+    if config.get('shards') is not None and not _isInt(config['shards'], 1):
+        errors.append("shards must be a positive number, not %s" % config['shards'])
+    elif int(config.get('shards') or 1) > 1 and config.get('pipelined'):
+        errors.append("shards and pipelined can't be used together")
+    elif int(config.get('shards') or 1) > 1 or config.get('pipelined'):
+        #NOTE: left out of the shards' runs and the pipelined waves
+        rules = config.get('cohort_rules')
+        if not rules or not isinstance(rules, list) or [r for r in rules if not re.match(r'^\w+$', str(r))]:
+            errors.append("cohort_rules must list chips' cohort-level rules (names) to run shards or pipelined")
+    if config.get('spot_max_recoveries') is not None and not _isInt(config['spot_max_recoveries']):
+        errors.append("spot_max_recoveries must be a number, not %s" % config['spot_max_recoveries'])
+    if config.get('ref_disk_mode', 'snapshot') not in disk.ref_modes:
+        errors.append("ref_disk_mode must be one of %s, not %s" % (", ".join(disk.ref_modes), config['ref_disk_mode']))
+    if not str(config['google_bucket_path']).startswith("gs://") or len(config['google_bucket_path']) <= len("gs://"):
+        errors.append("google_bucket_path must be a gs:// path, not %s" % config['google_bucket_path'])
+
+    samples = config['samples']
+    if not isinstance(samples, dict):
+        errors.append("samples must be a dictionary of {sample: [google bucket paths]}")
+    else:
+        for sample in samples:
+            paths = samples[sample]
+            paths = list(paths.values()) if isinstance(paths, dict) else paths
+            if not paths or not isinstance(paths, list):
+                errors.append("sample %s has no files" % sample)
+                continue
+            for p in paths:
+                if not str(p).startswith("gs://"):
+                    errors.append("sample %s: %s is not a gs:// path" % (sample, p))
+    metasheet = config['metasheet']
+    if not isinstance(metasheet, dict) or [r for r in metasheet if not isinstance(metasheet[r], dict)]:
+        errors.append("metasheet must be a dictionary of {run: {treat1: sample, cont1: sample, ..}}")
+    if errors:
+        return errors
+
+    #3. the METASHEET against the samples
+    for run in metasheet:
+        for k in metasheet[run]:
+            if k not in _run_keys:
+                close = difflib.get_close_matches(str(k), _run_keys, 1)
+                errors.append("metasheet run %s: unknown column '%s'%s (expected %s)" %
+                              (run, k, " (did you mean '%s'?)" % close[0] if close else "",
+                               ", ".join(_run_keys)))
+        if not metasheet[run].get('treat1'):
+            errors.append("metasheet run %s: treat1 is required" % run)
+        for k in _run_keys:
+            sample = metasheet[run].get(k)
+            if sample and sample not in samples:
+                close = difflib.get_close_matches(str(sample), [str(s) for s in samples], 1)
+                errors.append("metasheet run %s: %s '%s' is not one of the samples%s" %
+                              (run, k, sample, " (did you mean '%s'?)" % close[0] if close else ""))
+    if errors:
+        return errors
+
+    #4. the chips config TEMPLATE
+    if template:
+        try:
+            f = open(template)
+            chips_config = ruamel.yaml.round_trip_load(f.read())
+            f.close()
+        except (IOError, ruamel.yaml.YAMLError) as e:
+            return ["can't read the chips config template %s: %s" % (template, e)]
+        if not isinstance(chips_config, dict):
+            return ["the chips config template %s is not a dictionary" % template]
+        for f in ['ref', 'assembly']:
+            if not chips_config.get(f):
+                errors.append("the chips config template %s has no %s" % (template, f))
+        if chips_config.get('metasheet') != 'metasheet.csv':
+            errors.append("the chips config template %s must use metasheet: 'metasheet.csv' (which the automator uploads)" % template)
+    return errors
+
+@tracing.traced(cat="phase")
+def checkConfig(chips_auto_config, storage=None, template=_chips_template):
     """Does some basic checks on the config file
     INPUT config file parsed as a dictionary
-    returns True if everything is ok
+    returns a dictionary of {sample file path: object resource} (i.e.
+    with the file's size and checksums) if everything is ok
     otherwise exits!
+    NOTE: the offline checks (see validateConfig) go first, so a bad config
+    fails in milliseconds rather than after the bucket look-ups
     """
-    required_fields = ["instance_name", "cores", "disk_size",
-                       "google_bucket_path", "samples", "metasheet"]
-    #optional_fields = ['chips_commit'] #not used below!!
-
-    missing = []
-    for f in required_fields:
-        if not f in chips_auto_config or not chips_auto_config[f]:
-            missing.append(f)
+    errors = validateConfig(chips_auto_config, template)
+    if errors:
+        print("ERROR: Please correct the automator config file:")
+        for e in errors:
+            print("  %s" % e)
+        sys.exit()
 
     #check if the sample fastq/bam files are valid
     invalid_bucket_paths = []
     print("Checking the sample file paths...")
     samples = chips_auto_config['samples']
-    for sample in samples:
-        for f in samples[sample]:
-            cmd = [ "gsutil", "ls", f]
-            print(" ".join(cmd))
-            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE)
-            (out, error) = proc.communicate()
-            if proc.returncode != 0:
-                #print("Error %s:" % proc.returncode)
-                #print(out)
-                print(error)
-                invalid_bucket_paths.append(f)
+    source_objects = checkConfig_bucketPath(samples, invalid_bucket_paths, storage)
 
     if invalid_bucket_paths:
         print("Some sample file bucket files are invalid or do not exist, please correct this.")
@@ -117,97 +221,253 @@ def checkConfig(chips_auto_config):
             print(f)
         sys.exit()
 
-    #NOTE: can add additional checks like google_bucket_path is in0 the form
-    #of 'gs://...' etc.  but this is a start
-
-    if missing:
-        print("ERROR: Please define these required params in the automator config file:\n%s" % ", ".join(missing))
-        sys.exit()
-    else:
-        return True
-
-def createInstanceDisk(compute, instance_config, chips_ref_snapshot, disk_config, ssh_config, project, zone, disk_auto_del=True):
-    #create a new instance
-    print("Creating instance...")
-    response = instance.create(compute, instance_config['name'],
-                               instance_config['image_name'],
-                               instance_config['image_family'],
-                               instance_config['machine_type'],
-                               project,
-                               instance_config['serviceAcct'],
-                               zone)
-    instanceLink = response['targetLink']
-    instanceId = response['targetId']
-    print(instanceLink, instanceId)
-    #try to get the instance ip address
-    ip_addr = instance.get_instance_ip(compute, instanceId, project, zone)
-
-    #create a new disk
-    print("Creating disk...")
-    print(disk_config)
-    response = disk.create(compute, disk_config['name'], disk_config['size'], project, zone)
-    #print(response)
-
-    #attach disk to instance
-    print("Attaching disk...")
-    response = disk.attach_disk(compute, instance_config['name'], disk_config['name'], project, zone)
-    #print(response)
-
-    #CREATE REF DISK from snapshot given
-    print("Creating reference disk...")
+    return source_objects
+
+def printPhaseTimings(timings):
+    """Prints the {phase: (start, end)} timings returned by
+    workers.run_graph as a table, in the order the phases started"""
+    print("%-14s %8s %8s %8s" % ("phase", "start", "end", "secs"))
+    for (phase, (start, end)) in sorted(timings.items(), key=lambda t: t[1]):
+        print("%-14s %8.1f %8.1f %8.1f" % (phase, start, end, end - start))
+
+@tracing.traced(cat="phase")
+def createInstanceDisk(compute, instance_config, chips_ref_snapshot, disk_config, ssh_config, project, zone, disk_auto_del=True, ref_mode='snapshot', ref_pool_size=2, instance_pool_size=0, spot=False):
+    """Creates the instance along with its data disk and the reference disk
+    (restored from chips_ref_snapshot), then connects to it.
+    ref_mode (see disk.ref_modes) 'shared' attaches the snapshot's shared
+    read-only ref disk instead and 'pool' claims a pre-hydrated ref disk
+    from the snapshot's pool (topping the pool up to ref_pool_size); those
+    ref disks outlive the instance.
+    With instance_pool_size, a stopped instance is claimed from the image's
+    warm pool (see instance.claim_pooled_instance) and started with the
+    run's disks attached, rather than creating one; the pool is then
+    topped back up to instance_pool_size.  If the pool is empty the
+    instance is created as usual.
+    spot=True creates a spot instance (see recoverInstance for what happens
+    when it's preempted); pool instances aren't spot so the pool is skipped.
+
+    The steps are run as a dependency graph (see workers.run_graph) so that
+    independent steps overlap: the image and snapshot look-ups go in one
+    batched api call, and both disks are declared in the instance insert body so
+    they are created alongside the instance without separate disk insert or
+    attach calls.  Whether the disks go with the instance (disk_auto_del) is
+    declared in those same insert (or attach) bodies.
+    RETURNS: (instanceId, ip_addr, ssh connection)
+    """
+    if ref_mode not in disk.ref_modes:
+        raise ValueError("ref_disk_mode must be one of %s, not %s" % (", ".join(disk.ref_modes), ref_mode))
     ref_disk_name = "-".join([instance_config['name'], 'ref-disk'])
-    response = disk.createFromSnapshot(compute, ref_disk_name, chips_ref_snapshot, project, zone)
-    #print(response)
-
-    #attach disk to instance
-    print("Attaching reference disk...")
-    response = disk.attach_disk(compute, instance_config['name'], ref_disk_name, project, zone)
+    local_ssds = disk_config.get('local_ssds') if disk_config.get('type') == 'local-ssd' else 0
+    #NOTE: local ssds can only be added when an instance is created
+    use_pool = instance_pool_size > 0 and not local_ssds and not spot
+    if instance_pool_size and local_ssds:
+        print("Local ssds can't be added to a pool instance, creating the instance instead")
+    if instance_pool_size and spot:
+        print("Pool instances aren't spot instances, creating the instance instead")
+    #NOTE: shared/pool ref disks must never go with the instance, and are
+    #attached read-only so that no run can change them for the next one
+    ref_auto_delete = disk_auto_del and ref_mode == 'snapshot'
+    #api responses reused within this provisioning run, see instance.get_instance
+    session = {}
+
+    def _lookup(res):
+        #NOTE: the image and snapshot look-ups go in one batched round trip
+        print("Looking up image and reference snapshot...")
+        (image, snapshot) = disk.get_image_and_snapshot(gcp.for_thread(compute),
+                                                        instance_config['image_name'],
+                                                        instance_config['image_family'],
+                                                        chips_ref_snapshot,
+                                                        project)
+        return (image['selfLink'], snapshot['selfLink'])
+
+    def _data_disk(res):
+        #CREATE the data disk up front so it's ready to attach to a pool
+        #instance
+        print("Creating disk...")
+        disk.create(gcp.for_thread(compute), disk_config['name'],
+                    disk_config['size'], project, zone,
+                    disk_type=disk_config.get('type'),
+                    iops=disk_config.get('iops'),
+                    throughput=disk_config.get('throughput'))
+        return disk_config['name']
+
+    def _ref(res):
+        #GET a warm reference disk
+        snapshotLink = res['lookup'][1]
+        if ref_mode == 'snapshot':
+            #NOTE: only for pool instances, see _data_disk
+            print("Creating reference disk...")
+            disk.createFromSnapshot(gcp.for_thread(compute), ref_disk_name,
+                                    chips_ref_snapshot, project, zone)
+            return ref_disk_name
+        if ref_mode == 'shared':
+            return disk.get_shared_ref_disk(gcp.for_thread(compute), chips_ref_snapshot,
+                                            snapshotLink, project, zone)
+        return disk.claim_pool_ref_disk(gcp.for_thread(compute), chips_ref_snapshot,
+                                        snapshotLink, ref_pool_size, project, zone)
+
+    def _instance(res):
+        #create a new instance with its disks
+        #NOTE: the data disk is always persistent-disk-1 and the ref disk is
+        #persistent-disk-2--unless the working volume is on local ssds, in
+        #which case there's no data disk.  The sdX names follow the attach
+        #order, so the setup script is given the by-id paths (see
+        #setupCommand)
+        print("Creating instance, disk and reference disk...")
+        print(disk_config)
+        if use_pool:
+            disks = [disk.existing_disk_config(res['data_disk'], "persistent-disk-1",
+                                               project, zone,
+                                               auto_delete=disk_auto_del),
+                     disk.existing_disk_config(res['ref'], "persistent-disk-2",
+                                               project, zone,
+                                               read_only=(ref_mode != 'snapshot'),
+                                               auto_delete=ref_auto_delete)]
+            instance_id = instance.claim_pooled_instance(gcp.for_thread(compute),
+                                                         res['lookup'][0],
+                                                         instance_config['name'],
+                                                         instance_config['machine_type'],
+                                                         project, zone)
+            if instance_id:
+                instance.attach_disks(gcp.for_thread(compute), instance_config['name'],
+                                      disks, project, zone)
+                print("Starting instance...")
+                instance.start(gcp.for_thread(compute), instance_config['name'],
+                               project, zone)
+                return instance_id
+            print("No stopped instance in the pool, creating the instance...")
+        elif local_ssds:
+            disks = disk.local_ssd_configs(local_ssds, zone)
+        else:
+            disks = [disk.attached_disk_config(disk_config['name'],
+                                               "persistent-disk-1",
+                                               size=disk_config['size'],
+                                               disk_type=disk_config.get('type'),
+                                               iops=disk_config.get('iops'),
+                                               throughput=disk_config.get('throughput'),
+                                               zone=zone,
+                                               auto_delete=disk_auto_del)]
+        if use_pool:
+            #NOTE: the pool was empty, the disks already exist
+            pass
+        elif ref_mode == 'snapshot':
+            disks.append(disk.attached_disk_config(ref_disk_name,
+                                                   "persistent-disk-2",
+                                                   snapshotLink=res['lookup'][1],
+                                                   auto_delete=ref_auto_delete))
+        else:
+            disks.append(disk.existing_disk_config(res['ref'], "persistent-disk-2",
+                                                   project, zone,
+                                                   read_only=(ref_mode != 'snapshot')))
+        response = instance.create(gcp.for_thread(compute),
+                                   instance_config['name'],
+                                   instance_config['image_name'],
+                                   instance_config['image_family'],
+                                   instance_config['machine_type'],
+                                   project,
+                                   instance_config['serviceAcct'],
+                                   zone,
+                                   disks=disks,
+                                   source_image=res['lookup'][0],
+                                   spot=spot)
+        print(response['targetLink'], response['targetId'])
+        return response['targetId']
+
+    def _refill(res):
+        #TOP UP the pool for the next launch
+        names = instance.fill_instance_pool(gcp.for_thread(compute),
+                                            res['lookup'][0],
+                                            instance_pool_size,
+                                            instance_config['machine_type'],
+                                            project,
+                                            instance_config['serviceAcct'],
+                                            zone)
+        if names:
+            print("Adding %s instances to the pool: %s" % (len(names), ", ".join(names)))
+
+    def _ip(res):
+        #try to get the instance ip address
+        return instance.get_instance_ip(gcp.for_thread(compute),
+                                        res['instance'], project, zone,
+                                        session)
+
+    def _ssh(res):
+        #try to establish ssh connection as soon as the guest is up
+        print("Establishing connection...")
+        return wait_for_ssh(res['ip'], ssh_config['user'], ssh_config['key'],
+                            port=ssh_config.get('port', 22))
+
+    def _scratch(res):
+        #STRIPE the local ssds into the working volume
+        print("Setting up the local ssds...")
+        (status, out, err) = res['ssh'].sendCommand(scratchMountCommand())
+        if status:
+            raise Exception("Error %s: setting up the local ssds: %s" % (status, err))
+
+    tasks = {'lookup': ([], _lookup),
+             'instance': (['lookup'], _instance),
+             'ip': (['instance'], _ip),
+             'ssh': (['ip'], _ssh)}
+    if ref_mode != 'snapshot' or use_pool:
+        tasks['ref'] = (['lookup'], _ref)
+        tasks['instance'][0].append('ref')
+    if use_pool:
+        tasks['data_disk'] = ([], _data_disk)
+        tasks['instance'][0].append('data_disk')
+        tasks['refill'] = (['instance'], _refill)
+    if local_ssds:
+        tasks['scratch'] = (['ssh'], _scratch)
+    requests = gcp.request_count()
+    (results, timings) = workers.run_graph(tasks)
+    printPhaseTimings(timings)
+    print("Compute API requests: %s" % (gcp.request_count() - requests))
+
+    return (results['instance'], results['ip'], results['ssh'])
+
+#Stripes the local NVMe ssds (RAID 0 if there are several) into one ext4
+#volume mounted at $1 (a no-op if something is mounted there already)
+_scratch_sh = """mountpoint -q "$1" && exit 0
+set -e
+devs=$(ls /dev/disk/by-id/google-local-nvme-ssd-*)
+n=$(echo $devs | wc -w)
+if [ "$n" -gt 1 ]; then
+  sudo mdadm --create /dev/md0 --level=0 --raid-devices=$n $devs --run
+  dev=/dev/md0
+else
+  dev=$devs
+fi
+sudo mkfs.ext4 -F -q -m 0 $dev
+sudo mkdir -p "$1"
+sudo mount -o discard,defaults $dev "$1"
+sudo chmod a+w "$1"
+"""
 
-    #try to establish ssh connection:
-    # wait 30 secs
-    print("Establishing connection...")
-    time.sleep(60)
-    connection = ssh(ip_addr, ssh_config['user'], ssh_config['key'])
-    #TEST connection
-    #(status, stdin, stderr) = connection.sendCommand("ls /mnt")
-
-    #SET the auto-delete flag for the newly created disks
-    print("Setting disk auto-delete flag for disk %s" % disk_config['name'])
-    #NOTE: using the instance.set_disk_auto_delete fn doesn't work
-    #TRY manual call
-    #NOTE: the attached disk is always going to be persistent-disk-1
-    cmd = [ "gcloud", "compute", "instances", "set-disk-auto-delete", instance_config['name'], "--device-name", "persistent-disk-1", "--zone", zone]
-    print(" ".join(cmd))
-    proc = subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-    (out, error) = proc.communicate()
-    if proc.returncode != 0:
-        print("Error %s:" % proc.returncode)
-        #print(out)
-        print(error)
-
-    #NOTE: ref disk is sdc which is peristent-disk-2
-    cmd = [ "gcloud", "compute", "instances", "set-disk-auto-delete", instance_config['name'], "--device-name", "persistent-disk-2", "--zone", zone]
-    print(" ".join(cmd))
-    proc = subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-    (out, error) = proc.communicate()
-    if proc.returncode != 0:
-        print("Error %s:" % proc.returncode)
-        #print(out)
-        print(error)
-
-    return (instanceId, ip_addr, connection)
+def scratchMountCommand(mount_point="/mnt/ssd"):
+    """Returns the command that sets up the local ssds as the working
+    volume, see _scratch_sh"""
+    return "sh -c %s sh %s" % (quote(_scratch_sh), quote(mount_point))
 
 #NOTE: lots of redundancy betwwen this and the local version, but for now
 #saving a complete working copy
-def transferRawFiles_remote(samples, bucket_path):
+@tracing.traced(cat="phase")
+def transferRawFiles_remote(samples, bucket_path, storage=None, manifest_entries=None, num_workers=8):
     """Transfers the samples from their source location to the chips project
     location (a google bucket)
+    The files are copied server-side, bucket to bucket (see
+    bucket.copy_objects), with up to num_workers copies at a time.
+    Files whose destination already matches the source (same non-zero size
+    and crc32c) are skipped, so a rerun only copies what is missing, changed
+    or empty.  If given, manifest_entries (see manifest.load) is updated
+    with every file that is in place
     RETIRNS: a dictionary of samples with their new data paths (which are
     relative to the chips project location i.e. google bucket path
+    NOTE: samples with a file that failed to copy are left out (and printed)
     """
     # PUT the files in {bucket_path}/data
     # and build up new sample dictionary (tmp)
     tmp = {}
+    pairs = []
+    src_samples = {}
     for sample in samples:
         for fq in samples[sample]:
             #add this to the samples dictionary
@@ -221,32 +481,44 @@ def transferRawFiles_remote(samples, bucket_path):
                 dst = "%sdata/" % bucket_path
             else:
                 dst = "%s/data/" % bucket_path
-
-            cmd = [ "gsutil", "-m", "cp", fq, dst]
-            print(" ".join(cmd))
-            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE)
-            (out, error) = proc.communicate()
-            if proc.returncode != 0:
-                print("Error %s:" % proc.returncode)
-                #print(out)
-                print(error)
+            pairs.append((fq, dst + filename))
+            src_samples[fq] = sample
+
+    #LOOK UP the sources and any existing destinations in one batch
+    if not storage:
+        storage = gcp.build('storage', 'v1')
+    (objects, invalid) = bucket.check_paths(storage, [x for pair in pairs for x in pair], num_workers)
+
+    todo = []
+    for (fq, dst) in pairs:
+        if manifest.matches(objects.get(fq), objects.get(dst)):
+            print("Skipping %s, already transferred" % fq)
+            if manifest_entries is not None:
+                manifest_entries[dst] = manifest.make_entry(objects[fq])
+        else:
+            todo.append((fq, dst))
+
+    print("Copying %s files..." % len(todo))
+    (copied, errors) = bucket.copy_objects(storage, todo, num_workers, objects)
+    if manifest_entries is not None:
+        for (fq, dst) in todo:
+            if fq in copied and fq in objects:
+                manifest_entries[dst] = manifest.make_entry(objects[fq])
+    for sample in sorted(set(src_samples[fq] for fq in errors)):
+        print("ERROR: %s has files that failed to copy, leaving it out" % sample)
+        tmp.pop(sample, None)
     return tmp
 
-def transferRawFiles_local(samples, ssh_conn, sub_dir, chips_dir='/mnt/ssd/chips'):
-    """Goes through each FILE associated with each sample and issues
-    a cmd from the instance to download the file to /mnt/ssd/chips/data
-
-    RETURNS: a dictionary of samples with their new data paths
-
-    NOTE: This function handles two types of data structures
-    1. dictionary of lists: e.g. 'samples'-
-       {sample: [google bucket file paths, ...], ...}
-    2. dictionary of dictionaries which define google bucket paths, eg. 'rna'-
-       {sample: {bam_file: <google bucket path>, expression_file: <path>}...}
+def buildTransferManifest(samples, sub_dir, chips_dir='/mnt/ssd/chips'):
+    """Given the samples dictionary (see transferRawFiles_local for the two
+    types of data structures handled), works out where each file goes on
+    the instance
+    RETURNS: a tuple (tmp, manifest) where tmp is the dictionary of samples
+    with their new data paths (relative to chips_dir) and manifest is a
+    list of (google bucket path, destination dir) in sample order
     """
-
     tmp = {}
+    manifest = []
     for sample in samples:
         for fq in samples[sample]:
             #Check if this is dictionary of lists or dict of dicts
@@ -269,211 +541,1194 @@ def transferRawFiles_local(samples, ssh_conn, sub_dir, chips_dir='/mnt/ssd/chips
                 #MAKE sure that the data structure remains a dictionary
                 tmp[sample][fq] = os.path.join(sub_dir, sample, filename)
 
-
             #HARDCODED location of where the data files are expected--
             #no trailing /
             #dst = "/mnt/ssd/chips/data"
             dst = os.path.join(chips_dir, sub_dir, sample)
+            manifest.append((ffile, dst))
+    return (tmp, manifest)
+
+#Copies ONE manifest entry on the instance ($0 = source, $1 = destination
+#dir, $2 = expected size, $3 = expected crc32c, $4 = 1 if the transfer
+#manifest says it's already done, $5 = number of files in the sample) and
+#reports it as a tab-separated line:
+#OK|SKIP|FAIL, bytes, start secs, end secs, source, destination[, error]
+#NOTE: a file that is already in place (same size, and same crc32c unless
+#the manifest vouches for it) is skipped
+#Each file that is in place leaves a .{file}.done marker; whichever file
+#completes the sample also touches {dir}/.ready and reports "READY dir"
+_bulk_copy_sh = """s=$(date +%s.%N); f="$1/${0##*/}"; rm -f "$1/.${0##*/}.done"
+if [ -n "$2" ] && [ -s "$f" ] && [ "$(stat -c %s "$f")" = "$2" ] && { [ "$4" = 1 ] || [ "$(gsutil hash -c "$f" 2>/dev/null | awk '/crc32c/{print $NF}')" = "$3" ]; }; then
+  printf 'SKIP\\t%s\\t%s\\t%s\\t%s\\t%s\\n' "$2" "$s" "$(date +%s.%N)" "$0" "$f"
+elif err=$(gsutil -q cp "$0" "$1/" 2>&1); then
+  printf 'OK\\t%s\\t%s\\t%s\\t%s\\t%s\\n' "$(stat -c %s "$f")" "$s" "$(date +%s.%N)" "$0" "$f"
+else
+  printf 'FAIL\\t0\\t%s\\t%s\\t%s\\t%s\\t%s\\n' "$s" "$(date +%s.%N)" "$0" "$f" "$(echo $err | tail -c 300)"
+  exit 0
+fi
+touch "$1/.${0##*/}.done"
+if [ "$(ls "$1"/.*.done | wc -l)" -ge "$5" ]; then
+  touch "$1/.ready"; printf 'READY\\t%s\\n' "$1"
+fi"""
+
+def bulkCopyCommand(manifest, num_workers=8, source_objects=None, done=None):
+    """Given a transfer manifest (see buildTransferManifest), returns a single
+    shell command that copies all of the files with up to num_workers
+    copies running in parallel.  Prints one result line per file (see
+    _bulk_copy_sh) followed by a "TOTAL start end" line
+    source_objects ({path: object resource}) lets files that are already in
+    place be skipped; done is the set of source paths which the transfer
+    manifest says are already copied, these are trusted without re-hashing
+    A "READY dir" line is printed as each destination dir (i.e. sample)
+    gets all of its files, see _bulk_copy_sh
+    RETURNS: (command, stdin) where stdin is the file list that must be
+    sent to the command's standard input
+    NOTE: the file list doesn't go on the command line b/c for large
+    cohorts it's longer than the max length of a single argument (128KB),
+    i.e. the remote shell couldn't even be started
+    """
+    source_objects = source_objects or {}
+    done = done or set()
+    sample_files = {}
+    for (src, dst) in manifest:
+        sample_files[dst] = sample_files.get(dst, 0) + 1
+    entries = []
+    for (src, dst) in manifest:
+        obj = source_objects.get(src, {})
+        entries.extend([src, dst, str(obj.get('size', '')),
+                        obj.get('crc32c', ''), "1" if src in done else "0",
+                        str(sample_files[dst])])
+    #NOTE: the destination dirs are made up front--one mkdir over the unique
+    #dirs, i.e. the 2nd of every 6 entries of the (saved) file list--rather
+    #than once per file by every copy
+    cmd = " ".join(["start=$(date +%s.%N); list=$(mktemp); cat > \"$list\";",
+                    "tr '\\0' '\\n' < \"$list\" | awk 'NR % 6 == 2' | sort -u | xargs -r -d '\\n' mkdir -p;",
+                    "xargs -0 -n 6 -P %s sh -c" % num_workers,
+                    quote(_bulk_copy_sh), "< \"$list\"; rm -f \"$list\";",
+                    "printf 'TOTAL\\t%s\\t%s\\n' \"$start\" \"$(date +%s.%N)\""])
+    return (cmd, "".join("%s\0" % e for e in entries))
+
+def parseBulkCopyOutput(out):
+    """Parses the output of the bulkCopyCommand
+    RETURNS: a tuple (results, elapsed secs) where results is a list of
+    {'status', 'bytes', 'start', 'end', 'secs', 'src', 'dst', 'error'}
+    dictionaries, one per file (start/end are the instance's epoch secs)
+    """
+    results = []
+    elapsed = 0.0
+    for l in out.splitlines():
+        tmp = l.split("\t")
+        if tmp[0] == "TOTAL" and len(tmp) == 3:
+            elapsed = float(tmp[2]) - float(tmp[1])
+        elif tmp[0] in ("OK", "SKIP", "FAIL") and len(tmp) >= 6:
+            results.append({'status': tmp[0], 'bytes': int(tmp[1] or 0),
+                            'start': float(tmp[2]), 'end': float(tmp[3]),
+                            'secs': float(tmp[3]) - float(tmp[2]),
+                            'src': tmp[4], 'dst': tmp[5],
+                            'error': tmp[6] if len(tmp) > 6 else None})
+    return (results, elapsed)
+
+def pipelineOrder(manifest, metasheet, source_objects=None):
+    """Reorders a transfer manifest (see buildTransferManifest) so that the
+    files of each metasheet run's samples are next to each other, with the
+    smallest runs first--so with parallel copies, whole runs become ready
+    as early as possible.  Samples that aren't in any run go last
+    RETURNS: the reordered manifest"""
+    source_objects = source_objects or {}
+    by_sample = {}
+    for (src, dst) in manifest:
+        by_sample.setdefault(dst.rstrip("/").split("/")[-1], []).append((src, dst))
+
+    def _size(run):
+        return sum(int(source_objects.get(src, {}).get('size', 0))
+                   for sample in runSamples(metasheet[run])
+                   for (src, dst) in by_sample.get(sample, []))
+
+    ordered = []
+    for run in sorted(metasheet, key=lambda r: (_size(r), r)):
+        for sample in runSamples(metasheet[run]):
+            ordered.extend(by_sample.pop(sample, []))
+    for (src, dst) in manifest:
+        if dst.rstrip("/").split("/")[-1] in by_sample:
+            ordered.append((src, dst))
+    return ordered
+
+def transferRawFiles_local(samples, ssh_conn, sub_dir, chips_dir='/mnt/ssd/chips', num_workers=8, source_objects=None, manifest_entries=None, metasheet=None, on_ready=None):
+    """Issues a single cmd on the instance that downloads EVERY FILE
+    associated with each sample to /mnt/ssd/chips/data/{sample}, with up
+    to num_workers downloads running in parallel
+    (see buildTransferManifest and bulkCopyCommand)
+    If the source object resources are given ({path: resource}, e.g. from
+    checkConfig), files already on the instance with the same size and
+    crc32c are not downloaded again.  If given, manifest_entries (see
+    manifest.load) is used to avoid re-hashing and is updated with every
+    file that is in place
+    If a metasheet is given the files are copied in pipelineOrder, and
+    on_ready(sample) is called (from this thread) as soon as each sample
+    has all of its files
 
-            #MAKE the data directory
-            (status, stdin, stderr) = ssh_conn.sendCommand("mkdir -p %s" % dst)
-            cmd = " ".join([ "gsutil", "-m", "cp", ffile, dst])
-            print(cmd)
-            (status, stdin, stderr) = ssh_conn.sendCommand(cmd)
-            if stderr:
-                print(stderr)
+    RETURNS: a dictionary of samples with their new data paths
 
+    NOTE: This function handles two types of data structures
+    1. dictionary of lists: e.g. 'samples'-
+       {sample: [google bucket file paths, ...], ...}
+    2. dictionary of dictionaries which define google bucket paths, eg. 'rna'-
+       {sample: {bam_file: <google bucket path>, expression_file: <path>}...}
+    """
+    (tmp, file_list) = buildTransferManifest(samples, sub_dir, chips_dir)
+    if not file_list:
+        return tmp
+    source_objects = source_objects or {}
+    if manifest_entries is None:
+        manifest_entries = {}
+    if metasheet:
+        file_list = pipelineOrder(file_list, metasheet, source_objects)
+
+    done = set()
+    for (src, dst) in file_list:
+        dst_file = os.path.join(dst, src.split("/")[-1])
+        if manifest.matches(source_objects.get(src), manifest_entries.get(dst_file)):
+            done.add(src)
+
+    print("Transferring %s files..." % len(file_list))
+    with tracing.span("transferRawFiles_local", "transfer", files=len(file_list)) as s:
+        (cmd, file_args) = bulkCopyCommand(file_list, num_workers, source_objects, done)
+        out = []
+        ready = set()
+        for (name, data) in ssh_conn.streamCommand(cmd, stdin=file_args):
+            if name == 'stdout':
+                out.append(data)
+                if data.startswith("READY\t") and on_ready:
+                    sample = data.split("\t")[1].rstrip("/").split("/")[-1]
+                    #NOTE: files finishing together can both report it
+                    if sample not in ready:
+                        ready.add(sample)
+                        on_ready(sample)
+            elif name == 'stderr':
+                print(data)
+
+        (results, elapsed) = parseBulkCopyOutput("\n".join(out))
+        total = sum(r['bytes'] for r in results if r['status'] == 'OK')
+        s.set(bytes=total, skipped=len([r for r in results if r['status'] == 'SKIP']))
+    for r in results:
+        #NOTE: timed on the instance, so they go on their own lanes
+        tracing.add(r['src'].split("/")[-1], "transfer", r['start'], r['end'],
+                    lane_group="instance copy", status=r['status'],
+                    bytes=r['bytes'], src=r['src'])
+        if r['status'] == 'FAIL':
+            print("Error transferring %s: %s" % (r['src'], r['error']))
+            manifest_entries.pop(r['dst'], None)
+        elif r['src'] in source_objects:
+            manifest_entries[r['dst']] = manifest.make_entry(source_objects[r['src']])
+    print("Transferred %s/%s files (%s already in place), %.2f GB in %.1f secs (%.1f MB/s)" %
+          (len([r for r in results if r['status'] != 'FAIL']), len(file_list),
+           len([r for r in results if r['status'] == 'SKIP']),
+           total / 1e9, elapsed, total / 1e6 / elapsed if elapsed else 0))
     return tmp
 
-def main():
-    usage = "USAGE: %prog -c [chips_automator config yaml] -u [google account username, e.g. taing] -k [google account key path, i.e. ~/.ssh/google_cloud_engine"
-    optparser = OptionParser(usage=usage)
-    optparser.add_option("-c", "--config", help="instance name")
-    optparser.add_option("-u", "--user", help="username")
-    optparser.add_option("-k", "--key_file", help="key file path")
-    (options, args) = optparser.parse_args(sys.argv)
+def runSamples(run):
+    """Returns the samples of a metasheet run, i.e. its treats and conts"""
+    return [run[k] for k in ['treat1', 'cont1', 'treat2', 'cont2'] if run.get(k)]
 
-    if not options.config or not os.path.exists(options.config):
-        print("Error: missing or non-existent yaml configuration file")
-        optparser.print_help()
-        sys.exit(-1)
+def renderChipsConfig(config, samples):
+    """Given the automator config and the samples dictionary with their
+    paths on the instance (see transferRawFiles_local), returns the
+    contents of the chips config.yaml"""
+    # parse the chips_config.yaml template
+    #NOTE: using the local version of the config
+    chips_config_f = open('chips.config.yaml')
+    chips_config = ruamel.yaml.round_trip_load(chips_config_f.read())
+    chips_config_f.close()
 
-    if (not options.user or not options.key_file):
-        print("ERROR: missing user or google key path")
-        optparser.print_help()
-        sys.exit(-1)
+    # SET the config to the samples dictionary we built up
+    chips_config['samples'] = samples
 
-    # PARSE the yaml file
-    config_f = open(options.config)
+    chips_config['genes_to_plot'] = config.get('genes_to_plot', 'GAPDH ACTB TP53')
+    chips_config['upstream'] = config.get('upstream', '50000')
+    chips_config['downstream'] = config.get('downstream', '50000')
+    # Add sentieon path
+    chips_config['sentieon'] = config.get("sentieon", "/home/taing/sentieon/sentieon-genomics-201808.05/bin/sentieon")
+    ##set transfer path
+    transfer_path = config['google_bucket_path'].replace("gs://","")
+    #check if transfer_path has gs:// in front
+    if not transfer_path.startswith("gs://"):
+        transfer_path = "gs://%s" % transfer_path
+
+    if transfer_path.endswith("/"):
+        chips_config['transfer_path'] = transfer_path
+    else:
+        chips_config['transfer_path'] = transfer_path + "/"
+    ##print(chips_config)
+
+    #NOTE: this writes the comments for the metasheet as well, but ignore it
+    return ruamel.yaml.round_trip_dump(chips_config)
+
+def uploadRunFiles(ssh_conn, config_file, config_str, metasheet_str):
+    """Uploads the chips config.yaml and metasheet.csv (contents) along
+    with the automator config file to /mnt/ssd/chips
+    NOTE: all three files go over ONE sftp session on the existing ssh
+    connection--no temp files or separate scp handshakes"""
+    #upload chips automator config file as well
+    chips_auto_config_f = config_file.split("/")[-1] #Take out config fname
+    auto_config = open(config_file, "rb")
+    print("Uploading config.yaml, metasheet.csv and %s..." % chips_auto_config_f)
+    ssh_conn.putFiles([("/mnt/ssd/chips/config.yaml", config_str),
+                       ("/mnt/ssd/chips/metasheet.csv", metasheet_str),
+                       ("/mnt/ssd/chips/%s" % chips_auto_config_f, auto_config)])
+    auto_config.close()
+
+#the instance's disks by their device names (see createInstanceDisk), which
+#unlike sdb/sdc don't depend on which other disks are attached
+_data_dev = "/dev/disk/by-id/google-persistent-disk-1"
+_ref_dev = "/dev/disk/by-id/google-persistent-disk-2"
+
+#sets up the attached disks and the chips directory on the instance
+_setup_script = "/home/taing/utils/chips_automator.sh"
+#setupCommand's exit status when the image's setup script is too old to
+#take its disks from CHIPS_DATA_DEV/CHIPS_REF_DEV
+_setup_unsupported = 64
+
+def setupCommand(user, config, data_dev=_data_dev):
+    """RETURNS: the cmd that sets up the attached disk and chips directory
+    on the instance
+    NOTE: the setup script takes its disks from CHIPS_DATA_DEV and
+    CHIPS_REF_DEV (by-id paths).  CHIPS_DATA_DEV is empty when /mnt/ssd is
+    already mounted, i.e. for local ssds (see scratchMountCommand)
+    NOTE: an older script (i.e. image) would ignore them and format/mount
+    the sdX disks it expects--with an empty CHIPS_DATA_DEV, the data disk
+    of a run being resumed--so the cmd exits with _setup_unsupported
+    instead of running a script that doesn't mention them"""
+    if config.get('disk_type') == 'local-ssd':
+        data_dev = ""
+    guard = "grep -qs CHIPS_DATA_DEV \"$(command -v %s)\" || { echo \"%s does not take CHIPS_DATA_DEV/CHIPS_REF_DEV\" >&2; exit %s; }" % (_setup_script, _setup_script, _setup_unsupported)
+    return "%s; CHIPS_DATA_DEV=%s CHIPS_REF_DEV=%s %s %s %s" % (guard, quote(data_dev), quote(_ref_dev), _setup_script, user, config.get('chips_commit', ""))
+
+def runScriptCommand(config):
+    """RETURNS: the cmd that runs chips on the instance"""
+    #NOTE: _project and _bucket_path are not needed for local runs
+    _project = config.get("project", "cidc-biofx")
+    normal_bucket_path = config['google_bucket_path'].replace("gs://","")
+    return "/home/taing/utils/chips_automator_run_local.sh %s %s %s" % (_project, normal_bucket_path, str(config['cores']))
+
+def startRun(ssh_conn, config):
+    """Runs chips on the instance over the uploaded config.yaml and
+    metasheet.csv (see uploadRunFiles)
+    NOTE: the run script may hand the run off and return before it's done
+    (its results are sent later by chips_automator_tx.py), so nothing should
+    wait on it--see snakemakeCommand
+    RETURNS: the run script's exit status"""
+    return ssh_conn.runCommand(runScriptCommand(config))
+
+#the cmd that runs chips' snakemake on the instance (from the chips dir),
+#the config's snakemake: overrides it, e.g. to activate a conda env first
+_snakemake = "snakemake -s cidc_chips/chips.snakefile"
+
+def snakemakeCommand(config, chips_dir='/mnt/ssd/chips', args=()):
+    """RETURNS: the cmd that runs chips' snakemake (with the extra args) in
+    chips_dir in the FOREGROUND, i.e. the cmd is only done once the
+    workflow is and its exit status is snakemake's--unlike the run script,
+    see startRun"""
+    return " ".join(["cd %s &&" % quote(chips_dir),
+                     config.get('snakemake') or _snakemake,
+                     "-j %s" % config['cores']] +
+                    [quote(str(a)) for a in args])
+
+###############################################################################
+# Spot runs: snakemake is started in the background with its exit status
+# written to the data disk, and watched (see watchRun).  When the spot
+# instance is preempted it is stopped--its disks stay intact--so a
+# replacement instance is created with the same disks and the run is started
+# again; snakemake picks up from the outputs that are already done.
+###############################################################################
+_spot_status = ".chips_run_status"
+_spot_log = "chips_run.log"
+
+#Makes the chips dir ($1) ready for a resumed run: drops the snakemake lock
+#left by the preempted run and removes the outputs that snakemake had marked
+#incomplete (their marker names are the base64 of the output path), i.e.
+#what --unlock and --rerun-incomplete would do
+_resume_sh = """cd "$1" || exit 1
+rm -rf .snakemake/locks
+[ -d .snakemake/incomplete ] || exit 0
+find .snakemake/incomplete -type f | while read m; do
+  f=$(echo "${m#.snakemake/incomplete/}" | tr -d '/' | tr '_-' '/+' | base64 -d 2>/dev/null)
+  [ -n "$f" ] && rm -rf "$f" && echo "removed incomplete output $f"
+  rm -f "$m"
+done
+"""
+
+#Mounts the replacement instance's data disk ($2) at $1 AS IS--it's never
+#formatted--unless something is mounted there already, and checks that the
+#run's chips dir ($3) is on it
+_remount_sh = """if ! mountpoint -q "$1" && [ -b "$2" ]; then
+  sudo mkdir -p "$1" && sudo mount -o discard,defaults "$2" "$1" || exit 1
+fi
+[ -d "$3" ]
+"""
+
+#secs to keep trying to reconnect to a running instance, see watchRun
+_reconnect_secs = 600
+
+def spotRunCommand(config, chips_dir='/mnt/ssd/chips', args=()):
+    """RETURNS: the cmd that starts snakemake (see snakemakeCommand) in the
+    background (so it survives the ssh connection) and writes its exit
+    status to {chips_dir}/_spot_status when the workflow is done, see
+    spotRunStatus"""
+    status = os.path.join(chips_dir, _spot_status)
+    run = "%s; echo $? > %s" % (snakemakeCommand(config, chips_dir, args), quote(status))
+    return "rm -f %s; nohup sh -c %s > %s 2>&1 < /dev/null &" % (quote(status), quote(run), quote(os.path.join(chips_dir, _spot_log)))
+
+def resumeCommand(chips_dir='/mnt/ssd/chips'):
+    """RETURNS: the cmd that readies chips_dir for a resumed run, see
+    _resume_sh"""
+    return "sh -c %s sh %s" % (quote(_resume_sh), quote(chips_dir))
+
+def remountCommand(chips_dir='/mnt/ssd/chips'):
+    """RETURNS: the cmd that mounts an already set up data disk on a
+    replacement instance, see _remount_sh"""
+    return "sh -c %s sh %s %s %s" % (quote(_remount_sh), quote(os.path.dirname(chips_dir)),
+                                     quote(_data_dev), quote(chips_dir))
+
+def spotRunStatus(ssh_conn, chips_dir='/mnt/ssd/chips'):
+    """RETURNS: the exit status of the background run, or None if it's
+    still going
+    Raises socket.error if the ssh session is gone"""
+    transport = ssh_conn.client.get_transport()
+    if transport is None or not transport.is_active():
+        raise socket.error("the ssh session is closed")
+    (status, out, err) = ssh_conn.sendCommand("cat %s 2>/dev/null" % quote(os.path.join(chips_dir, _spot_status)))
+    out = out.strip()
+    return int(out) if not status and out.isdigit() else None
+
+def spotEventsPath(bucket_path, shard=None):
+    """Returns where the run's preemption/recovery events are kept, next
+    to its transfer manifest (see manifest.manifest_path)"""
+    name = "spot_events_%s" % shard if shard else "spot_events"
+    return "%s/.chips_automator/%s.json" % (bucket_path.rstrip("/"), name)
+
+def recordSpotEvent(storage, events_path, events, event, **info):
+    """Appends the event to the run's events and saves them to the bucket
+    (straight away, so they outlive the automator)"""
+    info.update({'event': event, 'time': time.strftime("%Y-%m-%dT%H:%M:%S")})
+    events.append(info)
+    print("EVENT %s: %s" % (event, ", ".join("%s=%s" % (k, info[k]) for k in sorted(info) if k not in ['event', 'time'])))
+    bucket.upload_string(storage, events_path,
+                         json.dumps(events, indent=1, sort_keys=True),
+                         mimetype="application/json")
+
+@tracing.traced(cat="phase")
+def recoverInstance(compute, instance_config, ssh_config, project, zone, spot=True):
+    """Replaces the (preempted, i.e. stopped) instance with a new instance
+    of the same name: its persistent disks--the data disk and the ref
+    disk--are detached and attached to the replacement as the same devices
+    (same mode and autoDelete); the old boot disk goes with the old instance
+    RETURNS: (instanceId, ip_addr, ssh connection) of the replacement"""
+    instance_name = instance_config['name']
+    old = instance.get_instance(compute, instance_name, project, zone)
+    disks = []
+    for d in old['disks']:
+        if d.get('boot') or 'source' not in d:
+            continue
+        disk_name = d['source'].split("/")[-1]
+        print("Detaching %s..." % disk_name)
+        disk.detach_disk(compute, instance_name, disk_name, project, zone)
+        disks.append(disk.existing_disk_config(disk_name, d['deviceName'], project, zone,
+                                               read_only=(d.get('mode') == 'READ_ONLY'),
+                                               auto_delete=d.get('autoDelete', False)))
+    print("Deleting the preempted instance %s..." % instance_name)
+    instance.delete(compute, instance_name, project, zone)
+
+    print("Creating the replacement instance...")
+    response = instance.create(compute, instance_name,
+                               instance_config['image_name'],
+                               instance_config['image_family'],
+                               instance_config['machine_type'],
+                               project,
+                               instance_config['serviceAcct'],
+                               zone,
+                               disks=disks,
+                               spot=spot)
+    instance_id = response['targetId']
+    ip_addr = instance.get_instance_ip(compute, instance_id, project, zone)
+    print("Establishing connection...")
+    ssh_conn = wait_for_ssh(ip_addr, ssh_config['user'], ssh_config['key'],
+                            port=ssh_config.get('port', 22))
+    return (instance_id, ip_addr, ssh_conn)
+
+def watchRun(compute, storage, config, instance_config, ssh_conn, ssh_config, project, zone, chips_dir='/mnt/ssd/chips', max_recoveries=3, poll_secs=60, args=()):
+    """Starts the run in the background (see spotRunCommand, args are passed
+    to snakemake) and watches the instance until the run is done.  Whenever
+    a spot instance is found preempted, it's replaced (see recoverInstance),
+    its data disk is mounted as is (see remountCommand) and the run is
+    resumed--at most max_recoveries times.  Every preemption/recovery is
+    recorded (see recordSpotEvent)
+    If the ssh session drops while the instance is running, it's
+    reconnected; the run is given up on if that fails for _reconnect_secs
+    NOTE: an instance that was stopped but NOT preempted (e.g. by hand) ends
+    the watch
+    RETURNS: (the run's exit status or None if it was given up on, ip_addr)"""
+    instance_name = instance_config['name']
+    events_path = spotEventsPath(config['google_bucket_path'], config.get('shard'))
+    events = json.loads((bucket.download_string(storage, events_path) or b"[]").decode("utf-8"))
+    recoveries = 0
+    ip_addr = None
+    lost_at = None
+    print("Running %s..." % instance_name)
+    ssh_conn.runCommand(spotRunCommand(config, chips_dir, args))
+    while True:
+        inst = instance.get_instance(compute, instance_name, project, zone)
+        if inst['status'] == 'RUNNING':
+            try:
+                status = spotRunStatus(ssh_conn, chips_dir)
+                lost_at = None
+            except Exception as e:
+                #RECONNECT, re-checking the instance between attempts (it
+                #may have been preempted)
+                lost_at = lost_at or time.time()
+                if time.time() - lost_at > _reconnect_secs:
+                    recordSpotEvent(storage, events_path, events, 'unreachable',
+                                    instance=instance_name, error=str(e))
+                    return (None, ip_addr)
+                print("Lost the connection to %s (%s), reconnecting..." % (instance_name, e))
+                ip_addr = instance.get_instance_ip(compute, inst['id'], project, zone)
+                try:
+                    ssh_conn = wait_for_ssh(ip_addr, ssh_config['user'], ssh_config['key'],
+                                            port=ssh_config.get('port', 22),
+                                            deadline=poll_secs)
+                except Exception as e:
+                    print("Could not reconnect to %s: %s" % (instance_name, e))
+                continue
+            if status is not None:
+                recordSpotEvent(storage, events_path, events, 'finished',
+                                instance=instance_name, status=status,
+                                recoveries=recoveries)
+                return (status, ip_addr)
+        elif inst['status'] == 'TERMINATED':
+            preemption = instance.find_preemption(compute, inst['id'], project, zone)
+            if not preemption:
+                print("The instance %s was stopped (not preempted), no longer watching the run" % instance_name)
+                return (None, ip_addr)
+            recordSpotEvent(storage, events_path, events, 'preempted',
+                            instance=instance_name, instance_id=inst['id'],
+                            preempted_at=preemption.get('insertTime'))
+            if recoveries >= max_recoveries:
+                recordSpotEvent(storage, events_path, events, 'gave_up',
+                                instance=instance_name, recoveries=recoveries)
+                return (None, ip_addr)
+            recoveries += 1
+            ssh_conn.client.close()
+            t0 = time.time()
+            (instance_id, ip_addr, ssh_conn) = recoverInstance(compute, instance_config,
+                                                               ssh_config, project, zone,
+                                                               spot=bool(config.get('spot')))
+            #MOUNT the data disk as is (the run is on it) and only then SETUP
+            #the rest of the replacement--with no data disk to touch
+            status = ssh_conn.runCommand(remountCommand(chips_dir))
+            if status:
+                recordSpotEvent(storage, events_path, events, 'gave_up',
+                                instance=instance_name, recoveries=recoveries,
+                                error="%s is not on the data disk" % chips_dir)
+                return (None, ip_addr)
+            status = ssh_conn.runCommand(setupCommand(ssh_config['user'], config, data_dev=""))
+            if status == _setup_unsupported:
+                recordSpotEvent(storage, events_path, events, 'gave_up',
+                                instance=instance_name, recoveries=recoveries,
+                                error="the setup script doesn't take CHIPS_DATA_DEV")
+                return (None, ip_addr)
+            elif status:
+                print("Error %s: setting up the replacement instance" % status)
+            ssh_conn.runCommand(resumeCommand(chips_dir))
+            ssh_conn.runCommand(spotRunCommand(config, chips_dir, args))
+            recordSpotEvent(storage, events_path, events, 'recovered',
+                            instance=instance_name, instance_id=instance_id,
+                            ip=ip_addr, recovery=recoveries,
+                            secs=round(time.time() - t0, 1))
+            continue
+        time.sleep(poll_secs)
+
+def runPipelined(config, config_file, ssh_conn, source_objects=None, manifest_entries=None, num_workers=8):
+    """Overlaps the run with the data transfer: the files are copied a
+    metasheet run at a time (see pipelineOrder) in the background and,
+    whenever runs have all of their samples, the run is started--or
+    extended--in waves: the config.yaml and metasheet.csv are re-uploaded
+    with every run that is ready so far and snakemake is run over them
+    (see snakemakeCommand, which only returns once the wave is done)
+    WITHOUT the cohort-level rules (see shardRunArgs), which would otherwise
+    be redone over the cohort-so-far in every wave.
+    The next wave goes once the last one is done (snakemake only builds what
+    is new), so later downloads overlap with the earlier samples' analysis.
+    Once every file is in place, the run script is started over every run
+    (see startRun), just like an unpipelined run--so the cohort-level rules
+    are only run once, over the whole cohort
+    NOTE: runs with samples that failed to transfer are never started
+    RETURNS: a dictionary of samples with their new data paths"""
+    metasheet = config['metasheet']
+    (samples, file_list) = buildTransferManifest(config['samples'], 'data')
+    ready = queue.Queue()
+    result = {}
+
+    def _transfer():
+        try:
+            result['samples'] = transferRawFiles_local(config['samples'], ssh_conn, 'data',
+                                                       num_workers=num_workers,
+                                                       source_objects=source_objects,
+                                                       manifest_entries=manifest_entries,
+                                                       metasheet=metasheet,
+                                                       on_ready=ready.put)
+        except Exception as e:
+            result['error'] = e
+        ready.put(None)
+
+    t = threading.Thread(target=_transfer)
+    t.daemon = True
+    t.start()
+
+    def _upload(runs):
+        run_samples = dict((sample, samples[sample]) for sample in samples
+                           if sample in ready_samples)
+        uploadRunFiles(ssh_conn, config_file, renderChipsConfig(config, run_samples),
+                       renderMetasheet(collections.OrderedDict((r, metasheet[r]) for r in runs)))
+
+    ready_samples = set()
+    started = []
+    transferring = True
+    while transferring:
+        #TAKE every sample that became ready while the last wave ran
+        item = ready.get()
+        while True:
+            if item is None:
+                transferring = False
+            else:
+                ready_samples.add(item)
+            try:
+                item = ready.get_nowait()
+            except queue.Empty:
+                break
+
+        runs = [r for r in metasheet if set(runSamples(metasheet[r])) <= ready_samples]
+        if not transferring or len(runs) == len(started):
+            continue
+        print("%s the run with %s of %s runs (%s new)..." %
+              ("Extending" if started else "Starting", len(runs), len(metasheet),
+               len(runs) - len(started)))
+        with tracing.span("wave", "phase", runs=len(runs), samples=len(ready_samples)):
+            _upload(runs)
+            status = ssh_conn.runCommand(snakemakeCommand(config, args=shardRunArgs(config)))
+        if status:
+            print("Error %s: running the wave" % status)
+        started = runs
+
+    t.join()
+    if 'error' in result:
+        raise result['error']
+    missing = [r for r in metasheet if r not in runs]
+    if missing:
+        print("NOT running %s (not all of their samples were transferred)" % ", ".join(missing))
+    #RUN over every run, snakemake only has what's new to do
+    print("Running with %s of %s runs..." % (len(runs), len(metasheet)))
+    _upload(runs)
+    status = startRun(ssh_conn, config)
+    if status:
+        print("Error %s: starting the run" % status)
+    return result['samples']
+
+def renderMetasheet(metasheet):
+    """Given the automator config's metasheet dictionary, returns the
+    contents of the chips metasheet.csv"""
+    lines = ["RunName,Treat1,Cont1,Treat2,Cont2"]
+    for run in metasheet:
+          #NOTE: only treat1 is required, see validateConfig
+          treat1 = metasheet[run]['treat1']
+          cont1 = metasheet[run].get('cont1')
+          treat2 = metasheet[run].get('treat2')
+          cont2 = metasheet[run].get('cont2')
+          ls = [run, treat1, cont1,treat2, cont2]
+          res = [str(i or '') for i in ls]
+          lines.append(','.join(res))
+    return "\n".join(lines) + "\n"
+
+#dictionary of machine types based on cores
+_machine_types = {'2': 'n2-standard-2',
+                  '4': 'n2-standard-4',
+                  '8': 'n2-standard-8',
+                  '16': 'n2-standard-16',
+                  '32': 'n2-standard-32',
+                  '64': 'n2-standard-64',
+                  '96': 'n2-standard-96'}
+
+def getMachineType(config):
+    """Returns the machine type to use for the config's core count
+    (default to n2-standard-8 if the core count is undefined)
+    NOTE: an explicit machine_type in the config (e.g. set by autosize)
+    wins"""
+    if config.get('machine_type'):
+        return config['machine_type']
+    machine_type = "n2-standard-8"
+    if 'cores' in config and str(config['cores']) in _machine_types:
+        machine_type = _machine_types[str(config['cores'])]
+    return machine_type
+
+#the service account of the chips instances
+_service_account = "biofxvm@cidc-biofx.iam.gserviceaccount.com"
+
+def instanceConfig(config):
+    """RETURNS: the instance config (see createInstanceDisk) for the
+    automator config"""
+    #AUTO append "chips_auto_" to instance name
+    return {'name': "-".join(['chips-auto', config['instance_name']]),
+            'image_name': config.get('image', 'chips-ver1-7a'),
+            'image_family': config.get('image_family', 'chips'),
+            'machine_type': getMachineType(config),
+            'serviceAcct': _service_account}
+
+def loadConfig(config_file):
+    """Parses the given automator config yaml file"""
+    config_f = open(config_file)
     config = ruamel.yaml.round_trip_load(config_f.read())
     config_f.close()
+    return config
+
+#ROUGH figures for --plan, see printPlan--tune as needed
+#secs for each provisioning step (the ref disk and instance are made in
+#parallel, see createInstanceDisk)
+_plan_secs = {'lookup': 2,
+              'ref': {'snapshot': 90, 'shared': 10, 'pool': 15},
+              'instance': 45,
+              'pooled_instance': 20,
+              'ssh': 30,
+              'setup': 60}
+#bucket -> instance transfer rate (MB/s) across all of the parallel copies
+_plan_transfer_mbps = 200.0
+#on-demand $ per vCPU hr, per GB of memory hr and per GB-month of disk
+_plan_vcpu_hr = 0.0316
+_plan_mem_gb_hr = 0.0042
+#spot vCPUs/memory go for roughly this fraction of the on-demand price
+_plan_spot_price = 0.3
+_plan_disk_gb_month = {'pd-standard': 0.04, 'pd-balanced': 0.10,
+                       'pd-ssd': 0.17, 'pd-extreme': 0.125,
+                       'hyperdisk-balanced': 0.08,
+                       'hyperdisk-throughput': 0.05,
+                       'hyperdisk-extreme': 0.125,
+                       'local-ssd': 0.08}
+_hrs_per_month = 730.0
+
+def printPlan(config, user=None):
+    """Prints what launch would do for the (validated) automator config--
+    the instance, disks, transfers and remote commands--with a rough
+    provisioning time, transfer volume and hourly cost.  Nothing touches
+    GCP, so the input sizes are unknown; the transfer volume is worked back
+    from the disk_size (see autosize.model)"""
+    user = user or "USER"
+    instance_name = "-".join(['chips-auto', config['instance_name']])
+    ref_mode = config.get('ref_disk_mode', 'snapshot')
+    pool_size = int(config.get('instance_pool_size', 0))
+    disk_type = config.get('disk_type') or 'pd-standard'
+    (samples, file_list) = buildTransferManifest(config['samples'], 'data')
+
+    print("PLAN for %s" % instance_name)
+    num_shards = int(config.get('shards') or 1)
+    if num_shards > 1:
+        #NOTE: sized by the number of files, the input sizes aren't known
+        shards = shardCohort(config, num_shards)
+        print("  shards: %s instances like the one below, then the cohort-level rules (%s) once on %s" %
+              (len(shards), ", ".join(str(r) for r in config['cohort_rules']), runInstanceNames(config)[0]))
+        printShards(shards, sized=False)
+    if config.get('autosize') and not config.get('machine_type') and not config.get('cores'):
+        machine_type = None
+        print("  instance: %s, machine type autosized at launch" % instance_name)
+    else:
+        machine_type = getMachineType(config)
+        print("  instance: %s, %s" % (instance_name, machine_type))
+    print("  image: %s (family %s), project %s, zone %s" %
+          (config.get('image', 'chips-ver1-7a'), config.get('image_family', 'chips'),
+           config.get("project", "cidc-biofx"), config.get("zone", "us-east1-b")))
+    if config.get('spot'):
+        print("  spot instance: replaced (with the same disks) and the run resumed if preempted, up to %s times" % config.get('spot_max_recoveries', 3))
+    elif pool_size:
+        print("  instance pool: claim one of %s warm instances, else create it" % pool_size)
+
+    disk_size = config.get('disk_size')
+    if not disk_size:
+        disk_gb = None
+        print("  data disk: %s-disk, %s, size autosized at launch" % (instance_name, disk_type))
+    elif disk_type == 'local-ssd':
+        ssds = int(config.get('local_ssds') or -(-int(disk_size) // disk.local_ssd_gb))
+        disk_gb = ssds * disk.local_ssd_gb
+        print("  data disk: %s local ssds (%s GB)" % (ssds, disk_gb))
+    else:
+        disk_gb = int(disk_size)
+        print("  data disk: %s-disk, %s GB %s" % (instance_name, disk_gb, disk_type))
+    chips_ref_snapshot = config.get('chips_ref_snapshot', 'chips-ref-ver1-0')
+    print("  ref disk: %s (%s)" % ({'snapshot': "restored from %s, deleted with the instance" % chips_ref_snapshot,
+                                    'shared': "the shared read-only disk of %s" % chips_ref_snapshot,
+                                    'pool': "claimed from the pool of %s disks (%s kept warm)" % (chips_ref_snapshot, config.get('ref_pool_size', 2))}[ref_mode],
+                                   ref_mode))
+
+    print("  transfers: %s files for %s samples -> /mnt/ssd/chips/data (%s runs in the metasheet%s)" %
+          (len(file_list), len(samples), len(config['metasheet']),
+           ", started as their samples arrive" if config.get('pipelined') else ""))
+    if disk_size:
+        #NOTE: the inverse of autosize's disk model, i.e. at most this much
+        input_gb = max(0.0, (int(disk_size) - autosize._disk_base_gb) / autosize._disk_per_input)
+        print("  transfer volume: up to ~%.0f GB (~%.0f min at %.0f MB/s)" %
+              (input_gb, input_gb * 1000 / _plan_transfer_mbps / 60, _plan_transfer_mbps))
+
+    instance_secs = _plan_secs['pooled_instance'] if pool_size and not config.get('spot') else _plan_secs['instance']
+    provision_secs = (_plan_secs['lookup'] + max(_plan_secs['ref'][ref_mode], instance_secs) +
+                      _plan_secs['ssh'])
+    print("  provisioning: ~%s secs, then ~%s secs of setup" % (provision_secs, _plan_secs['setup']))
+
+    if machine_type and disk_gb:
+        cores = int(machine_type.split("-")[-1])
+        per_core = dict(autosize._families).get(machine_type.rsplit("-", 1)[0],
+                                                autosize.pickFamily(cores)[1])
+        spot_price = _plan_spot_price if config.get('spot') else 1.0
+        hourly = (spot_price * (cores * _plan_vcpu_hr + cores * per_core * _plan_mem_gb_hr) +
+                  disk_gb * _plan_disk_gb_month.get(disk_type, 0.04) / _hrs_per_month)
+        print("  cost: ~$%.2f/hr (%s%s vCPUs, %s GB memory, %s GB %s; excl. boot/ref disks)%s" %
+              (hourly, "spot, " if config.get('spot') else "", cores, cores * per_core, disk_gb, disk_type,
+               " per shard" if num_shards > 1 else ""))
+
+    print("  remote commands:")
+    print("    %s" % setupCommand(user, config))
+    print("    xargs -P 8 gsutil cp ... (%s files, see bulkCopyCommand)" % len(file_list))
+    #NOTE: autosized cores are only known at launch
+    print("    %s" % runScriptCommand(dict(config, cores=config.get('cores') or "CORES")))
+
+@tracing.traced(cat="phase")
+def launch(config_file, user, key_file, config=None, source_objects=None, watch=False):
+    """Runs the automator for a single automator config file: creates the
+    instance and disks, transfers the data, sets up and starts the run
+    The parsed config and its source objects (see checkConfig) can be given,
+    e.g. for a shard of the config (see launchShards).  With watch=True
+    (always for spot runs) the run is watched until it's done, see watchRun
+    RETURNS: (instance name, ip address)
+    """
+    # PARSE the yaml file
+    if config is None:
+        config = loadConfig(config_file)
 
     #CHECK config
-    checkConfig(config)
+    #NOTE: the input sizes/checksums are kept for the later steps
+    storage = gcp.build('storage', 'v1')
+    if source_objects is None:
+        source_objects = checkConfig(config, storage)
+    print("Total input size: %.2f GB" % (sum(int(o['size']) for o in source_objects.values()) / 1e9))
+    #PICK the machine type and disk size from the inputs (if asked to)
+    autosize.apply(config, storage, source_objects)
 
     #SET DEFAULTS
-    _sentieon = config.get("sentieon", "/home/taing/sentieon/sentieon-genomics-201808.05/bin/sentieon")
-    _commit_str = config.get('chips_commit', "")
-    _image_name = config.get('image', 'chips-ver1-7a')
-    _image_family = config.get('image_family', 'chips')
-    _genes_to_plot = config.get('genes_to_plot', 'GAPDH ACTB TP53')
-    _upstream = config.get('upstream', '50000')
-    _downstream = config.get('downstream', '50000')
     _project = config.get("project", "cidc-biofx")
-    _service_account = "biofxvm@cidc-biofx.iam.gserviceaccount.com"
     _zone = config.get("zone", "us-east1-b")
-    #dictionary of machine types based on cores
-    _machine_types = {'2': 'n2-standard-2',
-                      '4': 'n2-standard-4',
-                      '8': 'n2-standard-8',
-                      '16': 'n2-standard-16',
-                      '32': 'n2-standard-32',
-                      '64': 'n2-standard-64',
-                      '96': 'n2-standard-96'}
 
     #SHOULD I error check these?
-    #AUTO append "chips_auto_" to instance name
-    instance_name = "-".join(['chips-auto', config['instance_name']])
+    instance_config = instanceConfig(config)
+    instance_name = instance_config['name']
     #AUTO name attached disk
     disk_name = "-".join([instance_name, 'disk'])
     disk_size = config['disk_size']
 
-    #SET machine type (default to n2-standard-8 if the core count is undefined)
-    machine_type = "n2-standard-8"
-    if 'cores' in config and str(config['cores']) in _machine_types:
-        machine_type = _machine_types[str(config['cores'])]
-
     #The google bucket path is in the form of gs:// ...
-    #The normal_bucket path is the google bucket path but without the gs://
     google_bucket_path = config['google_bucket_path']
-    normal_bucket_path = google_bucket_path.replace("gs://","") #remove gsL//
-
-    instance_config= {'name': instance_name,
-                      'image_name': _image_name,
-                      'image_family': _image_family,
-                      'machine_type': machine_type,
-                      'serviceAcct': _service_account}
 
     disk_config= {'name': disk_name,
-                  'size': disk_size}
+                  'size': disk_size,
+                  'type': config.get('disk_type'),
+                  'iops': config.get('disk_iops'),
+                  'throughput': config.get('disk_throughput')}
+    if disk_config['type'] == 'local-ssd':
+        #NOTE: enough local ssds to cover the disk_size unless given
+        disk_config['local_ssds'] = int(config.get('local_ssds') or
+                                        -(-int(disk_size) // disk.local_ssd_gb))
 
     chips_ref_snapshot = config.get('chips_ref_snapshot', 'chips-ref-ver1-0')
 
-    ssh_config= {'user': options.user,
-                 'key': options.key_file}
+    ssh_config= {'user': user,
+                 'key': key_file}
 
 
     print(instance_config)
     print(disk_config)
     #print(ssh_config)
-    compute = googleapiclient.discovery.build('compute', 'v1')
+    compute = gcp.build('compute', 'v1')
     (instanceId, ip_addr, ssh_conn) = createInstanceDisk(compute,
                                                          instance_config,
                                                          chips_ref_snapshot,
                                                          disk_config,
                                                          ssh_config,
                                                          _project,
-                                                         _zone)
+                                                         _zone,
+                                                         ref_mode=config.get('ref_disk_mode', 'snapshot'),
+                                                         ref_pool_size=int(config.get('ref_pool_size', 2)),
+                                                         instance_pool_size=int(config.get('instance_pool_size', 0)),
+                                                         spot=bool(config.get('spot')))
 
     print("Successfully created instance %s" % instance_config['name'])
     print("{instanceId: %s, ip_addr: %s, disk: %s}" % (instanceId, ip_addr, disk_config['name']))
 #------------------------------------------------------------------------------
     #SETUP the instance, disk, and chips directory
     print("Setting up the attached disk...")
-    cmd= "/home/taing/utils/chips_automator.sh %s %s" % (options.user, _commit_str)
+    cmd= setupCommand(user, config)
     #print(cmd)
-    (status, stdin, stderr) = ssh_conn.sendCommand(cmd)
-    if stderr:
-        print(stderr)
+    #NOTE: the script's output is streamed back as it runs
+    status = ssh_conn.runCommand(cmd)
+    if status == _setup_unsupported:
+        raise RuntimeError("%s on %s doesn't take CHIPS_DATA_DEV/CHIPS_REF_DEV (an older image?), "
+                           "nothing was transferred--delete the instance with chips_automator_teardown.py" % (_setup_script, instance_name))
+    elif status:
+        print("Error %s: setting up the attached disk" % status)
 #------------------------------------------------------------------------------
     # transfer the data to the bucket directory
-    print("Transferring raw files from the bucket...")
-    samples = transferRawFiles_local(config['samples'], ssh_conn, 'data')
+    #NOTE: the transfer manifest is kept with the run's results so that a
+    #rerun only copies what's missing or changed
+    transfer_entries = manifest.load(storage, google_bucket_path, config.get('shard'))
+    if config.get('pipelined'):
+        #START the run on the first samples while the rest are copied
+        print("Transferring raw files from the bucket and running as they arrive...")
+        try:
+            runPipelined(config, config_file, ssh_conn, source_objects, transfer_entries)
+        finally:
+            manifest.save(storage, google_bucket_path, transfer_entries, config.get('shard'))
+    else:
+        print("Transferring raw files from the bucket...")
+        samples = transferRawFiles_local(config['samples'], ssh_conn, 'data',
+                                         source_objects=source_objects,
+                                         manifest_entries=transfer_entries)
+        manifest.save(storage, google_bucket_path, transfer_entries, config.get('shard'))
+
+        #RENDER the config and metasheet in memory and UPLOAD them
+        print("Setting up the config and metasheet...")
+        uploadRunFiles(ssh_conn, config_file, renderChipsConfig(config, samples),
+                       renderMetasheet(config['metasheet']))
+
+        #RUN
+        if config.get('spot') or watch:
+            #NOTE: stays up to replace the instance if it's preempted
+            #NOTE: a shard leaves out the cohort-level rules, see mergeShards
+            (status, new_ip) = watchRun(compute, storage, config, instance_config,
+                                        ssh_conn, ssh_config, _project, _zone,
+                                        max_recoveries=int(config.get('spot_max_recoveries', 3)),
+                                        args=shardRunArgs(config) if config.get('shard') else ())
+            ip_addr = new_ip or ip_addr
+            if status:
+                print("Error %s: the run" % status)
+        else:
+            print("Running...")
+            status = startRun(ssh_conn, config)
+            if status:
+                print("Error %s: starting the run" % status)
 
+    print("The instance %s is running at the following IP: %s" % (instance_name, ip_addr))
+    print("please log into this instance and to check-in on the run")
 
-#------------------------------------------------------------------------------
-    # Write a config (.config.yaml) and a meta (.metasheet.csv) locally
-    # then upload it to the instance
-    # CONFIG.yaml
-    print("Setting up the config.yaml...")
-    # parse the chips_config.yaml template
-    #NOTE: using the local version of the config
-    chips_config_f = open('chips.config.yaml')
-    chips_config = ruamel.yaml.round_trip_load(chips_config_f.read())
-    chips_config_f.close()
+    return (instance_name, ip_addr)
+
+###############################################################################
+# Sharded runs: a cohort that's too big for one instance is split into
+# shards (see shardCohort) which are each run on their own instance, without
+# the cohort-level rules (see shardRunArgs).  Once every shard is done, their
+# outputs are pulled onto the first shard's instance and ONLY the
+# cohort-level rules are run there, once, over the whole cohort (see
+# mergeShards).
+###############################################################################
+#sends a run's results to its google_bucket_path, see chips_automator_tx.py
+_results_tx = "/home/taing/utils/chips_automator_tx.sh"
+
+#Sends a shard's outputs (its analysis dir, $1) to the shard's staging path
+#($2) and lists them (relative to the analysis dir), one per line
+_push_sh = """cd "$1" || exit 1
+gsutil -m -q rsync -r . "$2" || exit 1
+find . -type f ! -name '.*' | sed 's|^\\./||'
+"""
 
-    # SET the config to the samples dictionary we built up
-    chips_config['samples'] = samples
+#Drops the copy markers (see _bulk_copy_sh) left in the merge instance's
+#analysis dir ($1) by pulling the other shards' outputs
+_unmark_sh = """cd "$1" || exit 1
+find . -type f \\( -name '.*.done' -o -name .ready \\) -delete
+"""
 
-    chips_config['genes_to_plot'] = _genes_to_plot
-    chips_config['upstream'] = _upstream
-    chips_config['downstream'] = _downstream
-    # Add sentieon path
-    chips_config['sentieon'] = _sentieon
-    ##set transfer path
-    transfer_path = normal_bucket_path
-    #check if transfer_path has gs:// in front
-    if not transfer_path.startswith("gs://"):
-        transfer_path = "gs://%s" % transfer_path
+def runInstanceNames(config):
+    """RETURNS: the names of the instances that run the config, i.e. one per
+    shard for sharded configs--which can be fewer than the shards asked
+    for (see shardCohort)
+    NOTE: the number of shards doesn't depend on the input sizes, so the
+    names are known offline"""
+    num_shards = int(config.get('shards') or 1)
+    if num_shards <= 1:
+        return [_instance_prefix + str(config['instance_name'])]
+    return [_instance_prefix + s['instance_name'] for s in shardCohort(config, num_shards)]
+
+def shardStagingPath(bucket_path, shard):
+    """Returns where a shard's outputs are staged for the merge (see
+    mergeShards), apart from the run's results--which only the merge run
+    writes"""
+    return "%s/.chips_automator/shards/%s/analysis" % (bucket_path.rstrip("/"), shard)
+
+def shardRunArgs(config):
+    """RETURNS: the snakemake args of a shard's run (or a pipelined run's
+    wave, see runPipelined): every rule but the cohort-level ones (and
+    what's downstream of them)"""
+    return ['--omit-from'] + [str(r) for r in config['cohort_rules']]
+
+def mergeRunArgs(config):
+    """RETURNS: the snakemake args of the merge run: ONLY the cohort-level
+    rules are run, the other rules' outputs are taken as they are--a
+    missing one is an error, it's never rebuilt"""
+    rules = [str(r) for r in config['cohort_rules']]
+    return ['--allowed-rules'] + rules + ['--'] + rules
+
+def shardCohort(config, num_shards, source_objects=None):
+    """Splits the config's samples and metasheet runs into (at most)
+    num_shards shards of about the same input size: runs that share a
+    sample (e.g. a control used by several treatments) always go together,
+    samples that aren't in any run go on their own.  The groups are handed
+    out biggest first, each to the smallest shard so far
+    The input size comes from source_objects ({path: object resource}, see
+    checkConfig), or the number of files if they aren't given
+    RETURNS: a list of shard configs--copies of the config with the shard's
+    samples and runs, and its own shard name and instance_name"""
+    samples = config['samples']
+    metasheet = config['metasheet']
+
+    #GROUP the samples that are linked by runs
+    group = dict((s, s) for s in samples)
+    def _root(s):
+        while group[s] != s:
+            group[s] = group[group[s]]
+            s = group[s]
+        return s
+    run_samples = dict((run, [s for s in runSamples(metasheet[run]) if s in samples])
+                       for run in metasheet)
+    for run in metasheet:
+        for s in run_samples[run][1:]:
+            group[_root(s)] = _root(run_samples[run][0])
+
+    groups = collections.OrderedDict()
+    for s in samples:
+        g = groups.setdefault(_root(s), {'samples': set(), 'runs': set(), 'size': 0})
+        g['samples'].add(s)
+        for p in bucket.sample_paths(samples[s]):
+            g['size'] += int(source_objects[p]['size']) if source_objects and p in source_objects else 1
+    for run in metasheet:
+        if run_samples[run]:
+            groups[_root(run_samples[run][0])]['runs'].add(run)
+
+    #DEAL the groups out, biggest first
+    #NOTE: an empty shard always gets the next group (even an empty one), so
+    #there are min(num_shards, groups) shards whatever the sizes
+    shards = [{'samples': set(), 'runs': set(), 'size': 0} for i in range(max(1, num_shards))]
+    for g in sorted(groups.values(), key=lambda g: -g['size']):
+        shard = min(shards, key=lambda sh: (sh['size'], len(sh['samples'])))
+        for k in ['samples', 'runs']:
+            shard[k].update(g[k])
+        shard['size'] += g['size']
+
+    configs = []
+    for shard in [sh for sh in shards if sh['samples']]:
+        shard_config = dict(config)
+        shard_config.pop('shards', None)
+        shard_config['shard'] = "s%s" % (len(configs) + 1)
+        shard_config['instance_name'] = "%s-%s" % (config['instance_name'], shard_config['shard'])
+        shard_config['samples'] = collections.OrderedDict((s, samples[s]) for s in samples if s in shard['samples'])
+        shard_config['metasheet'] = collections.OrderedDict((r, metasheet[r]) for r in metasheet if r in shard['runs'])
+        shard_config['shard_size'] = shard['size']
+        configs.append(shard_config)
+    return configs
+
+def printShards(shards, sized=True):
+    """Prints the samples, runs and input size of every shard"""
+    print("%-6s %-36s %8s %6s %10s" % ("shard", "instance", "samples", "runs", "GB" if sized else "files"))
+    for shard in shards:
+        print("%-6s %-36s %8s %6s %10s" % (shard['shard'], "chips-auto-%s" % shard['instance_name'],
+                                           len(shard['samples']), len(shard['metasheet']),
+                                           "%.2f" % (shard['shard_size'] / 1e9) if sized else shard['shard_size']))
+
+def shardOutputs(storage, staging_path, files, chips_dir='/mnt/ssd/chips'):
+    """Given the outputs that a shard built (relative to its analysis dir,
+    see _push_sh), checks that every one of them is in the shard's staging
+    path (see shardStagingPath)
+    RETURNS: (a transfer manifest of them into {chips_dir}/analysis (see
+    buildTransferManifest), the outputs that are missing from the staging
+    path)"""
+    staging_path = staging_path.rstrip("/")
+    (bucket_name, prefix) = bucket.parse_path(staging_path + "/")
+    staged = set(o['name'][len(prefix):] for o in bucket.list_objects(storage, bucket_name, prefix))
+    pulled = [("%s/%s" % (staging_path, f), os.path.dirname(os.path.join(chips_dir, 'analysis', f)))
+              for f in files]
+    return (pulled, [f for f in files if f not in staged])
+
+@tracing.traced(cat="phase")
+def mergeShards(compute, storage, config, config_file, shards, ips, ssh_config, chips_dir='/mnt/ssd/chips', num_workers=8):
+    """The merge stage of a sharded run (see launchShards): once every
+    shard's run is done (ok), the other shards send their outputs to their
+    staging paths (see _push_sh) and they're pulled onto the first shard's
+    instance--every one of them, or the merge is called off (see
+    shardOutputs).  Then ONLY the cohort-level rules are run there (see
+    mergeRunArgs), with the WHOLE cohort's config.yaml and metasheet.csv,
+    and the results of the whole cohort are sent to the google_bucket_path
+    ips is {shard name: ip address}
+    RETURNS: the merge run's exit status, or None if it didn't run"""
+    _project = config.get("project", "cidc-biofx")
+    _zone = config.get("zone", "us-east1-b")
+    conns = dict((s['shard'], wait_for_ssh(ips[s['shard']], ssh_config['user'], ssh_config['key'],
+                                           port=ssh_config.get('port', 22)))
+                 for s in shards)
+    try:
+        #CHECK every shard's run
+        failed = [s['shard'] for s in shards if spotRunStatus(conns[s['shard']], chips_dir) != 0]
+        if failed:
+            print("ERROR: the runs of shards %s failed (or aren't done), not merging" % ", ".join(failed))
+            return None
+
+        #STAGE the other shards' outputs and CHECK that they're all there
+        merge = shards[0]
+        others = shards[1:]
+        print("Staging the outputs of %s shards..." % len(others))
+        def _push(shard):
+            cmd = "sh -c %s sh %s %s" % (quote(_push_sh), quote(os.path.join(chips_dir, 'analysis')),
+                                         quote(shardStagingPath(config['google_bucket_path'], shard)))
+            return conns[shard].sendCommand(cmd)
+        pulled = []
+        for (shard, res, err) in workers.imap_unordered(_push, [s['shard'] for s in others], max(1, len(others))):
+            if err is not None or res[0]:
+                print("ERROR: staging the outputs of shard %s: %s" % (shard, err or res[2]))
+                return None
+            files = [f for f in res[1].split("\n") if f.strip()]
+            (shard_pulled, missing) = shardOutputs(storage, shardStagingPath(config['google_bucket_path'], shard),
+                                                files, chips_dir)
+            if missing:
+                print("ERROR: %s of the %s outputs of shard %s are missing, not merging: %s" %
+                      (len(missing), len(files), shard, ", ".join(missing[:10])))
+                return None
+            pulled.extend(shard_pulled)
+
+        #PULL them onto the merge instance
+        ssh_conn = conns[merge['shard']]
+        print("Pulling %s outputs of the other shards onto %s..." % (len(pulled), instanceConfig(merge)['name']))
+        if pulled:
+            (cmd, file_args) = bulkCopyCommand(pulled, num_workers)
+            (status, out, err) = ssh_conn.sendCommand(cmd, stdin=file_args)
+            (results, elapsed) = parseBulkCopyOutput(out)
+            errors = [r for r in results if r['status'] == 'FAIL']
+            if status or errors or len(results) != len(pulled):
+                print("ERROR: pulling the shards' outputs: %s" % (errors[0]['error'] if errors else err))
+                return None
+            (status, out, err) = ssh_conn.sendCommand("sh -c %s sh %s" % (quote(_unmark_sh), quote(os.path.join(chips_dir, 'analysis'))))
+            if status:
+                print("Error %s: readying the merge: %s" % (status, err))
+                return None
+
+        #RUN the cohort-level rules
+        (samples, file_list) = buildTransferManifest(config['samples'], 'data')
+        merge_config = dict(merge, samples=config['samples'], metasheet=config['metasheet'], shard='merge')
+        uploadRunFiles(ssh_conn, config_file, renderChipsConfig(merge_config, samples),
+                       renderMetasheet(config['metasheet']))
+        (status, ip_addr) = watchRun(compute, storage, merge_config, instanceConfig(merge),
+                                     ssh_conn, ssh_config, _project, _zone, chips_dir,
+                                     max_recoveries=int(config.get('spot_max_recoveries', 3)),
+                                     args=mergeRunArgs(config))
+        if status != 0:
+            print("Error %s: the merge run" % status)
+            return status
+        if ip_addr:
+            #NOTE: the instance was replaced (spot) or reconnected to
+            ssh_conn = wait_for_ssh(ip_addr, ssh_config['user'], ssh_config['key'],
+                                    port=ssh_config.get('port', 22))
+            conns['merge'] = ssh_conn
+        status = ssh_conn.runCommand(_results_tx)
+        if status:
+            print("Error %s: transferring the merged results" % status)
+            return status
+        #NOTE: the whole cohort's outputs are in the results now
+        ssh_conn.runCommand("gsutil -m -q rm -r %s" % quote("%s/.chips_automator/shards" % config['google_bucket_path'].rstrip("/")))
+        return status
+    finally:
+        for conn in conns.values():
+            conn.client.close()
+
+def launchShards(config_file, user, key_file, config=None):
+    """Runs a sharded automator config (shards: K): the cohort is split (see
+    shardCohort), the shards are launched on their own instances at the same
+    time (see launch) and watched until they're done, then merged (see
+    mergeShards)
+    RETURNS: the merge run's exit status (None if it didn't run)"""
+    if config is None:
+        config = loadConfig(config_file)
+    storage = gcp.build('storage', 'v1')
+    source_objects = checkConfig(config, storage)
+    shards = shardCohort(config, int(config['shards']), source_objects)
+    printShards(shards)
+
+    def _launch(shard):
+        paths = set(p for s in shard['samples'] for p in bucket.sample_paths(shard['samples'][s]))
+        return launch(config_file, user, key_file, config=shard,
+                      source_objects=dict((p, o) for (p, o) in source_objects.items() if p in paths),
+                      watch=True)
+
+    ips = {}
+    for (shard, res, err) in workers.imap_unordered(_launch, shards, len(shards)):
+        if err is not None:
+            print("ERROR: shard %s: %s" % (shard['shard'], err))
+        else:
+            ips[shard['shard']] = res[1]
+    if len(ips) < len(shards):
+        print("ERROR: not every shard was launched, not merging")
+        return None
+    ssh_config = {'user': user, 'key': key_file}
+    status = mergeShards(gcp.build('compute', 'v1'), storage, config, config_file,
+                         shards, ips, ssh_config)
+    print("The shard instances (%s) can be deleted with chips_automator_teardown.py" %
+          ", ".join("chips-auto-%s" % s['instance_name'] for s in shards))
+    return status
 
-    if transfer_path.endswith("/"):
-        chips_config['transfer_path'] = transfer_path
-    else:
-        chips_config['transfer_path'] = transfer_path + "/"
-    ##print(chips_config)
+def main():
+    usage = "USAGE: %prog -c [chips_automator config yaml] -u [google account username, e.g. taing] -k [google account key path, i.e. ~/.ssh/google_cloud_engine] [-p plan only]"
+    optparser = OptionParser(usage=usage)
+    optparser.add_option("-c", "--config", help="instance name")
+    optparser.add_option("-u", "--user", help="username")
+    optparser.add_option("-k", "--key_file", help="key file path")
+    optparser.add_option("-r", "--refresh_cache", action="store_true", default=False, help="drop the cached image/snapshot/instance look-ups and api discovery documents first")
+    optparser.add_option("-t", "--trace", help="record where the time goes and write it to this file (Chrome trace json, e.g. open in chrome://tracing)")
+    optparser.add_option("-p", "--plan", action="store_true", default=False, help="check the config (and chips.config.yaml) offline and print what would be launched--nothing touches GCP")
+    (options, args) = optparser.parse_args(sys.argv)
 
-    #WRITE this to hidden file .config.yaml
-    print("Setting up the config and metasheet...")
-    #prepend a random string to these files
-    salt=''.join(random.choice(string.ascii_lowercase) for i in range(6))
-    print("writing %s" % (".config.%s.yaml" % salt))
-    out = open(".config.%s.yaml" % salt,"w")
-    #NOTE: this writes the comments for the metasheet as well, but ignore it
-    ruamel.yaml.round_trip_dump(chips_config, out)
-    out.close()
-
-    # METASHEET.csv
-    # write the metasheet to .metasheet.csv
-    print("writing %s" % (".metasheet.%s.csv" % salt))
-    out = open(".metasheet.%s.csv" % salt,"w")
-    out.write("RunName,Treat1,Cont1,Treat2,Cont2\n")
-    for run in config['metasheet']:
-          treat1 = config['metasheet'][run]['treat1']
-          cont1 = config['metasheet'][run]['cont1']
-          treat2 = config['metasheet'][run]['treat2']
-          cont2 = config['metasheet'][run]['cont2']
-          ls = [run, treat1, cont1,treat2, cont2]
-          res = [str(i or '') for i in ls]
-          out.write("%s\n" % ','.join(res))
-    out.close()
-#------------------------------------------------------------------------------
-    #UPLOAD .config.yaml and .metasheet.csv
-    #NOTE: we are skip checking .ssh/known_hosts
-    #really should make this a fn
+    if options.refresh_cache:
+        cache.invalidate()
 
-    #upload chips automator config file as well
-    chips_auto_config_f = options.config.split("/")[-1] #Take out config fname
-    for f in [('config.yaml', ".config.%s.yaml" % salt),
-              ('metasheet.csv', ".metasheet.%s.csv" % salt),
-              (chips_auto_config_f, options.config)]:
-        (basename, fname) = f
-        cmd = ['scp', "-o", "StrictHostKeyChecking=no", "-o", "UserKnownHostsFile=/dev/null", '-i', options.key_file, "%s" % fname, "%s@%s:%s%s" % (options.user, ip_addr, "/mnt/ssd/chips/", basename)]
-        print(" ".join(cmd))
-        proc = subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-        (out, error) = proc.communicate()
-        if proc.returncode != 0:
-            print("Error %s:" % proc.returncode)
-            print(error)
-
-    #RUN
-    print("Running...")
-    #NOTE: _project and _bucket_path are not needed for local runs
-    (status, stdin, stderr) = ssh_conn.sendCommand("/home/taing/utils/chips_automator_run_local.sh %s %s %s" % (_project, normal_bucket_path, str(config['cores'])))
-    if stderr:
-        print(stderr)
+    if not options.config or not os.path.exists(options.config):
+        print("Error: missing or non-existent yaml configuration file")
+        optparser.print_help()
+        sys.exit(-1)
 
-    print("The instance %s is running at the following IP: %s" % (instance_name, ip_addr))
-    print("please log into this instance and to check-in on the run")
+    if options.plan:
+        config = loadConfig(options.config)
+        errors = validateConfig(config)
+        if errors:
+            print("ERROR: Please correct the automator config file:")
+            for e in errors:
+                print("  %s" % e)
+            sys.exit(-1)
+        printPlan(config, options.user)
+        return
+
+    if (not options.user or not options.key_file):
+        print("ERROR: missing user or google key path")
+        optparser.print_help()
+        sys.exit(-1)
+
+    if options.trace:
+        tracing.enable()
+    try:
+        config = loadConfig(options.config)
+        if int(config.get('shards') or 1) > 1:
+            launchShards(options.config, options.user, options.key_file, config)
+        else:
+            launch(options.config, options.user, options.key_file, config)
+    finally:
+        if options.trace:
+            tracing.save(options.trace)
+            tracing.printSummary()
+            print("Trace written to %s" % options.trace)
 
 if __name__=='__main__':
     main()
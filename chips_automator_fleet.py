@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+"""Len Taing 2019 (TGBTG)
+CHIPS automator fleet script- runs the chips automator for many automator
+config files at once
+"""
+
+import os
+import sys
+import time
+from optparse import OptionParser
+from multiprocessing.pool import ThreadPool
+try:
+    import queue
+except ImportError: #python2
+    import Queue as queue
+
+import gcp
+import disk
+import tracing
+import autosize
+import chips_automator
+
+#the regional quotas that a launch draws on
+_cpu_metrics = ['CPUS', 'N2_CPUS']
+_disk_metric = 'DISKS_TOTAL_GB'
+#data disk types which draw on a quota other than _disk_metric (the boot and
+#ref disks are always pd-standard)
+_disk_type_metrics = {'pd-balanced': 'SSD_TOTAL_GB',
+                      'pd-ssd': 'SSD_TOTAL_GB',
+                      'local-ssd': 'LOCAL_SSD_TOTAL_GB'}
+
+def getRequirements(compute, config, storage, source_objects=None):
+    """Given a parsed automator config, returns a dictionary of
+    {quota metric: amount} that the launch will use, i.e. the cores and the
+    total GB of its boot, data and ref disks (by disk type)
+    NOTE: the config is autosized in place (see autosize.apply), so the
+    launch runs with the same sizes that were admitted"""
+    _project = config.get("project", "cidc-biofx")
+    _image_name = config.get('image', 'chips-ver1-7a')
+    _image_family = config.get('image_family', 'chips')
+    chips_ref_snapshot = config.get('chips_ref_snapshot', 'chips-ref-ver1-0')
+
+    autosize.apply(config, storage, source_objects)
+    cores = int(chips_automator.getMachineType(config).split("-")[-1])
+    (image, snapshot) = disk.get_image_and_snapshot(compute, _image_name, _image_family, chips_ref_snapshot, _project)
+    disk_gb = int(image['diskSizeGb'])
+    if config.get('ref_disk_mode', 'snapshot') == 'snapshot':
+        #NOTE: shared/pool ref disks already exist
+        disk_gb += int(snapshot['diskSizeGb'])
+    data_gb = int(config['disk_size'])
+    if config.get('disk_type') == 'local-ssd':
+        data_gb = disk.local_ssd_gb * int(config.get('local_ssds') or -(-data_gb // disk.local_ssd_gb))
+
+    reqs = dict((m, cores) for m in _cpu_metrics)
+    reqs[_disk_metric] = disk_gb
+    data_metric = _disk_type_metrics.get(config.get('disk_type'), _disk_metric)
+    reqs[data_metric] = reqs.get(data_metric, 0) + data_gb
+    return reqs
+
+def getQuotas(compute, project, region):
+    """Returns a dictionary of {quota metric: available amount} for the
+    given region"""
+    response = compute.regions().get(project=project, region=region).execute()
+    return dict((q['metric'], q['limit'] - q['usage']) for q in response['quotas'])
+
+def fits(available, reserved, reqs):
+    """Checks whether reqs fit in the available quota after taking out what
+    is reserved by the launches that are still in flight"""
+    for m in reqs:
+        if m in available and reserved.get(m, 0) + reqs[m] > available[m]:
+            return False
+    return True
+
+def printStatusTable(runs):
+    """Prints the consolidated status of every run"""
+    print("%-40s %-32s %-10s %-16s %8s  %s" % ("config", "instance", "status", "ip", "secs", "message"))
+    for r in runs:
+        print("%-40s %-32s %-10s %-16s %8s  %s" % (r['config'], r['instance'] or '', r['status'], r['ip'] or '', "%.0f" % r['secs'] if r['secs'] else '', r['message'] or ''))
+
+def runFleet(config_files, user, key_file, max_concurrent=4):
+    """Launches the automator for each of the config files with at most
+    max_concurrent launches in flight.  Before admitting a launch, the
+    regional CPU and disk quotas are checked (taking into account the
+    launches still in flight); launches that don't fit stay queued until
+    an earlier launch finishes.  Launches that can never fit are skipped.
+    Sharded configs (shards > 1) are rejected: their shards have to be
+    launched, watched and merged as one (see chips_automator.launchShards)
+    RETURNS: a list of run status dictionaries (see printStatusTable)
+    """
+    compute = gcp.build('compute', 'v1')
+    storage = gcp.build('storage', 'v1')
+    runs = []
+    for f in config_files:
+        run = {'config': f, 'instance': None, 'status': 'QUEUED', 'ip': None,
+               'secs': None, 'message': None}
+        runs.append(run)
+        try:
+            config = chips_automator.loadConfig(f)
+            if int(config.get('shards') or 1) > 1:
+                #NOTE: the requirements and the launch here are one instance's
+                raise ValueError("sharded (shards: %s), run it with chips_automator.py -c %s" % (config['shards'], f))
+            run['instance'] = "-".join(['chips-auto', config['instance_name']])
+            _zone = config.get("zone", "us-east1-b")
+            run['quota_key'] = (config.get("project", "cidc-biofx"), _zone.rsplit("-", 1)[0])
+            #NOTE: the checked and sized config is what gets launched, so the
+            #inputs aren't looked up (or sized) twice
+            run['source_objects'] = chips_automator.checkConfig(config, storage)
+            run['reqs'] = getRequirements(compute, config, storage, run['source_objects'])
+            run['settings'] = config
+        except SystemExit:
+            #NOTE: checkConfig has printed what's wrong
+            run['status'] = 'FAILED'
+            run['message'] = "bad config, see above"
+        except Exception as e:
+            run['status'] = 'FAILED'
+            run['message'] = "bad config: %s" % e
+
+    def _launch(run):
+        t0 = time.time()
+        try:
+            (_, ip_addr) = chips_automator.launch(run['config'], user, key_file,
+                                                  config=run['settings'],
+                                                  source_objects=run['source_objects'])
+            done.put((run, ip_addr, None, time.time() - t0))
+        except (Exception, SystemExit) as e:
+            done.put((run, None, e, time.time() - t0))
+
+    done = queue.Queue()
+    pending = [r for r in runs if r['status'] == 'QUEUED']
+    reserved = {} #quota_key -> {metric: amount} held by in-flight launches
+    active = 0
+    pool = ThreadPool(max(1, max_concurrent))
+    try:
+        while pending or active:
+            quotas = {} #fresh quota numbers for each admission round
+            for run in list(pending):
+                if active >= max_concurrent:
+                    break
+                key = run['quota_key']
+                if key not in quotas:
+                    quotas[key] = getQuotas(compute, key[0], key[1])
+                held = reserved.setdefault(key, {})
+                if not fits(quotas[key], held, run['reqs']):
+                    continue
+                for m in run['reqs']:
+                    held[m] = held.get(m, 0) + run['reqs'][m]
+                pending.remove(run)
+                run['status'] = 'RUNNING'
+                print("Launching %s" % run['config'])
+                pool.apply_async(_launch, (run,))
+                active += 1
+
+            if not active:
+                #nothing in flight to free up quota--the rest can't fit
+                for run in pending:
+                    run['status'] = 'SKIPPED'
+                    run['message'] = "insufficient quota in %s" % run['quota_key'][1]
+                break
+
+            (run, ip_addr, err, secs) = done.get()
+            active -= 1
+            held = reserved[run['quota_key']]
+            for m in run['reqs']:
+                held[m] -= run['reqs'][m]
+            run['secs'] = secs
+            if err is None:
+                run['status'] = 'LAUNCHED'
+                run['ip'] = ip_addr
+            else:
+                run['status'] = 'FAILED'
+                run['message'] = str(err)
+            print("%s: %s" % (run['config'], run['status']))
+    finally:
+        pool.close()
+        pool.join()
+    return runs
+
+def main():
+    usage = "USAGE: %prog [-d config dir | -c config yaml -c config yaml ...] -u [google account username, e.g. taing] -k [google account key path, i.e. ~/.ssh/google_cloud_engine] -n [max concurrent launches]"
+    optparser = OptionParser(usage=usage)
+    optparser.add_option("-d", "--config_dir", help="directory of automator config yamls")
+    optparser.add_option("-c", "--config", action="append", default=[], help="automator config yaml (can be given multiple times)")
+    optparser.add_option("-u", "--user", help="username")
+    optparser.add_option("-k", "--key_file", help="key file path")
+    optparser.add_option("-n", "--max_concurrent", type="int", default=4, help="max number of concurrent launches (default: 4)")
+    optparser.add_option("-t", "--trace", help="record where the time goes and write it to this file (Chrome trace json, e.g. open in chrome://tracing)")
+    (options, args) = optparser.parse_args(sys.argv)
+
+    config_files = list(options.config)
+    if options.config_dir:
+        config_files.extend(sorted(os.path.join(options.config_dir, f)
+                                   for f in os.listdir(options.config_dir)
+                                   if f.endswith((".yaml", ".yml"))))
+
+    missing = [f for f in config_files if not os.path.exists(f)]
+    if not config_files or missing:
+        print("Error: missing or non-existent yaml configuration files %s" % ", ".join(missing))
+        optparser.print_help()
+        sys.exit(-1)
+
+    if (not options.user or not options.key_file):
+        print("ERROR: missing user or google key path")
+        optparser.print_help()
+        sys.exit(-1)
+
+    if options.trace:
+        tracing.enable()
+    try:
+        runs = runFleet(config_files, options.user, options.key_file, options.max_concurrent)
+    finally:
+        if options.trace:
+            tracing.save(options.trace)
+            tracing.printSummary()
+            print("Trace written to %s" % options.trace)
+    printStatusTable(runs)
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+"""Len Taing 2019 (TGBTG)
+CHIPS automator ref disk script- lists, pre-fills and cleans up the shared
+and pooled reference disks of a chips reference snapshot (see the
+ref_disk_mode automator config option)
+"""
+
+import sys
+import time
+from optparse import OptionParser
+
+import gcp
+import disk
+
+def printRefDisks(compute, snapshotName, project, zone):
+    """Prints the snapshot's ref disks with their users, i.e. the runs that
+    have them attached"""
+    now = time.time()
+    print("%-44s %-7s %-9s %-7s %s" % ("disk", "mode", "status", "in use", "users"))
+    for mode in ['shared', 'pool']:
+        for d in disk.find_ref_disks(compute, snapshotName, mode, project, zone):
+            users = [u.split("/")[-1] for u in d.get('users', [])]
+            in_use = "no" if disk.is_unused(d, now) else ("yes" if users else "claimed")
+            print("%-44s %-7s %-9s %-7s %s" % (d['name'], mode, d['status'], in_use, ", ".join(users)))
+
+def main():
+    usage = "USAGE: %prog -s [chips ref snapshot, e.g. chips-ref-ver1-0] [-f pool size | -c [-k keep]]"
+    optparser = OptionParser(usage=usage)
+    optparser.add_option("-s", "--snapshot", help="chips reference snapshot")
+    optparser.add_option("-p", "--project", default="cidc-biofx", help="google project")
+    optparser.add_option("-z", "--zone", default="us-east1-b", help="zone")
+    optparser.add_option("-f", "--fill", type="int", help="restore pool disks until there are this many unused ones")
+    optparser.add_option("-c", "--cleanup", action="store_true", default=False, help="delete the unused ref disks (see -k)")
+    optparser.add_option("-k", "--keep", type="int", default=0, help="with -c, the number of unused pool disks to keep (default: 0)")
+    (options, args) = optparser.parse_args(sys.argv)
+
+    if not options.snapshot:
+        print("ERROR: a chips reference snapshot is required")
+        optparser.print_help()
+        sys.exit(-1)
+
+    compute = gcp.build('compute', 'v1')
+    if options.fill:
+        snapshotLink = disk.get_snapshot_link(compute, options.snapshot, options.project)
+        names = disk.fill_ref_pool(compute, options.snapshot, snapshotLink,
+                                   options.fill, options.project, options.zone)
+        print("Restoring %s new pool disks: %s" % (len(names), ", ".join(names)))
+    if options.cleanup:
+        names = disk.cleanup_ref_disks(compute, options.snapshot, options.project,
+                                       options.zone, options.keep)
+        print("Deleted %s unused ref disks: %s" % (len(names), ", ".join(names)))
+    printRefDisks(compute, options.snapshot, options.project, options.zone)
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""Len Taing 2019 (TGBTG)
+CHIPS automator teardown script- deletes the instances of one or more runs
+(or of every run) along with their orphaned data and ref disks
+"""
+
+import os
+import sys
+from optparse import OptionParser
+
+import gcp
+import disk
+import instance
+import chips_automator
+
+_prefix = 'chips-auto-'
+
+def nameFilters(names=None):
+    """Returns the (instance filter, disk filter) for the given run instance
+    names--or for every chips-auto-* instance if none are given
+    NOTE: regex filters (eq) can't be combined with other terms"""
+    if not names:
+        return ("name eq %s.*" % _prefix, "name eq %s.*" % _prefix)
+    names = "|".join(sorted(names))
+    return ("name eq (%s)" % names, "name eq (%s)(-disk|-ref-disk)?" % names)
+
+def findDisks(compute, project, zone, disk_filter, doomed_links=()):
+    """Returns the run disks which aren't in use by anything but the doomed
+    instances (shared/pool ref disks are never included)"""
+    return [d for d in disk.find_disks(compute, project, zone, disk_filter)
+            if not disk.is_ref_disk(d)
+            and set(d.get('users', [])) <= set(doomed_links)]
+
+def deleteAll(compute, project, kind, resources):
+    """Deletes the instances or disks (kind) in one batched call and then
+    waits on all of the operations together
+    RETURNS: the names of the deleted resources"""
+    if not resources:
+        return []
+    collection = compute.instances() if kind == 'instances' else compute.disks()
+    batch = gcp.Batch(compute)
+    zones = {}
+    for r in resources:
+        zone = r['zone'].split("/")[-1]
+        zones[r['name']] = zone
+        if kind == 'instances':
+            batch.add(r['name'], collection.delete(project=project, zone=zone, instance=r['name']))
+        else:
+            batch.add(r['name'], collection.delete(project=project, zone=zone, disk=r['name']))
+    try:
+        operations = batch.execute()
+    except gcp.BatchError as e:
+        for name in sorted(e.errors):
+            print("Error deleting %s: %s" % (name, e.errors[name]))
+        operations = e.responses
+
+    deleted = []
+    try:
+        for ((zone, op), result) in instance.wait_for_zone_operations(
+                compute, project, [(zones[n], operations[n]['name']) for n in operations]):
+            deleted.append(result['targetLink'].split("/")[-1])
+    except instance.OperationError as e:
+        print("Error: %s" % e)
+    if kind == 'instances':
+        for name in deleted:
+            instance.forget_instance(name, project)
+    return sorted(deleted)
+
+def teardown(compute, project, zone=None, names=None, dry_run=False):
+    """Deletes the run instances (see nameFilters) all at once and then
+    their disks that are left over, i.e. that didn't go with the instance
+    or were never attached
+    RETURNS: (deleted instance names, deleted disk names)"""
+    (instance_filter, disk_filter) = nameFilters(names)
+    instances = list(instance.find_instances(compute, project, zone, instance_filter))
+    if dry_run:
+        links = [i['selfLink'] for i in instances]
+        disks = findDisks(compute, project, zone, disk_filter, links)
+        print("Would delete %s instances: %s" % (len(instances), ", ".join(i['name'] for i in instances)))
+        print("Would delete %s disks (unless they go with their instance): %s" % (len(disks), ", ".join(d['name'] for d in disks)))
+        return ([], [])
+
+    print("Deleting %s instances..." % len(instances))
+    deleted_instances = deleteAll(compute, project, 'instances', instances)
+    #NOTE: listed afterwards so the auto-deleted disks are already gone
+    disks = findDisks(compute, project, zone, disk_filter)
+    print("Deleting %s disks..." % len(disks))
+    deleted_disks = deleteAll(compute, project, 'disks', disks)
+    return (deleted_instances, deleted_disks)
+
+def main():
+    usage = "USAGE: %prog [-c config yaml -c config yaml ... | -d config dir | -a] [-n]"
+    optparser = OptionParser(usage=usage)
+    optparser.add_option("-c", "--config", action="append", default=[], help="automator config yaml of the run to tear down (can be given multiple times)")
+    optparser.add_option("-d", "--config_dir", help="tear down the runs of every automator config yaml in this directory, e.g. a fleet")
+    optparser.add_option("-a", "--all", action="store_true", default=False, help="tear down EVERY chips-auto-* instance and disk")
+    optparser.add_option("-p", "--project", default="cidc-biofx", help="google project")
+    optparser.add_option("-z", "--zone", help="zone (default: every zone)")
+    optparser.add_option("-n", "--dry_run", action="store_true", default=False, help="only list what would be deleted")
+    (options, args) = optparser.parse_args(sys.argv)
+
+    config_files = list(options.config)
+    if options.config_dir:
+        config_files.extend(sorted(os.path.join(options.config_dir, f)
+                                   for f in os.listdir(options.config_dir)
+                                   if f.endswith((".yaml", ".yml"))))
+    if not config_files and not options.all:
+        print("ERROR: the runs' config files (or -a) are required")
+        optparser.print_help()
+        sys.exit(-1)
+
+    #NOTE: sharded runs have an instance per shard
+    names = [n for f in config_files for n in chips_automator.runInstanceNames(chips_automator.loadConfig(f))]
+    compute = gcp.build('compute', 'v1')
+    (instances, disks) = teardown(compute, options.project, options.zone,
+                                  None if options.all else names,
+                                  options.dry_run)
+    if not options.dry_run:
+        print("Deleted %s instances: %s" % (len(instances), ", ".join(instances)))
+        print("Deleted %s disks: %s" % (len(disks), ", ".join(disks)))
+
+if __name__=='__main__':
+    main()
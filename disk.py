@@ -5,16 +5,51 @@ CHIPS automator - Google Cloud API wrapper for disk operations
 import os
 import sys
 import time
+import random
 from optparse import OptionParser
 
-import googleapiclient.discovery
-
+import gcp
+import cache
+import instance
 from instance import wait_for_operation
 
-def create(compute, disk_name, size, project="cidc-biofx", zone="us-east1-b"):
+#snapshots are immutable, so their look-ups are cached for a long while
+_snapshot_ttl = 7 * 24 * 60 * 60
+
+#persistent disk types, e.g. for the data disk--only pd-extreme and
+#hyperdisks take provisioned iops/throughput
+disk_types = ['pd-standard', 'pd-balanced', 'pd-ssd', 'pd-extreme',
+              'hyperdisk-balanced', 'hyperdisk-throughput', 'hyperdisk-extreme']
+#the provisioned performance that each of those disk types takes
+provisioned = {'pd-extreme': ['iops'],
+               'hyperdisk-balanced': ['iops', 'throughput'],
+               'hyperdisk-throughput': ['throughput'],
+               'hyperdisk-extreme': ['iops']}
+#local ssds come in fixed sizes and are attached by count
+local_ssd_gb = 375
+
+def disk_type_link(disk_type, zone):
+    """Returns the (partial) url of the disk type, e.g. pd-ssd in us-east1-b"""
+    return "zones/%s/diskTypes/%s" % (zone, disk_type)
+
+def _performance(params, type_key, disk_type, iops, throughput, zone):
+    """Adds the disk type (as type_key, i.e. 'type' in a disk insert body,
+    'diskType' in initializeParams) and the provisioned iops/throughput
+    (if any) to params"""
+    if disk_type:
+        params[type_key] = disk_type_link(disk_type, zone)
+    if iops:
+        params['provisionedIops'] = int(iops)
+    if throughput:
+        params['provisionedThroughput'] = int(throughput)
+    return params
+
+def create(compute, disk_name, size, project="cidc-biofx", zone="us-east1-b", disk_type=None, iops=None, throughput=None):
     """Given a XX, YYY...
     Tries to create an disk according to the given params using
-    googeapi methods"""
+    googeapi methods
+    disk_type is one of disk_types (default: pd-standard) and iops/
+    throughput are the provisioned iops and MB/s, where the type takes them"""
 
     disk_config = {'name': "", "sizeGb": "", "zone": ""}
 
@@ -22,6 +57,7 @@ def create(compute, disk_name, size, project="cidc-biofx", zone="us-east1-b"):
     disk_config['name'] = disk_name
     disk_config['sizeGb'] = size
     disk_config['zone'] = zone
+    _performance(disk_config, 'type', disk_type, iops, throughput, zone)
     #print(disk_config)
 
     #create disk
@@ -33,16 +69,58 @@ def create(compute, disk_name, size, project="cidc-biofx", zone="us-east1-b"):
     #print(operation)
     return operation
 
+def get_snapshot(compute, snapshotName, project="cidc-biofx"):
+    """Returns {'selfLink', 'diskSizeGb'} of the given snapshot
+    The answer is kept in the on-disk cache, see _snapshot_ttl"""
+    key = "%s/%s" % (project, snapshotName)
+    snapshot = cache.lookup("snapshots", key, _snapshot_ttl)
+    if snapshot:
+        return snapshot
+
+    operation = compute.snapshots().get(
+        project=project,
+        snapshot=snapshotName).execute()
+    #print(operation)
+    return _cache_snapshot(snapshotName, project, operation)
+
+def _cache_snapshot(snapshotName, project, response):
+    snapshot = {'selfLink': response['selfLink'],
+                'diskSizeGb': response['diskSizeGb']}
+    cache.store("snapshots", "%s/%s" % (project, snapshotName), snapshot)
+    return snapshot
+
+def get_image_and_snapshot(compute, image_name, image_family, snapshotName, project="cidc-biofx"):
+    """Looks up the boot image (see instance.get_image) and the ref snapshot
+    (see get_snapshot) for a launch; whichever isn't already cached is
+    fetched in ONE batched api round trip
+    RETURNS: (image, snapshot), each a {'selfLink', 'diskSizeGb'}"""
+    image = instance.cached_image(image_name, image_family, project)
+    snapshot = cache.lookup("snapshots", "%s/%s" % (project, snapshotName), _snapshot_ttl)
+    if image and snapshot:
+        return (image, snapshot)
+
+    batch = gcp.Batch(compute)
+    if not image:
+        batch.add('image', instance._image_request(compute, image_name, image_family, project))
+    if not snapshot:
+        batch.add('snapshot', compute.snapshots().get(project=project, snapshot=snapshotName))
+    responses = batch.execute()
+    if not image:
+        image = instance.cache_image(image_name, image_family, project, responses['image'])
+    if not snapshot:
+        snapshot = _cache_snapshot(snapshotName, project, responses['snapshot'])
+    return (image, snapshot)
+
+def get_snapshot_link(compute, snapshotName, project="cidc-biofx"):
+    """Returns the selfLink of the given snapshot, see get_snapshot"""
+    return get_snapshot(compute, snapshotName, project)['selfLink']
+
 def createFromSnapshot(compute, disk_name, snapshotName, project="cidc-biofx", zone="us-east1-b"):
     """Given a disk_name and a name of a valid snapshot
     Tries to create an disk according to the given params using
     googeapi methods"""
     #First look up snapshot to get snapshotId
-    operation = compute.snapshots().get(
-        project=project,
-        snapshot=snapshotName).execute()
-    #print(operation)
-    snapshotId = operation['selfLink']
+    snapshotId = get_snapshot_link(compute, snapshotName, project)
 
     #Then create disk based on snapshotId
     disk_config = {'name': disk_name, 'sourceSnapshot': snapshotId,
@@ -56,6 +134,34 @@ def createFromSnapshot(compute, disk_name, snapshotName, project="cidc-biofx", z
     #print(operation)
     return operation
 
+def attached_disk_config(disk_name, device_name, size=None, snapshotLink=None, disk_type=None, iops=None, throughput=None, zone=None, auto_delete=False):
+    """Returns an attachedDisk body for instance.create which creates a new
+    disk, empty and of the given size (in Gb) OR restored from the given
+    snapshot selfLink, along with the instance--no separate disk insert or
+    attach calls are needed
+    disk_type/iops/throughput are as in create (the zone is needed for the
+    disk type); auto_delete makes the disk go with the instance"""
+    init_params = {'diskName': disk_name}
+    if snapshotLink:
+        init_params['sourceSnapshot'] = snapshotLink
+    else:
+        init_params['diskSizeGb'] = size
+    _performance(init_params, 'diskType', disk_type, iops, throughput, zone)
+    return {'deviceName': device_name,
+            'autoDelete': auto_delete,
+            'initializeParams': init_params}
+
+def local_ssd_configs(count, zone):
+    """Returns the attachedDisk bodies for count local NVMe ssds
+    (local_ssd_gb each) for instance.create
+    NOTE: local ssds are scratch space--they go with the instance"""
+    return [{'type': 'SCRATCH',
+             'interface': 'NVME',
+             'autoDelete': True,
+             'deviceName': "local-ssd-%s" % i,
+             'initializeParams': {'diskType': disk_type_link('local-ssd', zone)}}
+            for i in range(count)]
+
 def delete(compute, disk_name, project="cidc-biofx", zone="us-east1-b"):
     #based on From google tutorial!
     operation = compute.disks().delete(
@@ -66,7 +172,31 @@ def delete(compute, disk_name, project="cidc-biofx", zone="us-east1-b"):
     #print(operation)
     return operation
 
-def get_disk(comput, project, zone, disk_name):
+def find_disks(compute, project, zone=None, filter=None):
+    """Generator over the disks in the given zone--or in EVERY zone if no
+    zone is given--that match the optional server-side filter, see
+    instance.find_instances"""
+    page_token = None
+    while True:
+        if zone:
+            result = compute.disks().list(project=project, zone=zone,
+                                          filter=filter,
+                                          pageToken=page_token).execute()
+            items = result.get('items', [])
+        else:
+            result = compute.disks().aggregatedList(project=project,
+                                                    filter=filter,
+                                                    pageToken=page_token).execute()
+            items = [d for scope in result.get('items', {}).values()
+                     for d in scope.get('disks', [])]
+        for d in items:
+            yield d
+
+        page_token = result.get('nextPageToken')
+        if not page_token:
+            break
+
+def get_disk(compute, project, zone, disk_name):
     """Get the disk resource"""
     operation = compute.disks().get(
         project=project,
@@ -75,13 +205,9 @@ def get_disk(comput, project, zone, disk_name):
     return operation
 
 def attach_disk(compute, instance_name, disk_name, project="cidc-biofx", zone="us-east1-b"):
-
-    #get the disk resource
-    operation = compute.disks().get(
-        project=project,
-        zone=zone,
-        disk=disk_name).execute()
-    diskLink = operation['selfLink']
+    #NOTE: the partial url of the disk is a valid source, so there's no need
+    #to get the disk resource just for its selfLink
+    diskLink = "projects/%s/zones/%s/disks/%s" % (project, zone, disk_name)
     attached_disk_body = {'source':diskLink}
 
     #attach disk
@@ -94,35 +220,191 @@ def attach_disk(compute, instance_name, disk_name, project="cidc-biofx", zone="u
     #print(operation)
     return operation
 
-#TODO:
+###############################################################################
+# Reference disks: instead of restoring the (read-only) reference snapshot
+# into a new disk for every run, runs can share ONE read-only ref disk per
+# snapshot ('shared' mode) or take a pre-hydrated disk from a pool of them
+# ('pool' mode).  Both kinds are labelled with their snapshot and mode, and
+# are never auto-deleted.  A disk's attachments (its 'users') are its
+# reference count: a ref disk with no users is unused.
+###############################################################################
+ref_modes = ['snapshot', 'shared', 'pool']
+_ref_label = 'chips-ref'
+_ref_mode_label = 'chips-ref-mode'
+#pool disks are claimed by stamping this label (epoch secs) on them, which
+#only one launch can do b/c of the label fingerprint; a claim that isn't
+#followed by an attach within _claim_ttl secs lapses
+_ref_claim_label = 'chips-ref-claimed'
+_claim_ttl = 30 * 60
+
+def _ref_labels(snapshotName, mode, claimed=None):
+    labels = {_ref_label: snapshotName, _ref_mode_label: mode}
+    if claimed:
+        labels[_ref_claim_label] = str(int(claimed))
+    return labels
+
+def shared_ref_disk_name(snapshotName):
+    return "%s-shared" % snapshotName
+
+def disk_link(disk_name, project, zone):
+    """Returns the partial url of the disk, e.g. for an attachedDisk source"""
+    return "projects/%s/zones/%s/disks/%s" % (project, zone, disk_name)
+
+def existing_disk_config(disk_name, device_name, project, zone, read_only=False, auto_delete=False):
+    """Returns an attachedDisk body for instance.create (or an attachDisk
+    call) which attaches an EXISTING disk (read-only disks can be attached
+    to many instances)"""
+    return {'source': disk_link(disk_name, project, zone),
+            'deviceName': device_name,
+            'mode': 'READ_ONLY' if read_only else 'READ_WRITE',
+            'autoDelete': auto_delete}
+
+def find_ref_disks(compute, snapshotName, mode, project="cidc-biofx", zone="us-east1-b"):
+    """Returns the ref disk resources of the given snapshot and mode"""
+    disk_filter = '(labels.%s = "%s") (labels.%s = "%s")' % (_ref_label, snapshotName, _ref_mode_label, mode)
+    return list(find_disks(compute, project, zone, disk_filter))
+
+def is_ref_disk(d):
+    """Shared and pool ref disks are labelled, see _ref_labels"""
+    return _ref_label in d.get('labels', {})
+
+def is_unused(ref_disk, now=None):
+    """A ref disk is unused if nothing is attached to it and it isn't
+    freshly claimed"""
+    claimed = int(ref_disk.get('labels', {}).get(_ref_claim_label) or 0)
+    return not ref_disk.get('users') and (now or time.time()) - claimed > _claim_ttl
+
+def create_ref_disk(compute, disk_name, snapshotLink, snapshotName, mode, project="cidc-biofx", zone="us-east1-b", claimed=None, wait=True):
+    """Restores the snapshot into a new (labelled) ref disk
+    RETURNS: the insert operation"""
+    operation = compute.disks().insert(
+        project=project,
+        zone=zone,
+        body={'name': disk_name,
+              'sourceSnapshot': snapshotLink,
+              'labels': _ref_labels(snapshotName, mode, claimed)}).execute()
+    if wait:
+        wait_for_operation(compute, project, zone, operation['name'])
+    return operation
+
+def get_shared_ref_disk(compute, snapshotName, snapshotLink, project="cidc-biofx", zone="us-east1-b"):
+    """Returns the name of the snapshot's shared (read-only) ref disk,
+    restoring it from the snapshot first if it doesn't exist yet (once--
+    every later run just attaches it)"""
+    from googleapiclient.errors import HttpError
+    disk_name = shared_ref_disk_name(snapshotName)
+    try:
+        ref_disk = get_disk(compute, project, zone, disk_name)
+    except HttpError as e:
+        if e.resp.status != 404:
+            raise
+        print("Creating the shared reference disk %s..." % disk_name)
+        try:
+            create_ref_disk(compute, disk_name, snapshotLink, snapshotName,
+                            'shared', project, zone)
+            return disk_name
+        except HttpError as e:
+            #another launch is creating it--wait for it below
+            if e.resp.status != 409:
+                raise
+        ref_disk = get_disk(compute, project, zone, disk_name)
+
+    delay = 1
+    while ref_disk['status'] != 'READY':
+        if ref_disk['status'] not in ('CREATING', 'RESTORING'):
+            raise Exception("The shared reference disk %s is %s" % (disk_name, ref_disk['status']))
+        time.sleep(delay)
+        delay = min(delay * 2, 16)
+        ref_disk = get_disk(compute, project, zone, disk_name)
+    return disk_name
+
+def fill_ref_pool(compute, snapshotName, snapshotLink, pool_size, project="cidc-biofx", zone="us-east1-b", ref_disks=None):
+    """Starts restoring enough new pool disks that there are pool_size
+    unused ones (the operations are NOT waited on, the disks hydrate in the
+    background)
+    RETURNS: the names of the new disks"""
+    if ref_disks is None:
+        ref_disks = find_ref_disks(compute, snapshotName, 'pool', project, zone)
+    unused = len([d for d in ref_disks if is_unused(d)])
+    names = []
+    for i in range(pool_size - unused):
+        disk_name = "%s-pool-%s" % (snapshotName, "%08x" % random.getrandbits(32))
+        create_ref_disk(compute, disk_name, snapshotLink, snapshotName, 'pool',
+                        project, zone, wait=False)
+        names.append(disk_name)
+    return names
+
+def claim_pool_ref_disk(compute, snapshotName, snapshotLink, pool_size=2, project="cidc-biofx", zone="us-east1-b"):
+    """Claims an unused, hydrated disk from the snapshot's ref disk pool (or
+    restores a new one if there are none) and tops the pool back up to
+    pool_size unused disks
+    RETURNS: the name of the claimed disk, which the caller then attaches"""
+    from googleapiclient.errors import HttpError
+    ref_disks = find_ref_disks(compute, snapshotName, 'pool', project, zone)
+    claimed = None
+    for d in ref_disks:
+        if d['status'] != 'READY' or not is_unused(d):
+            continue
+        try:
+            #NOTE: the fingerprint makes this fail if another launch has
+            #claimed the disk since we listed it
+            operation = compute.disks().setLabels(
+                project=project,
+                zone=zone,
+                resource=d['name'],
+                body={'labels': _ref_labels(snapshotName, 'pool', time.time()),
+                      'labelFingerprint': d['labelFingerprint']}).execute()
+            wait_for_operation(compute, project, zone, operation['name'])
+            claimed = d['name']
+            break
+        except HttpError as e:
+            if e.resp.status not in (409, 412):
+                raise
+    if claimed:
+        print("Claimed the reference disk %s from the pool" % claimed)
+        ref_disks = [d for d in ref_disks if d['name'] != claimed]
+    fill_ref_pool(compute, snapshotName, snapshotLink, pool_size, project, zone, ref_disks)
+
+    if not claimed:
+        claimed = "%s-pool-%s" % (snapshotName, "%08x" % random.getrandbits(32))
+        print("No unused reference disk in the pool, creating %s..." % claimed)
+        create_ref_disk(compute, claimed, snapshotLink, snapshotName, 'pool',
+                        project, zone, claimed=time.time())
+    return claimed
+
+def cleanup_ref_disks(compute, snapshotName, project="cidc-biofx", zone="us-east1-b", keep=0):
+    """Deletes the snapshot's unused ref disks: the shared disk (if no run is
+    using it) and all but keep of the unused pool disks
+    RETURNS: the names of the deleted disks"""
+    doomed = [d['name'] for d in find_ref_disks(compute, snapshotName, 'shared', project, zone)
+              if not d.get('users')]
+    unused = [d['name'] for d in find_ref_disks(compute, snapshotName, 'pool', project, zone)
+              if is_unused(d)]
+    doomed.extend(unused[keep:])
+    operations = [compute.disks().delete(project=project, zone=zone, disk=n).execute()['name']
+                  for n in doomed]
+    for _ in instance.wait_for_operations(compute, project, zone, operations):
+        pass
+    return doomed
+
 def detach_disk(compute, instance_name, disk_name, project="cidc-biofx", zone="us-east1-b"):
-    print("detach_disk is not implemented!")
-    return
-    # #get the disk resource
-    # operation = compute.disks().get(
-    #     project=project,
-    #     zone=zone,
-    #     disk=disk_name).execute()
-    # #print(operation)
-    # #sys.exit()
-    # diskLink = operation['selfLink']
-
-    # #attached_disk_body = {'source':diskLink}
-    # attached_disk_body = {"source": "zones/%s/disks/%s" % (zone, disk_name)}
-
-    # #attach disk
-    # operation = compute.instances().detachDisk(
-    #     project=project,
-    #     zone=zone,
-    #     instance=instance_name,
-    #     #body=attached_disk_body).execute()
-    #     deviceName='wes-auto-disk').execute()
-    # wait_for_operation(compute, project, zone, operation['name'])
-    # #print(operation)
-    # return operation
+    """Detaches the named disk from the instance (by the device name it is
+    attached as)
+    RETURNS: the operation, or None if the disk isn't attached"""
+    device_name = instance.get_disk_device_name(compute, instance_name, project, zone, disk_name)
+    if not device_name:
+        return None
+    operation = compute.instances().detachDisk(
+        project=project,
+        zone=zone,
+        instance=instance_name,
+        deviceName=device_name).execute()
+    wait_for_operation(compute, project, zone, operation['name'])
+    #print(operation)
+    return operation
 
 def main():
-    compute = googleapiclient.discovery.build('compute', 'v1')
+    compute = gcp.build('compute', 'v1')
     #TODO: update this!
     usage = "USAGE: %prog -n [disk name] -s [disk size in Gb] -z [zone (us-east-1b]"
     optparser = OptionParser(usage=usage)
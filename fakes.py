@@ -0,0 +1,929 @@
+"""Len Taing 2019 (TGBTG)
+CHIPS automator - in-process stand-ins for the Compute API, the Storage API
+(plus a fake gsutil) and the chips instance's ssh server, so that the
+automator can be run end to end without touching GCP (see benchmark.py)
+NOTE: the fakes only implement the calls and fields that the automator uses
+"""
+
+import os
+import re
+import sys
+import copy
+import time
+import zlib
+import base64
+import socket
+import struct
+import hashlib
+import logging
+import threading
+import subprocess
+
+import gcp
+import tracing
+
+###############################################################################
+# Compute API
+###############################################################################
+
+#secs that each kind of call/operation takes, see FakeCompute
+_default_latencies = {'api': 0.05,      #the http round trip of every call
+                      'instance': 15.0, #instances().insert
+                      'disk': 5.0,      #disks().insert
+                      'attach': 2.0,    #attachDisk/detachDisk
+                      'start': 10.0,    #instances().start
+                      'stop': 10.0,     #instances().stop
+                      'delete': 10.0,   #instances()/disks().delete
+                      'default': 1.0,   #any other mutation
+                      'wait_max': 120.0}#zoneOperations().wait long-poll cap
+
+#filter terms that the fake understands, e.g. name = "foo" or
+#labels.chips-run = "bar"--or ONE (legacy) regex term, e.g. name eq foo-.*
+_filter_term = re.compile(r'([\w.\-]+)\s*=\s*"([^"]*)"')
+_filter_regex = re.compile(r'^\s*([\w.\-]+)\s+(eq|ne)\s+(.+?)\s*$')
+
+def http_error(status, reason):
+    """Returns a googleapiclient HttpError with the given http status"""
+    import httplib2
+    from googleapiclient.errors import HttpError
+    return HttpError(httplib2.Response({'status': status, 'reason': reason}),
+                     reason.encode("utf-8"))
+
+class FakeRequest(object):
+    """An api request: when executed, waits latency secs (the round trip)
+    and then returns fn()"""
+    def __init__(self, fn, latency=0, name="request"):
+        self.fn = fn
+        self.latency = latency
+        self.name = name
+        self.headers = {}
+
+    def execute(self, num_retries=0):
+        gcp.count_request()
+        with tracing.span(self.name, "api"):
+            if self.latency:
+                time.sleep(self.latency)
+            return self.fn()
+
+class FakeBatch(object):
+    """new_batch_http_request() stand-in: ONE round trip for every request"""
+    def __init__(self, latency, callback=None):
+        self.latency = latency
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        self.requests.append((request_id, request, callback or self.callback))
+
+    def execute(self):
+        #NOTE: gcp.Batch counts (and traces) the batch itself
+        if self.latency:
+            time.sleep(self.latency)
+        for (request_id, request, callback) in self.requests:
+            try:
+                (response, exception) = (request.fn(), None)
+            except Exception as e:
+                (response, exception) = (None, e)
+            callback(request_id, response, exception)
+
+class _Collection(object):
+    """Base of the fake api collections, e.g. compute.instances()"""
+    def __init__(self, compute):
+        self.compute = compute
+
+    def _request(self, fn):
+        #NOTE: named after the calling method, e.g. compute.instances.insert
+        name = "compute.%s.%s" % (self.__class__.__name__.strip("_").lower(),
+                                  sys._getframe(1).f_code.co_name)
+        return FakeRequest(fn, self.compute.latencies['api'], name)
+
+class FakeCompute(object):
+    """Compute API stand-in which keeps instances, disks and operations in
+    memory.  Mutations return a zone operation that is DONE after the
+    latency configured for its kind (see _default_latencies) and
+    zoneOperations().wait long-polls on it just like the real api.
+    Instances get ip as both their internal and external ip, e.g. the
+    address of a FakeSSHServer"""
+    def __init__(self, latencies=None, ip="127.0.0.1", image_size=10, snapshot_size=100, quotas=None):
+        self.latencies = dict(_default_latencies)
+        self.latencies.update(latencies or {})
+        self.ip = ip
+        self.image_size = image_size
+        self.snapshot_size = snapshot_size
+        self.quotas = quotas or {'CPUS': 2400, 'N2_CPUS': 2400, 'DISKS_TOTAL_GB': 409600}
+        self.lock = threading.RLock()
+        self.instances_ = {} #(project, zone, name) -> instance resource
+        self.disks_ = {}     #(project, zone, name) -> disk resource
+        self.operations = {} #name -> (operation resource, done at, apply fn)
+        self.ids = iter(range(1000000000000, 2000000000000))
+
+    #--- the api collections
+    def instances(self):
+        return _Instances(self)
+
+    def disks(self):
+        return _Disks(self)
+
+    def images(self):
+        return _Images(self)
+
+    def snapshots(self):
+        return _Snapshots(self)
+
+    def zoneOperations(self):
+        return _ZoneOperations(self)
+
+    def regions(self):
+        return _Regions(self)
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self.latencies['api'], callback)
+
+    #--- helpers
+    def _next_id(self):
+        with self.lock:
+            return str(next(self.ids))
+
+    def _operation(self, kind, project, zone, target_link, target_id, apply_fn=None):
+        """Registers a zone operation that takes the latency of its kind;
+        apply_fn (if any) is called when the operation finishes"""
+        latency = self.latencies.get(kind, self.latencies['default'])
+        op = {'kind': 'compute#operation',
+              'name': "operation-%s" % self._next_id(),
+              'zone': "projects/%s/zones/%s" % (project, zone),
+              'operationType': kind,
+              'targetLink': target_link,
+              'targetId': target_id,
+              'insertTime': time.strftime("%Y-%m-%dT%H:%M:%S"),
+              'status': 'RUNNING'}
+        with self.lock:
+            self.operations[op['name']] = (op, time.time() + latency, apply_fn)
+        return dict(op)
+
+    def preempt(self, project, zone, name):
+        """Simulates the preemption of a spot instance: it is stopped (its
+        disks stay attached) and a compute.instances.preempted operation is
+        recorded, like the real api"""
+        with self.lock:
+            inst = self._instance(project, zone, name)
+            if inst.get('scheduling', {}).get('provisioningModel') != 'SPOT':
+                raise http_error(400, "The resource 'instances/%s' is not a spot instance" % name)
+            inst['status'] = 'TERMINATED'
+            op = self._operation('compute.instances.preempted', project, zone,
+                                 inst['selfLink'], inst['id'])
+            self.operations[op['name']][0]['status'] = 'DONE'
+
+    def _finish(self, name):
+        """Returns the operation (marking it DONE if its time has come)"""
+        with self.lock:
+            (op, done_at, apply_fn) = self.operations[name]
+            if op['status'] != 'DONE' and time.time() >= done_at:
+                op['status'] = 'DONE'
+                if apply_fn:
+                    try:
+                        apply_fn()
+                    except Exception as e:
+                        op['error'] = {'errors': [{'message': str(e)}]}
+            return (dict(op), done_at)
+
+    def _link(self, project, zone, kind, name):
+        return "https://www.googleapis.com/compute/v1/projects/%s/zones/%s/%s/%s" % (project, zone, kind, name)
+
+    def _disk_name(self, source):
+        """disk name from its (partial or full) url"""
+        return source.rstrip("/").split("/")[-1]
+
+    def _new_disk(self, project, zone, body):
+        d = {'kind': 'compute#disk',
+             'id': self._next_id(),
+             'name': body['name'],
+             'zone': "projects/%s/zones/%s" % (project, zone),
+             'sizeGb': str(body.get('sizeGb') or self.snapshot_size),
+             'type': body.get('type', 'pd-standard'),
+             'status': 'READY',
+             'labels': dict(body.get('labels', {})),
+             'labelFingerprint': self._next_id(),
+             'users': [],
+             'selfLink': self._link(project, zone, 'disks', body['name'])}
+        for k in ['sourceSnapshot', 'sourceImage', 'provisionedIops',
+                  'provisionedThroughput']:
+            if body.get(k):
+                d[k] = body[k]
+        return d
+
+    def _check_attach(self, d, mode):
+        """A disk can be attached READ_WRITE to one instance or READ_ONLY to
+        many"""
+        if d['status'] != 'READY':
+            raise http_error(400, "The disk resource '%s' is not ready" % d['name'])
+        modes = [ad['mode'] for i in self.instances_.values() for ad in i['disks']
+                 if ad.get('source') == d['selfLink']]
+        if modes and (mode == 'READ_WRITE' or 'READ_WRITE' in modes):
+            raise http_error(400, "The disk resource '%s' is already being used by '%s'" % (d['name'], d['users'][0]))
+
+    def _instance(self, project, zone, name):
+        key = (project, zone, str(name))
+        if key not in self.instances_:
+            #look up by id
+            for k in self.instances_:
+                if k[:2] == (project, zone) and self.instances_[k]['id'] == str(name):
+                    return self.instances_[k]
+            raise http_error(404, "The resource 'instances/%s' was not found" % name)
+        return self.instances_[key]
+
+    def _field(self, resource, field):
+        obj = resource
+        for f in field.split("."):
+            obj = obj.get(f, {}) if isinstance(obj, dict) else {}
+        return obj
+
+    def _matches(self, resource, filter):
+        if not filter:
+            return True
+        m = _filter_regex.match(filter)
+        if m:
+            value = self._field(resource, m.group(1))
+            matched = isinstance(value, str) and re.match("(?:%s)$" % m.group(3).strip("'\""), value)
+            return bool(matched) == (m.group(2) == 'eq')
+        for (field, value) in _filter_term.findall(filter):
+            if self._field(resource, field) != value:
+                return False
+        return True
+
+    def _page(self, items, pageToken, maxResults=None):
+        start = int(pageToken or 0)
+        end = start + (maxResults or 500)
+        result = {'items': items[start:end]}
+        if end < len(items):
+            result['nextPageToken'] = str(end)
+        return result
+
+class _Images(_Collection):
+    def _image(self, project, name):
+        return {'name': name, 'diskSizeGb': str(self.compute.image_size),
+                'selfLink': "https://www.googleapis.com/compute/v1/projects/%s/global/images/%s" % (project, name)}
+
+    def get(self, project, image):
+        return self._request(lambda: self._image(project, image))
+
+    def getFromFamily(self, project, family):
+        return self._request(lambda: self._image(project, "%s-latest" % family))
+
+class _Snapshots(_Collection):
+    def get(self, project, snapshot):
+        def _get():
+            return {'name': snapshot,
+                    'diskSizeGb': str(self.compute.snapshot_size),
+                    'selfLink': "https://www.googleapis.com/compute/v1/projects/%s/global/snapshots/%s" % (project, snapshot)}
+        return self._request(_get)
+
+class _Regions(_Collection):
+    def get(self, project, region):
+        def _get():
+            return {'name': region,
+                    'quotas': [{'metric': m, 'limit': float(l), 'usage': 0.0}
+                               for (m, l) in self.compute.quotas.items()]}
+        return self._request(_get)
+
+class _ZoneOperations(_Collection):
+    def get(self, project, zone, operation):
+        return self._request(lambda: self.compute._finish(operation)[0])
+
+    def list(self, project, zone, filter=None, pageToken=None, maxResults=None):
+        c = self.compute
+        def _list():
+            with c.lock:
+                items = [dict(c.operations[k][0]) for k in sorted(c.operations)
+                         if c.operations[k][0]['zone'].endswith("/%s" % zone) and
+                         c.operations[k][0]['status'] == 'DONE' and
+                         c._matches(c.operations[k][0], filter)]
+            return c._page(items, pageToken, maxResults)
+        return self._request(_list)
+
+    def wait(self, project, zone, operation):
+        def _wait():
+            (op, done_at) = self.compute._finish(operation)
+            if op['status'] != 'DONE':
+                time.sleep(max(0, min(done_at - time.time(), self.compute.latencies['wait_max'])))
+                (op, done_at) = self.compute._finish(operation)
+            return op
+        return self._request(_wait)
+
+class _Disks(_Collection):
+    def insert(self, project, zone, body):
+        c = self.compute
+        def _insert():
+            with c.lock:
+                key = (project, zone, body['name'])
+                if key in c.disks_:
+                    raise http_error(409, "The resource 'disks/%s' already exists" % body['name'])
+                d = c._new_disk(project, zone, body)
+                d['status'] = 'CREATING'
+                c.disks_[key] = d
+            def _ready():
+                d['status'] = 'READY'
+            return c._operation('disk', project, zone, d['selfLink'], d['id'], _ready)
+        return self._request(_insert)
+
+    def get(self, project, zone, disk):
+        c = self.compute
+        def _get():
+            with c.lock:
+                if (project, zone, disk) not in c.disks_:
+                    raise http_error(404, "The resource 'disks/%s' was not found" % disk)
+                return copy.deepcopy(c.disks_[(project, zone, disk)])
+        return self._request(_get)
+
+    def list(self, project, zone, filter=None, pageToken=None, maxResults=None):
+        c = self.compute
+        def _list():
+            with c.lock:
+                items = [copy.deepcopy(c.disks_[k]) for k in sorted(c.disks_)
+                         if k[:2] == (project, zone) and c._matches(c.disks_[k], filter)]
+            return c._page(items, pageToken, maxResults)
+        return self._request(_list)
+
+    def aggregatedList(self, project, filter=None, pageToken=None, maxResults=None):
+        c = self.compute
+        def _list():
+            with c.lock:
+                items = [copy.deepcopy(c.disks_[k]) for k in sorted(c.disks_)
+                         if k[0] == project and c._matches(c.disks_[k], filter)]
+            page = c._page(items, pageToken, maxResults)
+            scopes = {}
+            for d in page['items']:
+                scopes.setdefault("zones/%s" % d['zone'].split("/")[-1], {'disks': []})['disks'].append(d)
+            page['items'] = scopes
+            return page
+        return self._request(_list)
+
+    def setLabels(self, project, zone, resource, body):
+        c = self.compute
+        def _set():
+            with c.lock:
+                d = c.disks_[(project, zone, resource)]
+                if body.get('labelFingerprint') != d['labelFingerprint']:
+                    raise http_error(412, "Labels fingerprint either invalid or resource labels have changed")
+                d['labels'] = dict(body.get('labels', {}))
+                d['labelFingerprint'] = c._next_id()
+                return c._operation('default', project, zone, d['selfLink'], d['id'])
+        return self._request(_set)
+
+    def delete(self, project, zone, disk):
+        c = self.compute
+        def _delete():
+            with c.lock:
+                key = (project, zone, disk)
+                if key not in c.disks_:
+                    raise http_error(404, "The resource 'disks/%s' was not found" % disk)
+                d = c.disks_[key]
+                if d['users']:
+                    raise http_error(400, "The disk resource '%s' is already being used by '%s'" % (disk, d['users'][0]))
+                del c.disks_[key]
+            return c._operation('delete', project, zone, d['selfLink'], d['id'])
+        return self._request(_delete)
+
+class _Instances(_Collection):
+    def insert(self, project, zone, body):
+        c = self.compute
+        def _insert():
+            with c.lock:
+                name = body['name']
+                if (project, zone, name) in c.instances_:
+                    raise http_error(409, "The resource 'instances/%s' already exists" % name)
+                link = c._link(project, zone, 'instances', name)
+                inst = {'kind': 'compute#instance',
+                        'id': c._next_id(),
+                        'name': name,
+                        'zone': "projects/%s/zones/%s" % (project, zone),
+                        'machineType': body['machineType'],
+                        'status': 'PROVISIONING',
+                        'labels': dict(body.get('labels', {})),
+                        'labelFingerprint': c._next_id(),
+                        'metadata': copy.deepcopy(body.get('metadata', {})),
+                        'scheduling': copy.deepcopy(body.get('scheduling', {})),
+                        'disks': [],
+                        'networkInterfaces': [{'networkIP': c.ip,
+                                               'accessConfigs': [{'natIP': c.ip}]}],
+                        'selfLink': link}
+                for (i, bd) in enumerate(body.get('disks', [])):
+                    params = bd.get('initializeParams', {})
+                    if bd.get('type') == 'SCRATCH':
+                        inst['disks'].append({'type': 'SCRATCH', 'interface': bd.get('interface', 'NVME'),
+                                              'deviceName': bd.get('deviceName', "local-ssd-%s" % i),
+                                              'autoDelete': True})
+                        continue
+                    if 'source' in bd:
+                        d = c.disks_.get((project, zone, c._disk_name(bd['source'])))
+                        if d is None:
+                            raise http_error(404, "The resource '%s' was not found" % bd['source'])
+                        c._check_attach(d, bd.get('mode', 'READ_WRITE'))
+                    else:
+                        dname = params.get('diskName', name if bd.get('boot') else "%s-%s" % (name, i))
+                        d = c._new_disk(project, zone, dict(params, name=dname,
+                                                            type=params.get('diskType', 'pd-standard'),
+                                                            sizeGb=params.get('diskSizeGb')))
+                        c.disks_[(project, zone, dname)] = d
+                    d['users'].append(link)
+                    inst['disks'].append({'source': d['selfLink'],
+                                          'deviceName': bd.get('deviceName', "persistent-disk-%s" % i),
+                                          'boot': bool(bd.get('boot')),
+                                          'mode': bd.get('mode', 'READ_WRITE'),
+                                          'autoDelete': bool(bd.get('autoDelete'))})
+                c.instances_[(project, zone, name)] = inst
+            def _running():
+                inst['status'] = 'RUNNING'
+                #NOTE: a startup script that powers the instance off (e.g. a
+                #warm pool instance's first boot) is run as well
+                scripts = [m['value'] for m in inst['metadata'].get('items', [])
+                           if m['key'] == 'startup-script']
+                if any("shutdown -h now" in v for v in scripts):
+                    inst['status'] = 'TERMINATED'
+            return c._operation('instance', project, zone, link, inst['id'], _running)
+        return self._request(_insert)
+
+    def get(self, project, zone, instance):
+        c = self.compute
+        def _get():
+            with c.lock:
+                return copy.deepcopy(c._instance(project, zone, instance))
+        return self._request(_get)
+
+    def list(self, project, zone, filter=None, pageToken=None, maxResults=None):
+        c = self.compute
+        def _list():
+            with c.lock:
+                items = [copy.deepcopy(c.instances_[k]) for k in sorted(c.instances_)
+                         if k[:2] == (project, zone) and c._matches(c.instances_[k], filter)]
+            return c._page(items, pageToken, maxResults)
+        return self._request(_list)
+
+    def aggregatedList(self, project, filter=None, pageToken=None, maxResults=None):
+        c = self.compute
+        def _list():
+            with c.lock:
+                items = [copy.deepcopy(c.instances_[k]) for k in sorted(c.instances_)
+                         if k[0] == project and c._matches(c.instances_[k], filter)]
+            page = c._page(items, pageToken, maxResults)
+            scopes = {}
+            for i in page['items']:
+                scopes.setdefault("zones/%s" % i['zone'].split("/")[-1], {'instances': []})['instances'].append(i)
+            page['items'] = scopes
+            return page
+        return self._request(_list)
+
+    def _mutate(self, kind, project, zone, instance, fn, now=None):
+        """Runs now(inst) straight away and fn(inst) when the operation
+        finishes (both under the lock)"""
+        c = self.compute
+        def _call():
+            with c.lock:
+                inst = c._instance(project, zone, instance)
+                if now:
+                    now(inst)
+            def _apply():
+                with c.lock:
+                    if fn:
+                        fn(inst)
+            return c._operation(kind, project, zone, inst['selfLink'], inst['id'], _apply)
+        return self._request(_call)
+
+    def delete(self, project, zone, instance):
+        c = self.compute
+        def _now(inst):
+            inst['status'] = 'STOPPING'
+        def _delete(inst):
+            for ad in inst['disks']:
+                if 'source' not in ad:
+                    continue
+                key = (project, zone, c._disk_name(ad['source']))
+                if key in c.disks_:
+                    c.disks_[key]['users'] = [u for u in c.disks_[key]['users'] if u != inst['selfLink']]
+                    if ad['autoDelete']:
+                        del c.disks_[key]
+            c.instances_.pop((project, zone, inst['name']), None)
+        return self._mutate('delete', project, zone, instance, _delete, _now)
+
+    def attachDisk(self, project, zone, instance, body):
+        c = self.compute
+        def _now(inst):
+            d = c.disks_.get((project, zone, c._disk_name(body['source'])))
+            if d is None:
+                raise http_error(404, "The resource '%s' was not found" % body['source'])
+            c._check_attach(d, body.get('mode', 'READ_WRITE'))
+            d['users'].append(inst['selfLink'])
+            inst['disks'].append({'source': d['selfLink'],
+                                  'deviceName': body.get('deviceName', "persistent-disk-%s" % len(inst['disks'])),
+                                  'boot': False,
+                                  'mode': body.get('mode', 'READ_WRITE'),
+                                  'autoDelete': bool(body.get('autoDelete'))})
+        return self._mutate('attach', project, zone, instance, None, _now)
+
+    def detachDisk(self, project, zone, instance, deviceName):
+        c = self.compute
+        def _now(inst):
+            for ad in list(inst['disks']):
+                if ad['deviceName'] == deviceName:
+                    inst['disks'].remove(ad)
+                    d = c.disks_.get((project, zone, c._disk_name(ad['source'])))
+                    if d:
+                        d['users'] = [u for u in d['users'] if u != inst['selfLink']]
+                    return
+            raise http_error(400, "No attached disk found with device name '%s'" % deviceName)
+        return self._mutate('attach', project, zone, instance, None, _now)
+
+    def setDiskAutoDelete(self, project, zone, instance, autoDelete, deviceName):
+        def _now(inst):
+            for ad in inst['disks']:
+                if ad['deviceName'] == deviceName:
+                    ad['autoDelete'] = bool(autoDelete)
+                    return
+            raise http_error(400, "No attached disk found with device name '%s'" % deviceName)
+        return self._mutate('default', project, zone, instance, None, _now)
+
+    def start(self, project, zone, instance):
+        def _now(inst):
+            inst['status'] = 'STAGING'
+        def _start(inst):
+            inst['status'] = 'RUNNING'
+        return self._mutate('start', project, zone, instance, _start, _now)
+
+    def stop(self, project, zone, instance):
+        def _now(inst):
+            inst['status'] = 'STOPPING'
+        def _stop(inst):
+            inst['status'] = 'TERMINATED'
+        return self._mutate('stop', project, zone, instance, _stop, _now)
+
+    def _check_stopped(self, inst):
+        if inst['status'] != 'TERMINATED':
+            raise http_error(400, "The resource 'instances/%s' is not stopped" % inst['name'])
+
+    def setMachineType(self, project, zone, instance, body):
+        def _now(inst):
+            self._check_stopped(inst)
+        def _set(inst):
+            inst['machineType'] = body['machineType']
+        return self._mutate('default', project, zone, instance, _set, _now)
+
+    def setName(self, project, zone, instance, body):
+        c = self.compute
+        def _now(inst):
+            self._check_stopped(inst)
+            if body.get('currentName') != inst['name']:
+                raise http_error(412, "The current name of the instance is not '%s'" % body.get('currentName'))
+            if (project, zone, body['name']) in c.instances_:
+                raise http_error(409, "The resource 'instances/%s' already exists" % body['name'])
+            old_link = inst['selfLink']
+            del c.instances_[(project, zone, inst['name'])]
+            inst['name'] = body['name']
+            inst['selfLink'] = c._link(project, zone, 'instances', body['name'])
+            c.instances_[(project, zone, inst['name'])] = inst
+            for d in c.disks_.values():
+                d['users'] = [inst['selfLink'] if u == old_link else u for u in d['users']]
+        return self._mutate('default', project, zone, instance, None, _now)
+
+    def setLabels(self, project, zone, instance, body):
+        c = self.compute
+        def _now(inst):
+            if body.get('labelFingerprint') != inst['labelFingerprint']:
+                raise http_error(412, "Labels fingerprint either invalid or resource labels have changed")
+            inst['labels'] = dict(body.get('labels', {}))
+            inst['labelFingerprint'] = c._next_id()
+        return self._mutate('default', project, zone, instance, None, _now)
+
+###############################################################################
+# Storage API and gsutil
+###############################################################################
+
+def checksums(path):
+    """Returns the (crc32c, md5Hash) of a local file, base64 encoded like the
+    Storage API's
+    NOTE: the fakes use zlib's crc32 in place of crc32c, which is fine as
+    long as the fake store and the fake gsutil agree"""
+    crc = 0
+    md5 = hashlib.md5()
+    f = open(path, "rb")
+    try:
+        while True:
+            data = f.read(1 << 20)
+            if not data:
+                break
+            crc = zlib.crc32(data, crc)
+            md5.update(data)
+    finally:
+        f.close()
+    return (base64.b64encode(struct.pack(">I", crc & 0xffffffff)).decode("ascii"),
+            base64.b64encode(md5.digest()).decode("ascii"))
+
+class FakeStorage(object):
+    """Storage API stand-in backed by a local directory: the object
+    gs://{bucket}/{name} is the file {root}/{bucket}/{name}.  Because it's
+    just files, the fake gsutil (see install_gsutil) sees the same objects,
+    e.g. on a FakeSSHServer"""
+    def __init__(self, root, latency=0.05, page_size=1000):
+        self.root = root
+        self.latency = latency
+        self.page_size = page_size
+
+    def objects(self):
+        return _Objects(self)
+
+    def path(self, bucket, name):
+        return os.path.join(self.root, bucket, name)
+
+    def put(self, gs_path, data):
+        """Writes data to the gs:// path (test setup, no api call)"""
+        (bucket, _, name) = gs_path[len("gs://"):].partition("/")
+        p = self.path(bucket, name)
+        if not os.path.isdir(os.path.dirname(p)):
+            os.makedirs(os.path.dirname(p))
+        f = open(p, "wb")
+        f.write(data)
+        f.close()
+
+    def install_gsutil(self, bin_dir):
+        """Writes a fake gsutil (see _gsutil_sh) into bin_dir
+        RETURNS: the env variables that it needs, e.g. for FakeSSHServer"""
+        if not os.path.isdir(bin_dir):
+            os.makedirs(bin_dir)
+        p = os.path.join(bin_dir, "gsutil")
+        f = open(p, "w")
+        f.write(_gsutil_sh % {'python': sys.executable,
+                              'dir': os.path.dirname(os.path.abspath(__file__))})
+        f.close()
+        os.chmod(p, 0o755)
+        return {'PATH': bin_dir + os.pathsep + os.environ.get('PATH', ''),
+                'FAKE_GCS_ROOT': self.root}
+
+    def resource(self, bucket, name):
+        p = self.path(bucket, name)
+        st = os.stat(p)
+        (crc32c, md5) = checksums(p)
+        return {'bucket': bucket, 'name': name, 'size': str(st.st_size),
+                'crc32c': crc32c, 'md5Hash': md5,
+                'updated': time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(st.st_mtime))}
+
+    def names(self, bucket, prefix):
+        """Sorted names of the objects under prefix"""
+        base = os.path.join(self.root, bucket)
+        start = os.path.join(base, prefix.rsplit("/", 1)[0]) if "/" in prefix else base
+        names = []
+        for (d, dirs, files) in os.walk(start):
+            for f in files:
+                name = os.path.relpath(os.path.join(d, f), base).replace(os.sep, "/")
+                if name.startswith(prefix):
+                    names.append(name)
+        return sorted(names)
+
+class _Objects(object):
+    def __init__(self, storage):
+        self.storage = storage
+
+    def _request(self, fn):
+        name = "storage.objects.%s" % sys._getframe(1).f_code.co_name
+        return FakeRequest(fn, self.storage.latency, name)
+
+    def list(self, bucket, prefix="", delimiter=None, pageToken=None, fields=None, maxResults=None):
+        s = self.storage
+        def _list():
+            entries = [] #sorted (name, is prefix)
+            seen = set()
+            for name in s.names(bucket, prefix or ""):
+                rest = name[len(prefix or ""):]
+                if delimiter and delimiter in rest:
+                    p = (prefix or "") + rest.split(delimiter)[0] + delimiter
+                    if p not in seen:
+                        seen.add(p)
+                        entries.append((p, True))
+                else:
+                    entries.append((name, False))
+            start = int(pageToken or 0)
+            end = start + (maxResults or s.page_size)
+            result = {}
+            page = entries[start:end]
+            if [e for e in page if not e[1]]:
+                result['items'] = [s.resource(bucket, n) for (n, is_prefix) in page if not is_prefix]
+            if [e for e in page if e[1]]:
+                result['prefixes'] = [n for (n, is_prefix) in page if is_prefix]
+            if end < len(entries):
+                result['nextPageToken'] = str(end)
+            return result
+        return self._request(_list)
+
+    def get(self, bucket, object, fields=None):
+        s = self.storage
+        def _get():
+            if not os.path.isfile(s.path(bucket, object)):
+                raise http_error(404, "No such object: %s/%s" % (bucket, object))
+            return s.resource(bucket, object)
+        return self._request(_get)
+
+    def get_media(self, bucket, object):
+        s = self.storage
+        def _get():
+            if not os.path.isfile(s.path(bucket, object)):
+                raise http_error(404, "No such object: %s/%s" % (bucket, object))
+            #honour a "bytes=start-end" Range header
+            (start, end) = (0, None)
+            if 'Range' in request.headers:
+                (start, end) = request.headers['Range'].split("=")[1].split("-")
+                (start, end) = (int(start), int(end) if end else None)
+            f = open(s.path(bucket, object), "rb")
+            try:
+                f.seek(start)
+                return f.read() if end is None else f.read(end - start + 1)
+            finally:
+                f.close()
+        request = self._request(_get)
+        return request
+
+    def insert(self, bucket, name, media_body, fields=None):
+        s = self.storage
+        def _insert():
+            s.put("gs://%s/%s" % (bucket, name), media_body.getbytes(0, media_body.size()))
+            return s.resource(bucket, name)
+        return self._request(_insert)
+
+    def rewrite(self, sourceBucket, sourceObject, destinationBucket, destinationObject, body=None, rewriteToken=None, maxBytesRewrittenPerCall=None, fields=None):
+        """Copies maxBytesRewrittenPerCall (if given) per call, the
+        rewriteToken being the bytes copied so far"""
+        s = self.storage
+        def _rewrite():
+            src = s.path(sourceBucket, sourceObject)
+            if not os.path.isfile(src):
+                raise http_error(404, "No such object: %s/%s" % (sourceBucket, sourceObject))
+            size = os.path.getsize(src)
+            done = int(rewriteToken or 0) + (maxBytesRewrittenPerCall or size)
+            if done < size:
+                return {'kind': 'storage#rewriteResponse', 'done': False,
+                        'totalBytesRewritten': str(done), 'objectSize': str(size),
+                        'rewriteToken': str(done)}
+            f = open(src, "rb")
+            s.put("gs://%s/%s" % (destinationBucket, destinationObject), f.read())
+            f.close()
+            return {'kind': 'storage#rewriteResponse', 'done': True,
+                    'totalBytesRewritten': str(size), 'objectSize': str(size),
+                    'resource': s.resource(destinationBucket, destinationObject)}
+        return self._request(_rewrite)
+
+#A (tiny) gsutil on top of the FakeStorage directory given by the
+#FAKE_GCS_ROOT env variable: cp, rsync -r, rm -r and ls are plain shell (a
+#python start-up per copy would dominate the transfer timings), hash -c goes
+#to gsutil_hash.
+#If FAKE_GSUTIL_MBPS is set, copies are slowed down to that rate
+_gsutil_sh = """#!/bin/sh
+while [ "$1" = "-m" ] || [ "$1" = "-q" ]; do shift; done
+p() { case "$1" in gs://*) echo "$FAKE_GCS_ROOT/${1#gs://}";; *) echo "$1";; esac; }
+case "$1" in
+cp)
+  src=$(p "$2"); dst=$(p "$3")
+  [ -f "$src" ] || { echo "CommandException: No URLs matched: $2" >&2; exit 1; }
+  case "$3" in */) dst="$dst${src##*/}";; *) [ -d "$dst" ] && dst="$dst/${src##*/}";; esac
+  mkdir -p "$(dirname "$dst")"
+  [ -n "$FAKE_GSUTIL_MBPS" ] && sleep $(awk "BEGIN{print $(stat -c %%s "$src") / ($FAKE_GSUTIL_MBPS * 1000000)}")
+  cp "$src" "$dst";;
+rsync)
+  [ "$2" = "-r" ] && shift
+  mkdir -p "$(p "$3")" && cp -r "$(p "$2")/." "$(p "$3")/";;
+rm)
+  [ "$2" = "-r" ] && shift
+  rm -rf "$(p "$2")";;
+ls)
+  [ -e "$(p "$2")" ] || { echo "CommandException: One or more URLs matched no objects." >&2; exit 1; }
+  echo "$2";;
+hash)
+  exec %(python)s -c "import sys; sys.path.insert(0, '%(dir)s'); import fakes; fakes.gsutil_hash(sys.argv[-1])" "$@";;
+*)
+  echo "fake gsutil: unsupported command $*" >&2; exit 1;;
+esac
+"""
+
+def gsutil_hash(path):
+    """Prints what 'gsutil hash -c' does for a local file, see _gsutil_sh"""
+    print("Hashes [base64] for %s:" % os.path.basename(path))
+    print("\tHash (crc32c):\t\t%s" % checksums(path)[0])
+
+###############################################################################
+# ssh
+###############################################################################
+
+class FakeSSHServer(object):
+    """A local paramiko ssh server that accepts any key for any user and
+    runs each command with bash (on this machine!) with the given extra
+    env variables, e.g. the ones returned by FakeStorage.install_gsutil.
+    Listens on 127.0.0.1:{port}"""
+    def __init__(self, env=None, host="127.0.0.1"):
+        import paramiko
+        logging.getLogger("fakes.sshd").addHandler(logging.NullHandler())
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.env = dict(os.environ)
+        self.env.update(env or {})
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, 0))
+        self.sock.listen(128)
+        (self.address, self.port) = self.sock.getsockname()
+        self.transports = []
+        t = threading.Thread(target=self._accept)
+        t.daemon = True
+        t.start()
+
+    @staticmethod
+    def client_key(path):
+        """Writes a new private key for clients to log in with to path"""
+        import paramiko
+        paramiko.RSAKey.generate(2048).write_private_key_file(path)
+        return path
+
+    def close(self):
+        self.sock.close()
+        for t in self.transports:
+            t.close()
+
+    def _accept(self):
+        import paramiko
+        server = self
+
+        class _Handler(paramiko.ServerInterface):
+            def check_channel_request(self, kind, chanid):
+                if kind == 'session':
+                    return paramiko.OPEN_SUCCEEDED
+                return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+            def get_allowed_auths(self, username):
+                return 'publickey'
+
+            def check_auth_publickey(self, username, key):
+                return paramiko.AUTH_SUCCESSFUL
+
+            def check_channel_exec_request(self, channel, command):
+                t = threading.Thread(target=server._run, args=(channel, command))
+                t.daemon = True
+                t.start()
+                return True
+
+        while True:
+            try:
+                (conn, addr) = self.sock.accept()
+            except (socket.error, OSError):
+                return #closed
+            transport = paramiko.Transport(conn)
+            #NOTE: wait_for_ssh's tcp probes drop the connection before the
+            #handshake, which paramiko would otherwise log as an error
+            transport.set_log_channel("fakes.sshd")
+            transport.add_server_key(self.host_key)
+            self.transports.append(transport)
+            try:
+                transport.start_server(server=_Handler())
+            except (paramiko.SSHException, EOFError):
+                transport.close()
+
+    def _run(self, channel, command):
+        if not isinstance(command, str):
+            command = command.decode("utf-8")
+        try:
+            proc = subprocess.Popen(["bash", "-c", command], stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                    env=self.env)
+        except OSError as e:
+            #e.g. the command is too long to exec, like a real sshd
+            channel.sendall_stderr(("bash: %s\n" % e).encode("utf-8"))
+            channel.send_exit_status(126)
+            channel.close()
+            return
+
+        def _feed():
+            #copy the channel's stdin to the command's until eof
+            try:
+                while True:
+                    data = channel.recv(32768)
+                    if not data:
+                        break
+                    proc.stdin.write(data)
+            except (IOError, OSError):
+                pass #the command exited without reading all of it
+            finally:
+                try:
+                    proc.stdin.close()
+                except (IOError, OSError):
+                    pass
+
+        def _pump(stream, send):
+            while True:
+                data = os.read(stream.fileno(), 32768)
+                if not data:
+                    break
+                send(data)
+        feed = threading.Thread(target=_feed)
+        feed.daemon = True
+        feed.start()
+        pumps = [threading.Thread(target=_pump, args=(proc.stdout, channel.sendall)),
+                 threading.Thread(target=_pump, args=(proc.stderr, channel.sendall_stderr))]
+        for p in pumps:
+            p.daemon = True
+            p.start()
+        for p in pumps:
+            p.join()
+        channel.send_exit_status(proc.wait())
+        channel.close()
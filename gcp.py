@@ -0,0 +1,142 @@
+"""Len Taing 2019 (TGBTG)
+CHIPS automator - helpers for building Google API clients
+NOTE: googleapiclient is imported lazily (it is slow to import) so that
+e.g. --help doesn't pay for it
+"""
+
+import threading
+
+import cache
+import tracing
+
+#per-thread copies of api resources, see for_thread
+_local = threading.local()
+
+#discovery documents hardly ever change
+_discovery_ttl = 7 * 24 * 60 * 60
+
+#number of api http round trips made by this process, see request_count
+_requests = {'count': 0}
+_requests_lock = threading.Lock()
+_request_builder = []
+
+#max requests per batch http call
+_max_batch = 100
+
+class DiscoveryCache(object):
+    """googleapiclient discovery_cache (i.e. get(url)/set(url, content))
+    that keeps the discovery documents in the on-disk cache, so building a
+    client doesn't fetch the document over the network every time"""
+    def __init__(self, serviceName, version):
+        self.name = "discovery_%s_%s" % (serviceName, version)
+
+    def get(self, url):
+        return cache.lookup(self.name, url, _discovery_ttl)
+
+    def set(self, url, content):
+        if not isinstance(content, str):
+            content = content.decode("utf-8")
+        cache.store(self.name, url, content)
+
+def count_request(n=1):
+    """Adds n to the api request counter"""
+    with _requests_lock:
+        _requests['count'] += n
+
+def request_count():
+    """Returns the number of api http round trips made so far (a batch of
+    requests counts as one)"""
+    return _requests['count']
+
+def _requestBuilder():
+    """Returns an HttpRequest class that counts each request it executes"""
+    if not _request_builder:
+        from googleapiclient.http import HttpRequest
+
+        class CountingHttpRequest(HttpRequest):
+            def execute(self, *args, **kwargs):
+                count_request()
+                with tracing.span(self.methodId or "request", "api"):
+                    return HttpRequest.execute(self, *args, **kwargs)
+        _request_builder.append(CountingHttpRequest)
+    return _request_builder[0]
+
+def build(serviceName, version):
+    """Returns a googleapiclient resource for the given service, e.g.
+    build('compute', 'v1') or build('storage', 'v1')"""
+    import googleapiclient.discovery
+    return googleapiclient.discovery.build(serviceName, version,
+                                           cache=DiscoveryCache(serviceName, version),
+                                           requestBuilder=_requestBuilder())
+
+def for_thread(resource):
+    """googleapiclient resources share a single httplib2.Http object which is
+    NOT thread-safe.  Given a resource, returns a copy of it that is safe to
+    use from the calling thread (built once per thread from the resource's
+    own discovery document, so no extra network round trip).
+    Anything that isn't a googleapiclient resource, e.g. a fake used for
+    testing, is returned as is"""
+    if not hasattr(resource, '_rootDesc'):
+        return resource
+
+    if not hasattr(_local, 'resources'):
+        _local.resources = {}
+    key = id(resource)
+    if key not in _local.resources:
+        import googleapiclient.discovery
+        _local.resources[key] = googleapiclient.discovery.build_from_document(resource._rootDesc, requestBuilder=_requestBuilder())
+    return _local.resources[key]
+
+class BatchError(Exception):
+    """Raised when requests in a batch fail; errors is a dictionary of
+    {request key: exception} and responses has those that succeeded"""
+    def __init__(self, errors, responses=None):
+        self.errors = errors
+        self.responses = responses or {}
+        Exception.__init__(self, "; ".join("%s: %s" % (k, errors[k]) for k in sorted(errors)))
+
+class Batch(object):
+    """Collects independent api requests (gets and/or mutations) and sends
+    them in ONE batch http round trip, e.g.
+        batch = Batch(compute)
+        batch.add('image', compute.images().get(...))
+        batch.add('snapshot', compute.snapshots().get(...))
+        responses = batch.execute() #{'image': ..., 'snapshot': ...}
+    NOTE: resources without batch support (e.g. test fakes) have their
+    requests executed one by one"""
+    def __init__(self, resource):
+        self.resource = resource
+        self.requests = []
+
+    def add(self, key, request):
+        self.requests.append((key, request))
+
+    def execute(self):
+        """RETURNS: {key: response}; raises BatchError if any request fails"""
+        responses = {}
+        errors = {}
+
+        def _callback(key, response, exception):
+            if exception is not None:
+                errors[key] = exception
+            else:
+                responses[key] = response
+
+        if not hasattr(self.resource, 'new_batch_http_request'):
+            for (key, request) in self.requests:
+                try:
+                    _callback(key, request.execute(), None)
+                except Exception as e:
+                    _callback(key, None, e)
+        else:
+            for i in range(0, len(self.requests), _max_batch):
+                batch = self.resource.new_batch_http_request(callback=_callback)
+                for (key, request) in self.requests[i:i + _max_batch]:
+                    batch.add(request, request_id=key)
+                count_request()
+                with tracing.span("batch", "api", requests=len(self.requests[i:i + _max_batch])):
+                    batch.execute()
+
+        if errors:
+            raise BatchError(errors, responses)
+        return responses
@@ -4,10 +4,28 @@ CHIPS automator - Google Cloud API wrapper for instance operations
 
 import os
 import sys
+import copy
 import time
+import random
+import socket
 from optparse import OptionParser
 
-import googleapiclient.discovery
+import gcp
+import cache
+import workers
+import tracing
+
+#http statuses worth retrying: rate limited or server side errors
+_retry_statuses = (429, 500, 502, 503, 504)
+
+#local name -> {id, zone, ip} index of instances, see lookup_instance
+_index = "instances"
+_index_ttl = 6 * 60 * 60
+
+#image look-ups are cached: a named image doesn't change, but the latest
+#image of a family does, so those are only kept for a short while
+_image_ttl = 7 * 24 * 60 * 60
+_image_family_ttl = 60 * 60
 
 ###############################################################################
 #STATICALLY including a template instance config
@@ -51,60 +69,198 @@ config = {
     }
 }
 
-def wait_for_operation(compute, project, zone, operation):
+#spot instances: preempted instances are STOPPED (not deleted) so their disks
+#stay attached and intact, see find_preemption
+_spot_scheduling = {'provisioningModel': 'SPOT',
+                    'instanceTerminationAction': 'STOP',
+                    'onHostMaintenance': 'TERMINATE',
+                    'automaticRestart': False}
+_preempted_op = 'compute.instances.preempted'
+
+class OperationError(Exception):
+    """Raised when one or more zone operations finish with an error or do
+    not finish in time; errors is a dictionary of {operation name: error}"""
+    def __init__(self, errors):
+        self.errors = errors
+        Exception.__init__(self, "; ".join("%s: %s" % (op, errors[op]) for op in sorted(errors)))
+
+#zoneOperations().wait returns after at most this many secs (it can't be
+#given a timeout of its own), see _poll_operation
+_wait_secs = 120
+
+def _poll_operation(compute, project, zone, operation, timeout=None):
+    """Blocks until the given operation is DONE and returns it.
+    Uses the server-side zoneOperations().wait long-poll, which returns as
+    soon as the operation is done (or after ~2 mins, in which case we just
+    ask again), so no client-side polling interval is needed.  Once less
+    than the long-poll's ~2 mins of the timeout is left, it switches to
+    get + sleep so that it never blocks past the deadline.  Transient
+    api/network errors are retried with exponential backoff.
+    Raises OperationError if timeout secs pass first"""
+    from googleapiclient.errors import HttpError
+    t_end = time.time() + timeout if timeout else None
+    delay = 1
+    retries = 0
+    with tracing.span("wait_for_operation", "operation", operation=operation) as s:
+        while True:
+            remaining = t_end - time.time() if t_end else None
+            #NOTE: the long-poll would block for (up to) _wait_secs
+            long_poll = remaining is None or remaining > _wait_secs
+            ops = compute.zoneOperations()
+            result = None
+            try:
+                request = ops.wait if long_poll else ops.get
+                result = request(project=project,
+                                 zone=zone,
+                                 operation=operation).execute()
+            except HttpError as e:
+                if e.resp.status not in _retry_statuses:
+                    raise
+                print("wait_for_operation: %s, retrying..." % e.resp.status)
+            except socket.error as e:
+                print("wait_for_operation: %s, retrying..." % e)
+
+            if result and result['status'] == 'DONE':
+                s.set(type=result.get('operationType'))
+                return result
+
+            remaining = t_end - time.time() if t_end else delay
+            if remaining <= 0:
+                raise OperationError({operation: "timed out after %s secs" % timeout})
+            if not result:
+                retries += 1
+                s.set(retries=retries)
+            elif long_poll:
+                delay = 1
+                continue
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 32)
+
+def wait_for_operation(compute, project, zone, operation, timeout=None):
     """From google api tutorial, tries to block while performing a given
-    operation"""
+    operation
+    Raises OperationError if the operation fails or timeout secs pass"""
     print('Waiting for operation to finish...')
-    while True:
-        result = compute.zoneOperations().get(
-            project=project,
-            zone=zone,
-            operation=operation).execute()
+    result = _poll_operation(compute, project, zone, operation, timeout)
+    print("done.")
+    if 'error' in result:
+        raise OperationError({operation: result['error']})
+    return result
 
-        if result['status'] == 'DONE':
-            print("done.")
-            if 'error' in result:
-                raise Exception(result['error'])
-            return result
+def wait_for_operations(compute, project, zone, operations, timeout=None, num_workers=8):
+    """Waits on a set of operation names concurrently
+    YIELDS: (operation name, result) as each operation finishes successfully
+    Once all are done, raises a single OperationError collecting every
+    operation that failed or timed out"""
+    for ((z, op), result) in wait_for_zone_operations(compute, project, [(zone, op) for op in operations], timeout, num_workers):
+        yield (op, result)
 
-        time.sleep(1)
+def wait_for_zone_operations(compute, project, operations, timeout=None, num_workers=8):
+    """wait_for_operations for operations in (possibly) several zones, i.e.
+    operations is a list of (zone, operation name)
+    YIELDS: ((zone, operation name), result)"""
+    fn = lambda zone_op: _poll_operation(gcp.for_thread(compute), project, zone_op[0], zone_op[1], timeout)
+    errors = {}
+    print('Waiting for %s operations to finish...' % len(operations))
+    for (zone_op, result, err) in workers.imap_unordered(fn, set(operations), num_workers):
+        op = zone_op[1]
+        if err is not None:
+            errors[op] = err.errors[op] if isinstance(err, OperationError) else err
+        elif 'error' in result:
+            errors[op] = result['error']
+        else:
+            yield (zone_op, result)
+    print("done.")
+    if errors:
+        raise OperationError(errors)
 
-def create(compute, instance_name, image_name, image_family, machine_type, project, serviceAcct, zone):
-    """Given a XX, YYY...
-    Tries to create an instance according to the given params using
-    googeapi methods
+def _image_cache_key(image_name, image_family, project):
+    """Returns the (cache key, ttl) for an image look-up, see get_image"""
+    if image_name:
+        return ("%s/%s" % (project, image_name), _image_ttl)
+    return ("%s/family/%s" % (project, image_family), _image_family_ttl)
+
+def _image_request(compute, image_name, image_family, project):
+    """Returns the (unexecuted) api request for an image look-up"""
+    #KEY: WE need to check if image_name is non-empty--if so, we try to
+    #retrieve the image ELSE (we assume image_family is non-empty) and
+    #get the latest image from the family name
+    if image_name:
+        return compute.images().get(project=project, image=image_name)
+    return compute.images().getFromFamily(project=project, family=image_family)
+
+def cache_image(image_name, image_family, project, image_response):
+    """Keeps the parts of an image look-up that we use in the on-disk cache
+    RETURNS: {'selfLink', 'diskSizeGb'}"""
+    image = {'selfLink': image_response['selfLink'],
+             'diskSizeGb': image_response['diskSizeGb']}
+    cache.store("images", _image_cache_key(image_name, image_family, project)[0], image)
+    return image
+
+def cached_image(image_name, image_family, project):
+    """Returns the cached {'selfLink', 'diskSizeGb'} of the image, or None"""
+    (key, ttl) = _image_cache_key(image_name, image_family, project)
+    return cache.lookup("images", key, ttl)
+
+def get_image(compute, image_name, image_family, project):
+    """Returns {'selfLink', 'diskSizeGb'} of the image to boot from
     NOTE: Either image_name or image_family is filled (i.e. both being
     empty strings are not allowed!)
     If both are specified, the image_name is used where this fn
     tries to retrieve that image, otherwise tries to use the
     latest image from the image_family, e.g. 'wes' or 'cidc_chips'
+    The answer is kept in the on-disk cache, see _image_ttl
     """
-    #KEY: WE need to check if image_name is non-empty--if so, we try to
-    #retrieve the image ELSE (we assume image_family is non-empty) and
-    #get the latest image from the family name
-    if image_name:
-        image_response = compute.images().get(project=project,
-                                              image=image_name).execute()
-    else:
-        image_response = compute.images().getFromFamily(project=project,
-                                                        family=image_family).execute()
-    source_disk_image = image_response['selfLink']
-
-    #set the machine type
-    machineType = "zones/%s/machineTypes/%s" % (zone, machine_type)
-
-    #set the config
-    config['name'] = instance_name
-    config['machineType'] = machineType
-    config['disks'][0]['initializeParams']['sourceImage'] = source_disk_image
-    config['serviceAccounts'][0]['email'] = serviceAcct
-    #print(config)
+    image = cached_image(image_name, image_family, project)
+    if image:
+        return image
+    image_response = _image_request(compute, image_name, image_family, project).execute()
+    return cache_image(image_name, image_family, project, image_response)
+
+def get_image_link(compute, image_name, image_family, project):
+    """Returns the selfLink of the image to boot from, see get_image"""
+    return get_image(compute, image_name, image_family, project)['selfLink']
+
+def _machine_type_link(machine_type, zone):
+    return "zones/%s/machineTypes/%s" % (zone, machine_type)
+
+def _instance_body(instance_name, machine_type, serviceAcct, zone, source_image, disks=None, spot=False):
+    """Returns the instances().insert body, see config"""
+    #NOTE: copy the template so that concurrent calls don't clobber it
+    body = copy.deepcopy(config)
+    body['name'] = instance_name
+    body['machineType'] = _machine_type_link(machine_type, zone)
+    body['disks'][0]['initializeParams']['sourceImage'] = source_image
+    body['disks'].extend(disks or [])
+    body['serviceAccounts'][0]['email'] = serviceAcct
+    if spot:
+        body['scheduling'] = dict(_spot_scheduling)
+    return body
+
+def create(compute, instance_name, image_name, image_family, machine_type, project, serviceAcct, zone, disks=None, source_image=None, spot=False):
+    """Given a XX, YYY...
+    Tries to create an instance according to the given params using
+    googeapi methods
+    NOTE: Either image_name or image_family is filled (i.e. both being
+    empty strings are not allowed!), see get_image_link.  If the image's
+    selfLink was already looked up it can be passed in as source_image.
+    disks is an optional list of attachedDisk bodies (see
+    disk.attached_disk_config) which are created and/or attached along with
+    the instance, i.e. in the same insert call
+    spot=True makes it a spot instance, which is stopped when preempted
+    (see _spot_scheduling)
+    """
+    if not source_image:
+        source_image = get_image_link(compute, image_name, image_family, project)
+    body = _instance_body(instance_name, machine_type, serviceAcct, zone,
+                          source_image, disks, spot)
+    #print(body)
 
     #create instance
     operation = compute.instances().insert(
         project=project,
         zone=zone,
-        body=config).execute()
+        body=body).execute()
     wait_for_operation(compute, project, zone, operation['name'])
     #print(operation)
     return operation
@@ -116,42 +272,296 @@ def delete(compute, name, project, zone):
         zone=zone,
         instance=name).execute()
     wait_for_operation(compute, project, zone, operation['name'])
+    forget_instance(name, project)
     #print(operation)
     return operation
 
+###############################################################################
+# Warm instance pool: instead of a cold insert (and first boot) for every
+# run, stopped instances that have already booted once from an image are
+# kept per image (and zone), labelled with the image name.  A launch claims
+# one--renaming it and resizing it to the run's machine type--attaches the
+# run's disks and starts it.  Stopped instances only cost their boot disk.
+###############################################################################
+_pool_label = 'chips-pool'
+_pool_prefix = 'chips-pool-'
+
+#the startup script of pool instances: power off at the end of the first
+#boot, so a new pool instance is ready to claim once it is TERMINATED; later
+#boots (i.e. once claimed) carry on as normal
+_pool_startup_script = """#!/bin/sh
+if [ ! -f /var/lib/chips-pool-warm ]; then
+  touch /var/lib/chips-pool-warm
+  shutdown -h now
+fi
+"""
+
+def pool_key(image_link):
+    """The pool of an image is keyed (and labelled) by the image's name, so
+    a new version of an image family starts a new pool"""
+    return image_link.split("/")[-1]
+
+def find_pooled_instances(compute, image_link, project, zone, status=None):
+    """Returns the image's pool instances--all of them or only those with
+    the given status, e.g. 'TERMINATED' for the ones ready to claim"""
+    pool_filter = '(labels.%s = "%s")' % (_pool_label, pool_key(image_link))
+    if status:
+        pool_filter += ' (status = "%s")' % status
+    return list(find_instances(compute, project, zone, pool_filter))
+
+def fill_instance_pool(compute, image_link, pool_size, machine_type, project, serviceAcct, zone, pooled=None):
+    """Starts creating enough new pool instances that the image's pool has
+    pool_size of them; new instances boot once and power themselves off
+    (the operations are NOT waited on)
+    pooled is the image's pool instances if they were just listed
+    RETURNS: the names of the new instances"""
+    if pooled is None:
+        pooled = find_pooled_instances(compute, image_link, project, zone)
+    names = []
+    for i in range(pool_size - len(pooled)):
+        instance_name = "%s%08x" % (_pool_prefix, random.getrandbits(32))
+        body = _instance_body(instance_name, machine_type, serviceAcct, zone, image_link)
+        body['labels'] = {_pool_label: pool_key(image_link)}
+        body['metadata'] = {'items': [{'key': 'startup-script',
+                                       'value': _pool_startup_script}]}
+        compute.instances().insert(project=project, zone=zone, body=body).execute()
+        names.append(instance_name)
+    return names
+
+def claim_pooled_instance(compute, image_link, instance_name, machine_type, project, zone):
+    """Takes a stopped instance from the image's pool, renames it to
+    instance_name and sets its machine type (both need it stopped)
+    If either of those fails, the claim is undone (see
+    _unclaim_pooled_instance) and the error is raised
+    RETURNS: the claimed instance's id, or None if the pool is empty"""
+    from googleapiclient.errors import HttpError
+    for pooled in find_pooled_instances(compute, image_link, project, zone, 'TERMINATED'):
+        try:
+            #NOTE: dropping the pool label takes the instance out of the
+            #pool; the fingerprint makes this fail if another launch has
+            #claimed it since we listed it
+            operation = compute.instances().setLabels(
+                project=project,
+                zone=zone,
+                instance=pooled['name'],
+                body={'labels': {},
+                      'labelFingerprint': pooled['labelFingerprint']}).execute()
+            wait_for_operation(compute, project, zone, operation['name'])
+        except HttpError as e:
+            if e.resp.status not in (409, 412):
+                raise
+            continue
+
+        print("Claimed the pool instance %s" % pooled['name'])
+        renamed = False
+        try:
+            operation = compute.instances().setName(
+                project=project,
+                zone=zone,
+                instance=pooled['name'],
+                body={'name': instance_name, 'currentName': pooled['name']}).execute()
+            wait_for_operation(compute, project, zone, operation['name'])
+            renamed = True
+            if pooled['machineType'].split("/")[-1] != machine_type:
+                operation = compute.instances().setMachineType(
+                    project=project,
+                    zone=zone,
+                    instance=instance_name,
+                    body={'machineType': _machine_type_link(machine_type, zone)}).execute()
+                wait_for_operation(compute, project, zone, operation['name'])
+        except Exception:
+            #NOTE: without its pool label nothing would ever use--or clean
+            #up--the instance, see _unclaim_pooled_instance
+            _unclaim_pooled_instance(compute, pooled, instance_name if renamed else None, project, zone)
+            raise
+        return pooled['id']
+    return None
+
+def _unclaim_pooled_instance(compute, pooled, renamed_to, project, zone):
+    """Undoes a claim (see claim_pooled_instance) that failed part way: an
+    instance that still has its pool name gets its pool labels back, one
+    that was already renamed (i.e. has the run's name) is deleted--as is
+    one whose labels can't be put back"""
+    if not renamed_to:
+        try:
+            current = compute.instances().get(project=project, zone=zone, instance=pooled['name']).execute()
+            operation = compute.instances().setLabels(
+                project=project,
+                zone=zone,
+                instance=pooled['name'],
+                body={'labels': pooled.get('labels', {}),
+                      'labelFingerprint': current['labelFingerprint']}).execute()
+            wait_for_operation(compute, project, zone, operation['name'])
+            print("Returned %s to the pool" % pooled['name'])
+            return
+        except Exception as e:
+            print("Couldn't return %s to the pool (%s), deleting it" % (pooled['name'], e))
+    try:
+        delete(compute, renamed_to or pooled['name'], project, zone)
+    except Exception as e:
+        print("Couldn't delete %s: %s" % (renamed_to or pooled['name'], e))
+
+def attach_disks(compute, instance_name, disks, project, zone):
+    """Attaches the attachedDisk bodies (see disk.existing_disk_config) in
+    order, so they get the same device order as if they were in the insert
+    body"""
+    for body in disks:
+        operation = compute.instances().attachDisk(
+            project=project,
+            zone=zone,
+            instance=instance_name,
+            body=body).execute()
+        wait_for_operation(compute, project, zone, operation['name'])
+
+def start(compute, instance_name, project, zone):
+    operation = compute.instances().start(
+        project=project,
+        zone=zone,
+        instance=instance_name).execute()
+    wait_for_operation(compute, project, zone, operation['name'])
+    return operation
+
+def drain_instance_pool(compute, image_link, project, zone, keep=0):
+    """Deletes all but keep of the image's stopped pool instances (those
+    still on their first boot are left alone)
+    RETURNS: the names of the deleted instances"""
+    pooled = find_pooled_instances(compute, image_link, project, zone, 'TERMINATED')
+    operations = []
+    names = []
+    for pooled_instance in pooled[keep:]:
+        operation = compute.instances().delete(
+            project=project,
+            zone=zone,
+            instance=pooled_instance['name']).execute()
+        operations.append(operation['name'])
+        names.append(pooled_instance['name'])
+    if operations:
+        for _ in wait_for_operations(compute, project, zone, operations):
+            pass
+    return names
+
+def find_instances(compute, project, zone=None, filter=None):
+    """Generator over the instances in the given zone--or in EVERY zone
+    (using aggregatedList) if no zone is given--that match the optional
+    server-side filter, e.g. 'name = "chips-auto-foo"'
+    NOTE: follows nextPageToken, so nothing beyond the first page is missed"""
+    page_token = None
+    while True:
+        if zone:
+            result = compute.instances().list(project=project, zone=zone,
+                                              filter=filter,
+                                              pageToken=page_token).execute()
+            items = result.get('items', [])
+        else:
+            result = compute.instances().aggregatedList(project=project,
+                                                        filter=filter,
+                                                        pageToken=page_token).execute()
+            items = [i for scope in result.get('items', {}).values()
+                     for i in scope.get('instances', [])]
+        for i in items:
+            yield i
+
+        page_token = result.get('nextPageToken')
+        if not page_token:
+            break
+
+def find_preemption(compute, instance_id, project, zone):
+    """Looks for the zone operation that records the preemption of the
+    (spot) instance, e.g. once it's found stopped
+    NOTE: keyed by the instance id, so a replacement instance with the same
+    name doesn't inherit its predecessor's preemptions
+    RETURNS: the latest preemption operation, or None if it wasn't preempted"""
+    op_filter = '(operationType = "%s") (targetId = "%s")' % (_preempted_op, instance_id)
+    latest = None
+    page_token = None
+    while True:
+        result = compute.zoneOperations().list(project=project, zone=zone,
+                                               filter=op_filter,
+                                               pageToken=page_token).execute()
+        for op in result.get('items', []):
+            if not latest or op.get('insertTime', '') > latest.get('insertTime', ''):
+                latest = op
+        page_token = result.get('nextPageToken')
+        if not page_token:
+            break
+    return latest
+
 def list_instances(compute, project, zone):
-    result = compute.instances().list(project=project, zone=zone).execute()
-    return result['items'] if 'items' in result else None
+    result = list(find_instances(compute, project, zone))
+    return result if result else None
 
-def get_instance(compute, instance_id, project, zone):
+def get_instance(compute, instance_id, project, zone, session=None):
+    """Returns the instance resource
+    If a session dictionary is given (e.g. one per provisioning run), the
+    response is kept in it and reused by later calls instead of calling
+    instances().get again"""
+    key = ('instance', project, zone, str(instance_id))
+    if session is not None and key in session:
+        return session[key]
     result = compute.instances().get(project=project, zone=zone, instance=instance_id).execute()
+    if session is not None:
+        session[key] = result
     return result
 
-def get_instance_from_name(compute, machine_name, project, zone):
-    """Helper fn to wrap looking up the ID using the name
-    may be costly b/c it calls a list all instances and then tries to pull out
-    the target instance"""
+def get_instance_from_name(compute, machine_name, project, zone=None):
+    """Helper fn to wrap looking up the instance using the name
+    Uses a server-side name filter (searching every zone if zone is None)
+    and refreshes the local instance index, see lookup_instance"""
     instance = None
-    result = list_instances(compute, project, zone) #calling list_instances fn
-    for (i,r) in enumerate(result):
-        if r['name'] == machine_name:
-            instance = r
+    name_filter = 'name = "%s"' % machine_name
+    for r in find_instances(compute, project, zone, name_filter):
+        instance = r
+        break
+    if instance:
+        cache.store(_index, "%s/%s" % (project, machine_name), _index_entry(instance))
     return instance
 
-def get_instance_ip(compute, instance_id, project, zone):
-    result = get_instance(compute, instance_id, project, zone)
+def _index_entry(instance):
+    """The instance index keeps the id, zone and ip addresses of instances"""
+    nic = instance['networkInterfaces'][0]
+    access = nic.get('accessConfigs', [{}])[0]
+    return {'id': instance['id'],
+            'zone': instance['zone'].split("/")[-1],
+            'ip': access.get('natIP'),
+            'internal_ip': nic.get('networkIP')}
+
+def lookup_instance(compute, machine_name, project, zone=None, ttl=_index_ttl, refresh=False):
+    """Returns {'id', 'zone', 'ip', 'internal_ip'} for the named instance,
+    or None if there is no such instance.
+    Answers come from the local instance index (~/.chips_automator/cache)
+    while they're younger than ttl secs, so repeated tx/monitor/teardown
+    calls skip the api entirely; pass refresh=True (e.g. if the cached ip
+    no longer answers) to go back to the api"""
+    key = "%s/%s" % (project, machine_name)
+    entry = None if refresh else cache.lookup(_index, key, ttl)
+    if entry and (not zone or entry['zone'] == zone):
+        return entry
+
+    instance = get_instance_from_name(compute, machine_name, project, zone)
+    if not instance:
+        cache.invalidate(_index, key)
+        return None
+    return _index_entry(instance)
+
+def forget_instance(machine_name, project):
+    """Drops the named instance from the local instance index, e.g. after
+    it is deleted"""
+    cache.invalidate(_index, "%s/%s" % (project, machine_name))
+
+def get_instance_ip(compute, instance_id, project, zone, session=None):
+    result = get_instance(compute, instance_id, project, zone, session)
     ext_ip_addr = result['networkInterfaces'][0]['accessConfigs'][0]['natIP']
     int_ip_addr = result['networkInterfaces'][0]['networkIP']
     return int_ip_addr
 
 def get_instance_ip_from_name(compute, machine_name, project, zone):
-    result = get_instance_from_name(compute, machine_name, project, zone)
-    ip_addr = result['networkInterfaces'][0]['accessConfigs'][0]['natIP']
+    result = lookup_instance(compute, machine_name, project, zone)
+    ip_addr = result['ip']
     return ip_addr
 
-def get_disk_device_name(compute, instance_id, project, zone, disk_name):
+def get_disk_device_name(compute, instance_id, project, zone, disk_name, session=None):
     "Tries to find the disk's assigned device name"
-    response = get_instance(compute, instance_id, project, zone)
+    response = get_instance(compute, instance_id, project, zone, session)
     disks = response['disks'] #an array of dictionaries, key in on source field
     for d in disks:
         #check if last elm in source url == disk_name
@@ -159,16 +569,18 @@ def get_disk_device_name(compute, instance_id, project, zone, disk_name):
             return d['deviceName']
     return None
 
-#WARNING: THE FN below DOES NOT ACTUAKKY work--the call is correct but the
-# google api is broken!
 def set_disk_auto_delete(compute, instance_name, project, zone, disk_dev_name, auto_del_flag=True):
     """GIVEN a compute resource, an instance_name, project, zone,
-    disk_name, will set the auto_delete flag to the given val (default True)"""
-    result = compute.instances().setDiskAutoDelete(project=project, zone=zone, instance=instance_name, autoDelete=auto_del_flag, deviceName=disk_dev_name)
-    return result
+    disk device name, will set the auto_delete flag to the given val
+    (default True)
+    NOTE: new disks should rather declare autoDelete in their attachedDisk
+    body, see disk.attached_disk_config"""
+    operation = compute.instances().setDiskAutoDelete(project=project, zone=zone, instance=instance_name, autoDelete=auto_del_flag, deviceName=disk_dev_name).execute()
+    wait_for_operation(compute, project, zone, operation['name'])
+    return operation
 
 def main():
-    compute = googleapiclient.discovery.build('compute', 'v1')
+    compute = gcp.build('compute', 'v1')
     #TODO: update this!
     usage = "USAGE: %prog -n [instance name] -t [instance type (n1-highmem-96) -p [project (cidc-biofx)] -z [zone (us-east-1b]"
     optparser = OptionParser(usage=usage)
@@ -180,8 +592,27 @@ def main():
     optparser.add_option("-z", "--zone", default="us-east1-b", help="zone")
     optparser.add_option("-c", "--create", action="store_true", default=False, help="create an instance")
     optparser.add_option("-d", "--delete", action="store_true", default=False, help="create an instance")
+    optparser.add_option("-f", "--fill_pool", type="int", help="top up the image's warm instance pool to this many instances")
+    optparser.add_option("--drain_pool", action="store_true", default=False, help="delete the image's stopped pool instances")
     (options, args) = optparser.parse_args(sys.argv)
 
+    if options.fill_pool or options.drain_pool:
+        if not options.image:
+            print("ERROR: an image family, e.g. 'wes' 'cidc_chips' is required")
+            optparser.print_help()
+            sys.exit(-1)
+        image_link = get_image_link(compute, None, options.image, options.project)
+        if options.fill_pool:
+            names = fill_instance_pool(compute, image_link, options.fill_pool,
+                                       options.machine_type, options.project,
+                                       options.service_account, options.zone)
+            print("Creating %s pool instances: %s" % (len(names), ", ".join(names)))
+        if options.drain_pool:
+            names = drain_instance_pool(compute, image_link, options.project,
+                                        options.zone)
+            print("Deleted %s pool instances: %s" % (len(names), ", ".join(names)))
+        sys.exit(0)
+
     if not options.instance_name:
         print("ERROR: an unique instance name is required")
         optparser.print_help()
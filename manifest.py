@@ -0,0 +1,55 @@
+"""Len Taing 2019 (TGBTG)
+CHIPS automator - transfer manifest: records the size and checksums of every
+file transferred for a run so that a rerun only copies what is missing,
+changed or empty
+"""
+
+import json
+import time
+
+import bucket
+
+def manifest_path(bucket_path, shard=None):
+    """Returns where the manifest for a run is kept, i.e. next to the run's
+    results in {bucket_path}/.chips_automator/ (one per shard for sharded
+    runs, which share the bucket path)"""
+    name = "transfer_manifest_%s" % shard if shard else "transfer_manifest"
+    return "%s/.chips_automator/%s.json" % (bucket_path.rstrip("/"), name)
+
+def load(storage, bucket_path, shard=None):
+    """Returns the run's manifest: a dictionary of {destination path: entry}
+    (see make_entry), empty if the run has no manifest yet"""
+    data = bucket.download_string(storage, manifest_path(bucket_path, shard))
+    if not data:
+        return {}
+    return json.loads(data.decode("utf-8"))
+
+def save(storage, bucket_path, entries, shard=None):
+    """Persists the run's manifest to the bucket"""
+    bucket.upload_string(storage, manifest_path(bucket_path, shard),
+                         json.dumps(entries, indent=1, sort_keys=True),
+                         mimetype="application/json")
+
+def make_entry(src_obj):
+    """Given the source object resource, returns the manifest entry for a
+    completed transfer of it"""
+    return {'src': "gs://%s/%s" % (src_obj['bucket'], src_obj['name']),
+            'size': int(src_obj['size']),
+            'crc32c': src_obj.get('crc32c'),
+            'md5Hash': src_obj.get('md5Hash'),
+            'time': time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+def matches(src_obj, dst):
+    """Checks whether dst (an object resource or a manifest entry) is a
+    complete copy of the source object: same, non-zero, size and the same
+    crc32c (or md5, for the rare object without a crc32c)"""
+    if not src_obj or not dst:
+        return False
+    size = int(src_obj['size'])
+    if size == 0 or int(dst.get('size', -1)) != size:
+        return False
+    if src_obj.get('crc32c') and dst.get('crc32c'):
+        return src_obj['crc32c'] == dst['crc32c']
+    if src_obj.get('md5Hash') and dst.get('md5Hash'):
+        return src_obj['md5Hash'] == dst['md5Hash']
+    return False
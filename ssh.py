@@ -0,0 +1,193 @@
+"""Len Taing 2019 (TGBTG)
+CHIPS automator - ssh connection to the chips instances (shared by the
+automator scripts)
+"""
+
+import time
+import socket
+import random
+import select
+
+import workers
+import tracing
+
+class CommandTimeout(Exception):
+    """Raised when a remote command runs longer than its timeout"""
+    pass
+
+class ssh:
+    client = None
+
+    def __init__(self, address, username, key_filename, port=22, timeout=None):
+        #NOTE: paramiko is slow to import, only pay for it when connecting
+        from paramiko import client
+        # Let the user know we're connecting to the server
+        print("Connecting to server.")
+        # Create a new SSH client
+        self.client = client.SSHClient()
+        # The following line is required if you want the script to be able to access a server that's not yet in the known_hosts file
+        self.client.set_missing_host_key_policy(client.AutoAddPolicy())
+        # Make the connection
+        self.client.connect(address, port=port, username=username, key_filename=key_filename, look_for_keys=False, timeout=timeout, banner_timeout=timeout, auth_timeout=timeout)
+
+    def streamCommand(self, command, timeout=None, stdin=None):
+        """Runs the command on its own channel and YIELDS (stream, data)
+        tuples as the output arrives: ('stdout', line) or ('stderr', line)
+        and, last, ('exit', exit status)
+        stdout and stderr are read together so neither can fill up and
+        stall the remote command, and only partial lines are buffered.
+        NOTE: each call opens a new channel on the one transport, so several
+        commands can run at the same time (see sendCommands)
+        Raises CommandTimeout (and closes the channel) if the command runs
+        longer than timeout secs
+        If given, stdin (a string) is sent to the command's standard input,
+        e.g. for input too long to go on the command line"""
+        chan = self.client.get_transport().open_session()
+        t_end = time.time() + timeout if timeout else None
+        s = tracing.span("ssh", "ssh", command=command[:200])
+        s.__enter__()
+        try:
+            chan.exec_command(command)
+            if stdin is not None:
+                chan.sendall(stdin)
+                chan.shutdown_write()
+            nbytes = len(stdin or "")
+            bufs = {'stdout': b"", 'stderr': b""}
+            while True:
+                got_data = False
+                for (name, ready, recv) in [('stdout', chan.recv_ready, chan.recv),
+                                            ('stderr', chan.recv_stderr_ready, chan.recv_stderr)]:
+                    if ready():
+                        got_data = True
+                        data = recv(32768)
+                        nbytes += len(data)
+                        lines = (bufs[name] + data).split(b"\n")
+                        bufs[name] = lines.pop()
+                        for l in lines:
+                            yield (name, l.decode("utf-8", "replace"))
+
+                if t_end and time.time() > t_end:
+                    s.set(error="timed out")
+                    raise CommandTimeout("'%s' did not finish within %s secs" % (command, timeout))
+                if not got_data:
+                    if chan.exit_status_ready() and not chan.recv_ready() and not chan.recv_stderr_ready():
+                        break
+                    #wait for more output
+                    select.select([chan], [], [], 0.5)
+
+            for name in ['stdout', 'stderr']:
+                if bufs[name]:
+                    yield (name, bufs[name].decode("utf-8", "replace"))
+            status = chan.recv_exit_status()
+            s.set(status=status, bytes=nbytes)
+            yield ('exit', status)
+        finally:
+            chan.close()
+            #NOTE: not a with block b/c a generator can be abandoned part
+            #way, in which case this still closes the span
+            s.__exit__(None, None, None)
+
+    def runCommand(self, command, timeout=None):
+        """Runs the command, printing its output as it arrives (nothing is
+        kept in memory)
+        RETURNS: the command's exit status"""
+        for (name, data) in self.streamCommand(command, timeout):
+            if name == 'exit':
+                return data
+            print(data)
+
+    def sendCommand(self, command, timeout=None, stdin=None):
+        """Runs the command and RETURNS (exit status, stdout, stderr)
+        Raises CommandTimeout if the command runs longer than timeout secs
+        (see streamCommand for stdin)"""
+        # Check if connection is made previously
+        #ref: https://www.programcreek.com/python/example/7495/paramiko.SSHException
+        #example 3
+        if(self.client):
+            import paramiko
+            out = {'stdout': [], 'stderr': []}
+            status = 0
+            try:
+                for (name, data) in self.streamCommand(command, timeout, stdin):
+                    if name == 'exit':
+                        status = data
+                    else:
+                        out[name].append(data)
+            except paramiko.SSHException as e:
+                status = 1
+                out['stderr'].append(u"%s" % e)
+
+            std_out = u"\n".join(out['stdout'])
+            std_err = u"\n".join(out['stderr'])
+            return (status, std_out, std_err)
+
+    def putFiles(self, files):
+        """Uploads files over ONE sftp session on this connection
+        files is a list of (remote path, data) where data is either the
+        contents to write (a string) or an open file object to copy from"""
+        sftp = self.client.open_sftp()
+        try:
+            with tracing.span("sftp", "ssh", files=len(files)) as s:
+                nbytes = 0
+                for (path, data) in files:
+                    if hasattr(data, 'read'):
+                        nbytes += sftp.putfo(data, path).st_size or 0
+                    else:
+                        f = sftp.open(path, 'w')
+                        f.write(data)
+                        f.close()
+                        nbytes += len(data)
+                s.set(bytes=nbytes)
+        finally:
+            sftp.close()
+
+    def sendCommands(self, commands, timeout=None, num_workers=8):
+        """Runs several commands at once, each on its own channel
+        YIELDS: (command, (exit status, stdout, stderr), error) as each
+        command finishes, see workers.imap_unordered"""
+        fn = lambda cmd: self.sendCommand(cmd, timeout)
+        for res in workers.imap_unordered(fn, commands, num_workers):
+            yield res
+
+def wait_for_ssh(address, username, key_filename, port=22, deadline=600, max_delay=16, max_auth_failures=3):
+    """Blocks until the given address accepts ssh logins and returns the
+    connected ssh object.
+    Each attempt first probes the tcp port (cheap) and only then tries the
+    full ssh handshake + login; failed attempts are retried with exponential
+    backoff (1, 2, 4.. up to max_delay secs, with full jitter so that many
+    launches don't retry in lock-step) until deadline secs have passed, at
+    which point socket.timeout is raised
+    A rejected login is only retried max_auth_failures times (on a fresh
+    boot the guest may not have installed our key yet), after that the
+    AuthenticationException is raised--a wrong user/key won't get better"""
+    import paramiko
+    t_end = time.time() + deadline
+    delay = 1
+    auth_failures = 0
+    while True:
+        try:
+            sock = socket.create_connection((address, port), timeout=5)
+            sock.close()
+            return ssh(address, username, key_filename, port=port, timeout=15)
+        except paramiko.AuthenticationException as e:
+            auth_failures += 1
+            if auth_failures >= max_auth_failures:
+                raise
+            last_err = e
+        except (socket.error, paramiko.SSHException, EOFError) as e:
+            last_err = e
+
+        remaining = t_end - time.time()
+        if remaining <= 0:
+            raise socket.timeout("%s not accepting ssh logins after %s secs: %s" % (address, deadline, last_err))
+        print("%s not ready (%s), retrying..." % (address, last_err))
+        time.sleep(min(random.uniform(0, delay), remaining))
+        delay = min(delay * 2, max_delay)
+
+def wait_for_ssh_many(addresses, username, key_filename, port=22, deadline=600, num_workers=16):
+    """Waits on several launches at once, see wait_for_ssh
+    YIELDS: (address, ssh object, error) tuples as each address becomes
+    ready (or fails to within the deadline, in which case ssh is None)"""
+    fn = lambda addr: wait_for_ssh(addr, username, key_filename, port, deadline)
+    for res in workers.imap_unordered(fn, addresses, num_workers):
+        yield res
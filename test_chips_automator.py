@@ -0,0 +1,487 @@
+#!/usr/bin/env python
+"""Len Taing 2019 (TGBTG)
+CHIPS automator - unit tests for the retry/wait logic and the cohort
+sharding, run against the in-process fakes (see fakes.py), e.g.
+python -m pytest -q test_chips_automator.py (or python -m unittest)
+"""
+
+import os
+import shutil
+import time
+import socket
+import subprocess
+import tempfile
+import unittest
+import collections
+
+import gcp
+import cache
+import fakes
+import ssh
+import bucket
+import instance
+import chips_automator
+import chips_automator_fleet
+
+class FakeClock(object):
+    """Stands in for the time module: sleep() just moves the clock on (and
+    records the delay), so backoff can be checked without waiting"""
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, secs):
+        self.sleeps.append(secs)
+        self.now += secs
+
+def _free_port():
+    """RETURNS: a local port that nothing is listening on"""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+class WaitForSshTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.saved = (ssh.time, ssh.random.uniform, ssh.ssh)
+        ssh.time = self.clock
+        #NOTE: no jitter, i.e. always sleep the full delay
+        ssh.random.uniform = lambda a, b: b
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(50)
+        self.port = self.server.getsockname()[1]
+
+    def tearDown(self):
+        (ssh.time, ssh.random.uniform, ssh.ssh) = self.saved
+        self.server.close()
+
+    def _login(self, failures, exception):
+        """Replaces the ssh class with one that raises exception on the first
+        failures logins; RETURNS: the list of login attempts"""
+        calls = []
+        class _ssh(object):
+            def __init__(self, *args, **kwargs):
+                calls.append(args)
+                if len(calls) <= failures:
+                    raise exception("login failed")
+        ssh.ssh = _ssh
+        return calls
+
+    def test_backoff_until_deadline(self):
+        with self.assertRaises(socket.timeout):
+            ssh.wait_for_ssh('127.0.0.1', 'chips', 'key', port=_free_port(),
+                             deadline=60, max_delay=16)
+        self.assertEqual(self.clock.sleeps[:6], [1, 2, 4, 8, 16, 16])
+        self.assertAlmostEqual(sum(self.clock.sleeps), 60)
+
+    def test_retries_until_login(self):
+        import paramiko
+        calls = self._login(2, paramiko.SSHException)
+        conn = ssh.wait_for_ssh('127.0.0.1', 'chips', 'key', port=self.port)
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(self.clock.sleeps, [1, 2])
+        self.assertTrue(conn is not None)
+
+    def test_auth_failure_limit(self):
+        import paramiko
+        calls = self._login(10, paramiko.AuthenticationException)
+        with self.assertRaises(paramiko.AuthenticationException):
+            ssh.wait_for_ssh('127.0.0.1', 'chips', 'key', port=self.port,
+                             deadline=600, max_auth_failures=3)
+        self.assertEqual(len(calls), 3)
+
+    def test_auth_failure_recovers(self):
+        import paramiko
+        calls = self._login(2, paramiko.AuthenticationException)
+        ssh.wait_for_ssh('127.0.0.1', 'chips', 'key', port=self.port,
+                         max_auth_failures=3)
+        self.assertEqual(len(calls), 3)
+
+class WaitForOperationsTest(unittest.TestCase):
+    project = 'test-project'
+
+    def setUp(self):
+        self.compute = fakes.FakeCompute(latencies={'api': 0, 'default': 0.05,
+                                                    'instance': 3600, 'wait_max': 0.1})
+
+    def _operation(self, zone, kind='default', fail=False):
+        def _apply():
+            if fail:
+                raise ValueError("disk quota exceeded")
+        op = self.compute._operation(kind, self.project, zone, "link", "1", _apply)
+        return op['name']
+
+    def test_collects_every_error(self):
+        ok = [self._operation('us-east1-b') for i in range(3)]
+        failed = [self._operation('us-east1-b', fail=True) for i in range(2)]
+        slow = self._operation('us-east1-b', kind='instance')
+        done = []
+        with self.assertRaises(instance.OperationError) as cm:
+            for (op, result) in instance.wait_for_operations(self.compute, self.project, 'us-east1-b',
+                                                             ok + failed + [slow], timeout=0.5):
+                done.append(op)
+        self.assertEqual(sorted(done), sorted(ok))
+        errors = cm.exception.errors
+        self.assertEqual(sorted(errors), sorted(failed + [slow]))
+        for op in failed:
+            self.assertTrue("disk quota exceeded" in str(errors[op]))
+        self.assertTrue("timed out" in str(errors[slow]))
+
+    def test_zones(self):
+        ops = [('us-east1-b', self._operation('us-east1-b')),
+               ('us-west1-a', self._operation('us-west1-a')),
+               ('us-west1-a', self._operation('us-west1-a', fail=True))]
+        done = []
+        with self.assertRaises(instance.OperationError) as cm:
+            for (zone_op, result) in instance.wait_for_zone_operations(self.compute, self.project, ops):
+                done.append(zone_op)
+                self.assertEqual(result['status'], 'DONE')
+        self.assertEqual(sorted(done), sorted(ops[:2]))
+        self.assertEqual(list(cm.exception.errors), [ops[2][1]])
+
+    def test_timeout_cuts_long_poll(self):
+        #the long-poll (up to 120 secs here) mustn't run past the timeout
+        self.compute.latencies['wait_max'] = 120
+        slow = self._operation('us-east1-b', kind='instance')
+        quick = self._operation('us-east1-b')
+        start = time.time()
+        with self.assertRaises(instance.OperationError) as cm:
+            list(instance.wait_for_operations(self.compute, self.project, 'us-east1-b', [slow, quick], timeout=1))
+        self.assertTrue(time.time() - start < 5)
+        self.assertEqual(list(cm.exception.errors), [slow])
+
+    def test_all_ok(self):
+        ops = [self._operation('us-east1-b') for i in range(4)]
+        done = [op for (op, result) in instance.wait_for_operations(self.compute, self.project, 'us-east1-b', ops)]
+        self.assertEqual(sorted(done), sorted(ops))
+
+class RefDiskTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.saved = cache._cache_dir
+        cache._cache_dir = os.path.join(self.root, "cache")
+        self.server = fakes.FakeSSHServer(dict(os.environ))
+        self.key = fakes.FakeSSHServer.client_key(os.path.join(self.root, "id_rsa"))
+        latencies = dict((k, 0.01) for k in fakes._default_latencies)
+        latencies['wait_max'] = 1
+        self.compute = fakes.FakeCompute(latencies)
+
+    def tearDown(self):
+        cache._cache_dir = self.saved
+        self.server.close()
+        shutil.rmtree(self.root)
+
+    def _ref_disk_mode(self, ref_mode, instance_pool_size=0, run=1):
+        name = "chips-auto-test-%s-%s-%s" % (ref_mode, instance_pool_size, run)
+        instance_config = {'name': name, 'image_name': '', 'image_family': 'chips',
+                           'machine_type': 'n1-standard-8', 'serviceAcct': 'test@example.com'}
+        (instance_id, ip, ssh_conn) = chips_automator.createInstanceDisk(
+            self.compute, instance_config, 'chips-ref', {'name': "%s-disk" % name, 'size': 10},
+            {'user': 'chips', 'key': self.key, 'port': self.server.port},
+            'test-project', 'us-east1-b', ref_mode=ref_mode, instance_pool_size=instance_pool_size)
+        ssh_conn.client.close()
+        inst = self.compute.instances_[('test-project', 'us-east1-b', name)]
+        return [d['mode'] for d in inst['disks'] if d['deviceName'] == "persistent-disk-2"][0]
+
+    def test_snapshot_ref_disk_writable(self):
+        self.assertEqual(self._ref_disk_mode('snapshot'), 'READ_WRITE')
+
+    def test_kept_ref_disks_read_only(self):
+        #shared and pool ref disks outlive the run, so no run may change them
+        self.assertEqual(self._ref_disk_mode('shared'), 'READ_ONLY')
+        self.assertEqual(self._ref_disk_mode('pool'), 'READ_ONLY')
+        #NOTE: the 1st run fills the instance pool, the 2nd claims from it
+        self.assertEqual(self._ref_disk_mode('pool', instance_pool_size=1), 'READ_ONLY')
+        self.assertEqual(self._ref_disk_mode('pool', instance_pool_size=1, run=2), 'READ_ONLY')
+        #i.e. the 2nd run didn't create its own (plus the pool's new one)
+        self.assertEqual(len(self.compute.instances_), 5)
+
+class ClaimPooledInstanceTest(unittest.TestCase):
+    project = 'test-project'
+    zone = 'us-east1-b'
+    image = "projects/test-project/global/images/chips-v1"
+
+    def setUp(self):
+        latencies = dict((k, 0.01) for k in fakes._default_latencies)
+        latencies['wait_max'] = 1
+        self.compute = fakes.FakeCompute(latencies)
+        instance.fill_instance_pool(self.compute, self.image, 1, 'n1-standard-8', self.project,
+                                    'test@example.com', self.zone)
+        for inst in self.compute.instances_.values():
+            inst['status'] = 'TERMINATED'
+        self.saved = (fakes._Instances.setName, fakes._Instances.setMachineType)
+
+    def tearDown(self):
+        (fakes._Instances.setName, fakes._Instances.setMachineType) = self.saved
+
+    def _fail(self, method):
+        def _raise(*args, **kwargs):
+            raise fakes.http_error(503, "backend error")
+        setattr(fakes._Instances, method, _raise)
+
+    def _claim(self):
+        return instance.claim_pooled_instance(self.compute, self.image, 'chips-auto-run',
+                                              'n1-highmem-32', self.project, self.zone)
+
+    def test_claim(self):
+        self.assertTrue(self._claim())
+        inst = self.compute.instances_[(self.project, self.zone, 'chips-auto-run')]
+        self.assertEqual(inst['labels'], {})
+        self.assertTrue(inst['machineType'].endswith("/n1-highmem-32"))
+        self.assertEqual(self._claim(), None)
+
+    def test_failed_rename_returns_to_pool(self):
+        self._fail('setName')
+        with self.assertRaises(Exception):
+            self._claim()
+        self.assertEqual(len(instance.find_pooled_instances(self.compute, self.image, self.project,
+                                                            self.zone, 'TERMINATED')), 1)
+
+    def test_failed_resize_deletes(self):
+        #it has the run's name by then, so it can't go back to the pool
+        self._fail('setMachineType')
+        with self.assertRaises(Exception):
+            self._claim()
+        self.assertEqual(self.compute.instances_, {})
+
+class FleetTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.saved = (gcp.build, chips_automator.loadConfig)
+        services = {'compute': fakes.FakeCompute(), 'storage': fakes.FakeStorage(self.root, latency=0)}
+        gcp.build = lambda name, version: services[name]
+
+    def tearDown(self):
+        (gcp.build, chips_automator.loadConfig) = self.saved
+        shutil.rmtree(self.root)
+
+    def test_rejects_sharded(self):
+        chips_automator.loadConfig = lambda f: {'instance_name': 'cohort', 'shards': 4}
+        runs = chips_automator_fleet.runFleet(["cohort.yaml"], 'chips', 'key')
+        self.assertEqual([r['status'] for r in runs], ['FAILED'])
+        self.assertTrue("chips_automator.py -c cohort.yaml" in runs[0]['message'])
+
+class ShardCohortTest(unittest.TestCase):
+    def _config(self, samples, runs):
+        """samples is a list of (name, number of files), runs a list of
+        (run, treat, control)"""
+        config = {'instance_name': 'cohort'}
+        config['samples'] = collections.OrderedDict(
+            (s, ["gs://bucket/%s_%s.fastq.gz" % (s, i) for i in range(n)]) for (s, n) in samples)
+        config['metasheet'] = collections.OrderedDict(
+            (run, {'treat1': treat, 'cont1': cont}) for (run, treat, cont) in runs)
+        return config
+
+    def _groups(self, shards):
+        return sorted(sorted(sh['samples']) for sh in shards)
+
+    def test_shared_control_stays_together(self):
+        config = self._config([('T1', 1), ('T2', 1), ('C1', 1), ('T3', 1), ('C2', 1)],
+                              [('r1', 'T1', 'C1'), ('r2', 'T2', 'C1'), ('r3', 'T3', 'C2')])
+        shards = chips_automator.shardCohort(config, 2)
+        self.assertEqual(self._groups(shards), [['C1', 'T1', 'T2'], ['C2', 'T3']])
+        for sh in shards:
+            for run in sh['metasheet'].values():
+                for s in chips_automator.runSamples(run):
+                    self.assertTrue(s in sh['samples'])
+
+    def test_loose_samples(self):
+        #samples without a run each go on their own
+        config = self._config([('A', 1), ('B', 1), ('C', 1), ('D', 1)], [])
+        shards = chips_automator.shardCohort(config, 4)
+        self.assertEqual(self._groups(shards), [['A'], ['B'], ['C'], ['D']])
+        self.assertEqual([sh['metasheet'] for sh in shards], [{}] * 4)
+
+    def test_shard_count(self):
+        #at most one shard per group, however many are asked for
+        config = self._config([('T1', 1), ('C1', 1), ('T2', 1), ('C2', 1)],
+                              [('r1', 'T1', 'C1'), ('r2', 'T2', 'C2')])
+        shards = chips_automator.shardCohort(config, 8)
+        self.assertEqual(len(shards), 2)
+        self.assertEqual([sh['shard'] for sh in shards], ['s1', 's2'])
+        self.assertEqual([sh['instance_name'] for sh in shards], ['cohort-s1', 'cohort-s2'])
+        self.assertTrue(all('shards' not in sh for sh in shards))
+
+    def test_balanced_by_size(self):
+        config = self._config([('A', 6), ('B', 3), ('C', 2), ('D', 1)], [])
+        shards = chips_automator.shardCohort(config, 2)
+        self.assertEqual(self._groups(shards), [['A'], ['B', 'C', 'D']])
+        self.assertEqual(sorted(sh['shard_size'] for sh in shards), [6, 6])
+
+    def test_source_object_sizes(self):
+        config = self._config([('A', 1), ('B', 1), ('C', 1)], [])
+        sizes = {'A': 10, 'B': 6, 'C': 5}
+        source_objects = dict(("gs://bucket/%s_0.fastq.gz" % s, {'size': str(sizes[s])}) for s in sizes)
+        shards = chips_automator.shardCohort(config, 2, source_objects)
+        self.assertEqual(self._groups(shards), [['A'], ['B', 'C']])
+
+    def test_similar_names(self):
+        #S1 and S1_rep are different samples, i.e. not linked by name
+        config = self._config([('S1', 1), ('S1_rep', 1), ('C1', 1)],
+                              [('r1', 'S1', 'C1')])
+        shards = chips_automator.shardCohort(config, 2)
+        self.assertEqual(self._groups(shards), [['C1', 'S1'], ['S1_rep']])
+
+class CheckPathsTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.storage = fakes.FakeStorage(self.root, latency=0, page_size=10)
+        #a big shared fastq directory
+        for i in range(200):
+            self.storage.put("gs://bucket/fastq/SAMPLE%03d_R1.fastq.gz" % i, b"reads")
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_narrow_listing(self):
+        paths = ["gs://bucket/fastq/SAMPLE12%s_R1.fastq.gz" % i for i in range(4)]
+        paths.append("gs://bucket/fastq/SAMPLE12_missing.fastq.gz")
+        start = gcp.request_count()
+        (objects, invalid) = bucket.check_paths(self.storage, paths)
+        self.assertEqual(sorted(objects), sorted(paths[:4]))
+        self.assertEqual(invalid, paths[4:])
+        #one page of SAMPLE12*, not the 20 pages of the whole directory
+        self.assertEqual(gcp.request_count() - start, 1)
+
+    def test_stops_after_last_name(self):
+        paths = ["gs://bucket/fastq/SAMPLE000_R1.fastq.gz", "gs://bucket/fastq/SAMPLE015_R1.fastq.gz"]
+        start = gcp.request_count()
+        (objects, invalid) = bucket.check_paths(self.storage, paths)
+        self.assertEqual((sorted(objects), invalid), (paths, []))
+        self.assertEqual(gcp.request_count() - start, 2)
+
+    def test_lookups(self):
+        paths = ["gs://bucket/fastq/SAMPLE001_R1.fastq.gz", "gs://bucket/other/x.fastq.gz", "bucket/x"]
+        (objects, invalid) = bucket.check_paths(self.storage, paths)
+        self.assertEqual(sorted(objects), paths[:1])
+        self.assertEqual(sorted(invalid), sorted(paths[1:]))
+
+class BulkCopyTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.storage = fakes.FakeStorage(os.path.join(self.root, "gcs"), latency=0)
+        self.env = dict(os.environ)
+        self.env.update(self.storage.install_gsutil(os.path.join(self.root, "bin")))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_copies_into_new_dirs(self):
+        data = os.path.join(self.root, "data")
+        manifest = []
+        for s in ["S1", "S2", "S 3"]:
+            for r in ["R1", "R2"]:
+                self.storage.put("gs://bucket/%s_%s.fastq.gz" % (s, r), b"reads")
+                manifest.append(("gs://bucket/%s_%s.fastq.gz" % (s, r), os.path.join(data, s)))
+        manifest.append(("gs://bucket/missing.fastq.gz", os.path.join(data, "S4")))
+        (cmd, stdin) = chips_automator.bulkCopyCommand(manifest, num_workers=4)
+        proc = subprocess.Popen(["bash", "-c", cmd], stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=self.env)
+        out = proc.communicate(stdin.encode("utf-8"))[0].decode("utf-8")
+        (results, elapsed) = chips_automator.parseBulkCopyOutput(out)
+        status = dict((r['src'], r['status']) for r in results)
+        self.assertEqual(status.pop("gs://bucket/missing.fastq.gz"), "FAIL")
+        self.assertEqual(sorted(status.values()), ["OK"] * 6)
+        for (src, dst) in manifest[:-1]:
+            self.assertTrue(os.path.isfile(os.path.join(dst, src.split("/")[-1])))
+        self.assertTrue(os.path.isfile(os.path.join(data, "S 3", ".ready")))
+        self.assertTrue(elapsed > 0)
+
+class SetupTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.saved = chips_automator._setup_script
+
+    def tearDown(self):
+        chips_automator._setup_script = self.saved
+        shutil.rmtree(self.root)
+
+    def _run(self, script, config):
+        chips_automator._setup_script = os.path.join(self.root, "setup.sh")
+        f = open(chips_automator._setup_script, "w")
+        f.write(script)
+        f.close()
+        os.chmod(chips_automator._setup_script, 0o755)
+        return subprocess.call(["bash", "-c", chips_automator.setupCommand('chips', config)])
+
+    def test_script_takes_devs(self):
+        script = '#!/bin/bash\n[ "$CHIPS_DATA_DEV" = "%s" ] && [ "$1" = chips ]\n' % chips_automator._data_dev
+        self.assertEqual(self._run(script, {}), 0)
+
+    def test_old_script(self):
+        #an older script would format/mount sdb/sdc, so it mustn't be run
+        marker = os.path.join(self.root, "ran")
+        script = "#!/bin/bash\ntouch %s\n" % marker
+        self.assertEqual(self._run(script, {}), chips_automator._setup_unsupported)
+        self.assertFalse(os.path.exists(marker))
+
+class ValidateConfigTest(unittest.TestCase):
+    config = {'instance_name': 'test', 'cores': 32, 'disk_size': 500,
+              'google_bucket_path': "gs://bucket/run",
+              'samples': {'S1': ["gs://bucket/S1.fastq.gz"]},
+              'metasheet': {'r1': {'treat1': 'S1'}}}
+
+    def _errors(self, word, **fields):
+        return [e for e in chips_automator.validateConfig(dict(self.config, **fields), template=None) if word in e]
+
+    def test_disk_performance(self):
+        _errors = lambda **fields: self._errors("disk_", **fields)
+        self.assertEqual(_errors(disk_type='hyperdisk-balanced', disk_iops=5000, disk_throughput=300), [])
+        self.assertEqual(_errors(disk_type='pd-extreme', disk_iops=10000), [])
+        self.assertEqual(len(_errors(disk_type='pd-ssd', disk_iops=10000)), 1)
+        self.assertEqual(len(_errors(disk_iops=10000, disk_throughput=300)), 2)
+        self.assertEqual(len(_errors(disk_type='pd-extreme', disk_throughput=300)), 1)
+        self.assertEqual(len(_errors(disk_type='local-ssd', disk_iops=10000)), 1)
+
+    def test_cohort_rules(self):
+        #the shards and the pipelined waves leave them out
+        _errors = lambda **fields: self._errors("cohort_rules", **fields)
+        self.assertEqual(_errors(), [])
+        self.assertEqual(len(_errors(pipelined=True)), 1)
+        self.assertEqual(len(_errors(shards=2)), 1)
+        self.assertEqual(len(_errors(pipelined=True, cohort_rules=['report', 'bad rule'])), 1)
+        self.assertEqual(_errors(pipelined=True, cohort_rules=['report']), [])
+        self.assertEqual(_errors(shards=2, cohort_rules=['report']), [])
+
+class FindEmptyObjectsTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.storage = fakes.FakeStorage(self.root, latency=0)
+        #a chips results tree: everything under one analysis/ prefix
+        self.empty = []
+        for s in ["S%s" % i for i in range(3)]:
+            for d in ["align/%s" % s, "peaks/%s" % s, "logs/%s" % s]:
+                self.storage.put("gs://bucket/run/analysis/%s/%s.txt" % (d, s), b"data")
+                self.empty.append("gs://bucket/run/analysis/%s/%s.empty" % (d, s))
+        self.empty.append("gs://bucket/run/analysis/report.html")
+        self.empty.append("gs://bucket/run/top.txt")
+        for p in self.empty:
+            self.storage.put(p, b"")
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_fans_out(self):
+        shards = bucket.scan_shards(self.storage, 'bucket', 'run/', num_workers=8)
+        self.assertTrue(len(shards) >= 8)
+        #run/ and run/analysis/ are listed a level at a time
+        self.assertTrue(('run/', False) in shards)
+        self.assertTrue(('run/analysis/', False) in shards)
+        self.assertTrue(('run/analysis/align/S0/', True) in shards)
+
+    def test_stops_at_enough_shards(self):
+        shards = bucket.scan_shards(self.storage, 'bucket', 'run/', num_workers=1)
+        self.assertEqual(shards, [('run/', False), ('run/analysis/', True)])
+
+    def test_finds_each_once(self):
+        for num_workers in [1, 2, 8, 64]:
+            found = list(bucket.find_empty_objects(self.storage, "gs://bucket/run", num_workers))
+            self.assertEqual(sorted(found), sorted(self.empty))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+"""Len Taing 2019 (TGBTG)
+CHIPS automator - lightweight tracing: spans around the automator's phases,
+api calls, ssh commands, subprocesses and transfers which record their wall
+time (plus retries, bytes moved etc.) and are exported as a Chrome trace,
+i.e. open the file in chrome://tracing or https://ui.perfetto.dev
+NOTE: tracing is off unless enable() is called (e.g. --trace); while it's
+off, span() hands back a shared do-nothing object, so the cost is one
+function call per instrumented site
+"""
+
+import os
+import json
+import time
+import threading
+import functools
+
+_enabled = False
+_events = []
+_lock = threading.Lock()
+#thread ids -> names, for the trace viewer's thread labels
+_threads = {}
+#tids of the lanes for events timed elsewhere, see add
+_lanes = {}
+_t0 = time.time()
+
+def enable():
+    """Turns tracing on (from now on)"""
+    global _enabled, _t0
+    _t0 = time.time()
+    _enabled = True
+
+def enabled():
+    return _enabled
+
+class _NoSpan(object):
+    """What span() returns while tracing is off"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set(self, **args):
+        pass
+
+_no_span = _NoSpan()
+
+class Span(object):
+    """Times a block of code, see span"""
+    def __init__(self, name, cat, args):
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def set(self, **args):
+        """Adds to the span's args, e.g. span.set(bytes=1234, retries=2)"""
+        self.args.update(args)
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.time()
+        if exc_type is not None:
+            self.args['error'] = "%s: %s" % (exc_type.__name__, exc)
+        t = threading.current_thread()
+        _record({'name': self.name, 'cat': self.cat, 'ph': 'X',
+                 'ts': (self.start - _t0) * 1e6, 'dur': (end - self.start) * 1e6,
+                 'pid': os.getpid(), 'tid': t.ident, 'args': self.args},
+                (t.ident, t.name))
+        return False
+
+def _record(event, thread=None):
+    with _lock:
+        _events.append(event)
+        if thread:
+            _threads[thread[0]] = thread[1]
+
+def span(name, cat="automator", **args):
+    """Context manager that records the wall time of its block as a span
+    named name (cat groups spans, e.g. 'api', 'ssh'); args are shown with
+    the span and more can be added with .set(), e.g.
+        with tracing.span("transfer", files=10) as s:
+            ...
+            s.set(bytes=total)
+    If the block raises, the error is recorded with the span"""
+    if not _enabled:
+        return _no_span
+    return Span(name, cat, args)
+
+def traced(name=None, cat="automator"):
+    """Decorator version of span, named after the fn unless name is given"""
+    def _decorator(fn):
+        label = name or fn.__name__
+        @functools.wraps(fn)
+        def _wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            with Span(label, cat, {}):
+                return fn(*args, **kwargs)
+        return _wrapper
+    return _decorator
+
+def add(name, cat, start, end, lane_group="remote", **args):
+    """Records a span that was timed elsewhere, e.g. on the instance, from
+    its start and end (epoch secs).  These are laid out on lanes named
+    after lane_group so that overlapping spans don't hide each other"""
+    if not _enabled:
+        return
+    with _lock:
+        lanes = _lanes.setdefault(lane_group, [])
+        for (i, lane_end) in enumerate(lanes):
+            if lane_end <= start:
+                lanes[i] = end
+                break
+        else:
+            lanes.append(end)
+            i = len(lanes) - 1
+        tid = "%s-%s" % (lane_group, i)
+        _threads[tid] = "%s %s" % (lane_group, i)
+        _events.append({'name': name, 'cat': cat, 'ph': 'X',
+                        'ts': (start - _t0) * 1e6, 'dur': (end - start) * 1e6,
+                        'pid': os.getpid(), 'tid': tid, 'args': args})
+
+#span args that are totalled up by summary
+_summed = ('bytes', 'files', 'retries', 'requests')
+
+def summary():
+    """RETURNS: {(cat, name): {'count', 'secs', and the totals of the
+    _summed args}} over everything recorded so far"""
+    totals = {}
+    with _lock:
+        events = list(_events)
+    for e in events:
+        t = totals.setdefault((e['cat'], e['name']), {'count': 0, 'secs': 0.0})
+        t['count'] += 1
+        t['secs'] += e['dur'] / 1e6
+        for k in _summed:
+            if k in e['args']:
+                t[k] = t.get(k, 0) + e['args'][k]
+    return totals
+
+def printSummary():
+    """Prints the summary as a table, slowest first"""
+    totals = summary()
+    print("%-10s %-40s %6s %10s  %s" % ("category", "span", "count", "secs", "other"))
+    for (key, t) in sorted(totals.items(), key=lambda kv: -kv[1]['secs']):
+        other = ", ".join("%s=%s" % (k, t[k]) for k in sorted(t) if k not in ('count', 'secs'))
+        print("%-10s %-40s %6s %10.2f  %s" % (key[0], key[1][:40], t['count'], t['secs'], other))
+
+def save(path):
+    """Writes everything recorded so far to path as a Chrome trace"""
+    with _lock:
+        events = list(_events)
+        threads = dict(_threads)
+    meta = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid,
+             'args': {'name': name}} for (tid, name) in threads.items()]
+    f = open(path, "w")
+    json.dump({'traceEvents': meta + events, 'displayTimeUnit': 'ms'}, f)
+    f.close()
@@ -0,0 +1,149 @@
+"""Len Taing 2019 (TGBTG)
+CHIPS automator - thread pool helpers shared by the automator scripts
+"""
+
+import time
+import threading
+from multiprocessing.pool import ThreadPool
+try:
+    import queue
+except ImportError: #python2
+    import Queue as queue
+
+import tracing
+
+def _call(args):
+    """Runs fn(item) and packs the outcome so that a failing call never
+    takes down the pool (NOTE: SystemExit is caught too b/c some of the
+    automator fns call sys.exit on bad input)"""
+    (fn, item) = args
+    try:
+        return (item, fn(item), None)
+    except (Exception, SystemExit) as e:
+        return (item, None, e)
+
+def imap_unordered(fn, items, workers=8):
+    """Applies fn to each of the items on a pool of at most 'workers' threads
+    YIELDS: (item, result, error) tuples in the order the calls finish;
+    error is None if the call succeeded, otherwise it is the exception raised
+    """
+    items = list(items)
+    if not items:
+        return
+
+    pool = ThreadPool(max(1, min(workers, len(items))))
+    try:
+        for res in pool.imap_unordered(_call, [(fn, i) for i in items]):
+            yield res
+    finally:
+        pool.close()
+        pool.join()
+
+def run_graph(tasks, num_workers=8):
+    """Runs a dependency graph of tasks: each task is started (on a pool of at
+    most num_workers threads) as soon as all of its dependencies are done.
+    INPUT: a dictionary of {name: (list of dependency names, fn)} where fn is
+    called with a dictionary of {name: result} of the tasks finished so far
+    RETURNS: a tuple (results, timings) where results is {name: result} and
+    timings is {name: (start, end)} in seconds since the graph started
+    NOTE: if a task fails, no new tasks are started and the error is
+    re-raised once the running tasks finish
+    """
+    pending = dict(tasks)
+    results = {}
+    timings = {}
+    done = queue.Queue()
+    t0 = time.time()
+
+    def _run(name, fn, finished):
+        start = time.time() - t0
+        with tracing.span(name, "task") as s:
+            (_, res, err) = _call((fn, finished))
+            if err is not None:
+                s.set(error=str(err))
+        done.put((name, res, err, start, time.time() - t0))
+
+    pool = ThreadPool(max(1, num_workers))
+    running = 0
+    failed = None
+    try:
+        while pending or running:
+            if failed is None:
+                ready = [n for n in pending
+                         if all(d in results for d in pending[n][0])]
+                for name in ready:
+                    (deps, fn) = pending.pop(name)
+                    pool.apply_async(_run, (name, fn, dict(results)))
+                    running += 1
+            if not running:
+                break
+
+            (name, res, err, start, end) = done.get()
+            running -= 1
+            timings[name] = (start, end)
+            if err is not None:
+                failed = failed or (name, err)
+            else:
+                results[name] = res
+    finally:
+        pool.close()
+        pool.join()
+
+    if failed:
+        print("ERROR: %s failed" % failed[0])
+        raise failed[1]
+    if pending:
+        raise ValueError("Unresolvable task dependencies: %s" % ", ".join(sorted(pending)))
+    return (results, timings)
+
+def imap_generators(fn, items, num_workers=8, maxsize=1000):
+    """Runs the generator fn(item) for each of the items on a pool of at most
+    num_workers threads and YIELDS the values as the generators produce
+    them (in no particular order).
+    NOTE: values pass through a queue of at most maxsize entries, so the
+    workers are held back rather than piling results up in memory if the
+    consumer is slow.  If a generator fails, the error is re-raised here.
+    """
+    items = list(items)
+    if not items:
+        return
+
+    out = queue.Queue(maxsize)
+    stop = threading.Event()
+
+    def _put(msg):
+        #don't block forever if the consumer has gone away
+        while not stop.is_set():
+            try:
+                out.put(msg, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def _run(item):
+        try:
+            for val in fn(item):
+                if stop.is_set():
+                    break
+                _put(('val', val))
+            _put(('done', None))
+        except (Exception, SystemExit) as e:
+            _put(('done', e))
+
+    pool = ThreadPool(max(1, min(num_workers, len(items))))
+    try:
+        for item in items:
+            pool.apply_async(_run, (item,))
+        remaining = len(items)
+        while remaining:
+            (kind, val) = out.get()
+            if kind == 'val':
+                yield val
+            else:
+                remaining -= 1
+                if val is not None:
+                    raise val
+    finally:
+        stop.set()
+        pool.close()
+        pool.join()